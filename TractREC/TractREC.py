@@ -7,31 +7,584 @@ Created on Thu Oct 22 10:07:32 2015
 import utils as utils
 import preprocessing as preproc
 
-def imgLoad(full_fileName, RETURN_RES=False, RETURN_HEADER=False):
+
+class LRUCache(object):
+    """
+    Thread-safe least-recently-used cache of numpy arrays (or tuples that contain them) with a memory budget in bytes
+    Entries are evicted oldest-first once the budget is exceeded, entries larger than the budget are never stored
+    hits and misses are counted so that you can check that the cache is doing something useful
+    """
+    def __init__(self, max_bytes=0):
+        import threading
+        from collections import OrderedDict
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                value, nbytes = self._entries.pop(key)
+                self._entries[key] = (value, nbytes)  # move to the end, most recently used
+                self.hits += 1
+                return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                    'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self._entries) > 0:
+            self.nbytes -= self._entries.popitem(last=False)[1][1]
+
+
+_IMG_CACHE = LRUCache(max_bytes=0)  # process-wide, disabled until set_img_cache_size is called
+
+
+def set_img_cache_size(max_bytes):
+    """
+    Set the memory budget (in bytes) of the process-wide image cache used by imgLoad(CACHE=True)
+    0 (the default) disables the cache, reducing the budget evicts the least recently used images
+    e.g., set_img_cache_size(2 * 1024**3) to keep up to 2GB of decoded images in memory
+    """
+    _IMG_CACHE.set_max_bytes(max_bytes)
+
+
+def clear_img_cache():
+    """
+    Remove all images from the image cache and reset the hit/miss counters
+    """
+    _IMG_CACHE.clear()
+
+
+def get_img_cache_stats():
+    """
+    Return dictionary of image cache statistics {'hits','misses','entries','nbytes','max_bytes'}
+    """
+    return _IMG_CACHE.stats()
+
+
+FLOAT_DTYPE = 'float32'  # precision of floating point image data in computations, see set_float_dtype
+
+
+def set_float_dtype(dtype):
+    """
+    Set the package-wide precision of floating point image data, 'float32' (default) or 'float64'
+    Honoured by tract_seg3, DKE_by_slice, and smooth_data_array. Sums, means, and standard deviations are always
+    accumulated in float64, so float32 mainly halves the memory of the data (and of the maths that runs over it)
+    """
+    import numpy as np
+    global FLOAT_DTYPE
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'f':
+        raise ValueError("Float precision must be a floating point dtype, not {0}".format(dtype))
+    FLOAT_DTYPE = dtype.name
+
+
+def get_float_dtype():
+    """
+    Return the numpy dtype that floating point image data is computed in (see set_float_dtype)
+    """
+    import numpy as np
+    return np.dtype(FLOAT_DTYPE)
+
+
+def get_file_key(full_fileName):
+    """
+    Identity of a file on disk as (absolute path, modification time, size)
+    The key changes whenever the file is rewritten, so it is safe to use for caching
+    """
+    import os
+    st = os.stat(full_fileName)
+    return os.path.abspath(full_fileName), st.st_mtime, st.st_size
+
+
+def imgLoad(full_fileName, RETURN_RES=False, RETURN_HEADER=False, LAZY=False, CACHE=False, nthreads=1):
     """
     Load img file with nibabel, returns data and affine by default
     returns data, affine, and dimension resolution (if RETURN_RES=True)
+    LAZY=True returns nibabel's array proxy (img.dataobj) in place of the data. Nothing is decoded until you slice it,
+    uncompressed .nii files are memory-mapped, and slicing only reads what you ask for
+    (e.g., data[:, :, 10:20] or get_img_volume(data, volume_idx) for one volume of a 4D file)
+    CACHE=True looks the file up in the process-wide image cache first (keyed on path, mtime, and size) and stores it
+    there after loading. Cached data is returned READ-ONLY, copy it if you need to modify it. Does nothing unless the
+    cache has been given a budget with set_img_cache_size, and is ignored when LAZY=True
+    nthreads>1 (or None for all cpus) decompresses .nii.gz files on multiple threads (see parallel_gzip), which is
+    fastest for files written by niiSave with nthreads/compresslevel set
     """
     import nibabel as nb
-    img = nb.load(full_fileName)
+    if CACHE and not LAZY and _IMG_CACHE.max_bytes > 0:
+        key = get_file_key(full_fileName)
+        cached = _IMG_CACHE.get(key)
+        if cached is None:
+            data, affine, zooms, header = imgLoad(full_fileName, RETURN_RES=True, RETURN_HEADER=True,
+                                                  nthreads=nthreads)
+            data.flags.writeable = False  # shared between callers, so nobody gets to change it
+            cached = (data, affine, zooms, header)
+            _IMG_CACHE.put(key, cached, data.nbytes)
+        data, affine, zooms, header = cached
+        affine = affine.copy()
+        header = header.copy()
+    elif not LAZY and nthreads != 1 and full_fileName.endswith('.nii.gz'):
+        import parallel_gzip as pgz
+        data, affine, header = pgz.load_nii_gz(full_fileName, nthreads=nthreads)
+        zooms = header.get_zooms()
+    else:
+        img = nb.load(full_fileName)
+        if LAZY:
+            data = img.dataobj
+        else:
+            data = img.get_data()
+        affine = img.affine
+        zooms = img.header.get_zooms()
+        header = img.get_header()
     if RETURN_RES and not RETURN_HEADER:
-        return img.get_data(), img.affine, img.header.get_zooms()
+        return data, affine, zooms
     elif RETURN_HEADER and not RETURN_RES:
-        return img.get_data(), img.affine, img.get_header()
+        return data, affine, header
     elif RETURN_RES and RETURN_HEADER:
-        return img.get_data(), img.affine, img.header.get_zooms(), img.get_header()
+        return data, affine, zooms, header
+    else:
+        return data, affine
+
+
+def get_img_volume(data, volume_idx=0):
+    """
+    Return a single 3D volume of 3D or 4D image data as a numpy array
+    Works on numpy arrays and on the lazy proxies returned by imgLoad(LAZY=True), in which case only the
+    selected volume is read from disk
+        - data:         numpy array or array proxy
+        - volume_idx:   index of the volume in the 4th dimension (ignored for 3D data)
+    """
+    import numpy as np
+    if len(data.shape) > 3:
+        return np.asanyarray(data[:, :, :, volume_idx])
+    else:
+        return np.asanyarray(data)
+
+
+def iter_img_volumes(full_fileName, volume_idxs=None):
+    """
+    Read the volumes of a 3D or 4D image one at a time, yields (volume_idx, 3D numpy array)
+    The file is opened once and kept open, so reading the volumes of a .nii.gz in order decompresses it once (rather than
+    from the start for every volume), and only one volume is in memory at a time
+        - full_fileName:    3D or 4D image (a 3D image is volume 0)
+        - volume_idxs:      volumes to read, in this order (sorted is fastest), None for all of them
+    """
+    import nibabel as nb
+    if full_fileName.endswith('.nii') or full_fileName.endswith('.nii.gz'):
+        img = nb.load(full_fileName, keep_file_open=True)
     else:
-        return img.get_data(), img.affine
+        img = nb.load(full_fileName)
+    if volume_idxs is None:
+        volume_idxs = range(img.shape[3] if len(img.shape) > 3 else 1)
+    for volume_idx in volume_idxs:
+        yield volume_idx, get_img_volume(img.dataobj, volume_idx)
+
+
+def iter_img_slabs(full_fileName, slab_size=16, volume_idx=0):
+    """
+    Read a 3D image (or one volume of a 4D image) in slabs along the 3rd dimension, yields (start, stop, slab)
+    The file is opened once and the slabs are read in order, so a .nii.gz is decompressed once and only one slab is in
+    memory at a time
+        - full_fileName:    3D or 4D image
+        - slab_size:        number of slices per slab
+        - volume_idx:       volume to read from a 4D image (ignored for 3D images)
+    """
+    import numpy as np
+    import nibabel as nb
+    if full_fileName.endswith('.nii') or full_fileName.endswith('.nii.gz'):
+        img = nb.load(full_fileName, keep_file_open=True)
+    else:
+        img = nb.load(full_fileName)
+    data = img.dataobj
+    for start in range(0, data.shape[2], slab_size):
+        stop = min(start + slab_size, data.shape[2])
+        if len(data.shape) > 3:
+            slab = data[:, :, start:stop, volume_idx]
+        else:
+            slab = data[:, :, start:stop]
+        yield start, stop, np.array(slab)  # a copy, so that it can be modified (e.g., a memory-mapped label slab)
 
 
 # for backwards compatability with previous scripts
 niiLoad = imgLoad
 
 
+_RESAMPLE_CACHE = LRUCache(max_bytes=0)  # process-wide, disabled until set_resample_cache_size is called
+RESAMPLE_CACHE_DIR = None  # where resampled images are persisted, None for $TRACTREC_RESAMPLE_CACHE_DIR (or nowhere)
+
+
+def set_resample_cache_size(max_bytes, cache_dir=None):
+    """
+    Set the memory budget (in bytes) of the process-wide cache of resampled images used by resample_to_grid, and
+    optionally a directory to also persist them in (shared by worker processes and by later runs)
+    0 (the default) disables the in-memory cache, reducing the budget evicts the least recently used images
+    e.g., set_resample_cache_size(1024**3, cache_dir='/scratch/resampled') when applying one atlas to a cohort
+    Worker processes (n_jobs>1) start with an empty, disabled in-memory cache, so set $TRACTREC_RESAMPLE_CACHE_DIR
+    to share resampled images with them through the disk cache
+    """
+    global RESAMPLE_CACHE_DIR
+    _RESAMPLE_CACHE.set_max_bytes(max_bytes)
+    if cache_dir is not None:
+        RESAMPLE_CACHE_DIR = cache_dir
+
+
+def clear_resample_cache():
+    """
+    Remove all resampled images from the in-memory cache and reset the hit/miss counters (the disk cache is kept)
+    """
+    _RESAMPLE_CACHE.clear()
+
+
+def get_resample_cache_stats():
+    """
+    Return dictionary of resampling cache statistics {'hits','misses','entries','nbytes','max_bytes'}
+    """
+    return _RESAMPLE_CACHE.stats()
+
+
+def get_nearest_grid_index(source_affine, source_shape, target_affine, target_shape, tol=1e-6):
+    """
+    Source voxel of every target voxel along each axis, for grids whose axes are parallel and in the same direction
+    (diagonal voxel to voxel transform: integer or other scaling, plus any translation), exactly as nearest neighbour
+    resample_img (scipy's affine_transform with order=0) computes them: same floating point operations, half way
+    between two source voxels rounds up, and target voxels outside of [0, n - 1] in source voxels are empty
+    Returns a list of one index array per axis (-1 where the target voxel is outside of the source), or None if the
+    transform is not diagonal or the grids do not overlap, or (scipy < 1.6, which has other edges) a target voxel is
+    within tol of the half voxel beyond the edge of the source
+    """
+    import numpy as np
+    import scipy
+    from scipy import linalg
+    source_affine = np.asarray(source_affine, dtype=np.float64)
+    target_affine = np.asarray(target_affine, dtype=np.float64)
+    if np.all(target_affine == source_affine):
+        transform = np.eye(4)
+    else:  # the same arithmetic as resample_img, so that the coordinates are identical to the last bit
+        transform = np.dot(linalg.inv(source_affine), target_affine)
+    A = transform[:3, :3]
+    if not np.all(np.diag(np.diag(A)) == A) or np.any(np.diag(A) <= 0):
+        return None
+    from nilearn.image.resampling import get_bounds
+    bounds = get_bounds(source_shape[:3], np.linalg.inv(target_affine).dot(source_affine))
+    if np.any([bound[1] < 0 for bound in bounds]):  # resample_img raises a BoundingBoxError
+        return None
+    old_edges = [int(num) for num in scipy.__version__.split('.')[:2]] < [1, 6]
+    index = []
+    for zoom, shift, n_source, n_target in zip(np.diag(A), transform[:3, 3], source_shape[:3], target_shape[:3]):
+        coord = (np.arange(n_target) + shift / zoom) * zoom  # as computed by scipy's zoom_shift
+        edge = ((coord < 0) & (coord > -0.5 - tol)) | ((coord > n_source - 1) & (coord < n_source - 0.5 + tol))
+        if old_edges and np.any(edge):
+            return None
+        idx = np.floor(coord + 0.5).astype(np.intp)
+        idx[(coord < 0) | (coord > n_source - 1)] = -1
+        if np.all(idx < 0):
+            return None
+        index.append(idx)
+    return index
+
+
+def resample_nearest(img, target_affine, target_shape):
+    """
+    Nearest neighbour resampling of an image to a target grid, with the same result as nilearn's
+    resample_img(interpolation='nearest', force_resample=True)
+    Grids with parallel axes (integer voxel size ratios, translations, see get_nearest_grid_index) are resampled by
+    indexing alone: slices where the source voxels are evenly spaced (downsampling by an integer factor, translations),
+    repeats of consecutive voxels (upsampling) and a gather otherwise. Anything else (rotations, flips) goes to
+    resample_img, with force_resample because the shortcut that nilearn (e.g., 0.9) takes for whole voxel translations
+    places the wrong part of the image when the target grid starts inside of the source
+        - img:              nibabel image or image file
+        - target_affine:    4x4 affine of the target grid
+        - target_shape:     3D shape of the target grid
+    Returns numpy array of the resampled data (in the dtype of the image data)
+    """
+    import numpy as np
+    import nibabel as nb
+    if isinstance(img, basestring):
+        img = nb.load(img)
+    target_affine = np.asarray(target_affine, dtype=np.float64)
+    target_shape = tuple([int(dim) for dim in target_shape])
+    if np.allclose(target_affine, img.affine) and np.array_equal(target_shape, img.shape[:3]):
+        return np.asanyarray(img.dataobj)  # resample_img returns these as they are
+    index = get_nearest_grid_index(img.affine, img.shape, target_affine, target_shape)
+    if index is None:
+        from nilearn.image import resample_img
+        return np.asarray(resample_img(img, target_affine, target_shape, interpolation='nearest',
+                                       force_resample=True).get_data())
+
+    data = np.asanyarray(img.dataobj)
+    if data.dtype.kind == 'f':
+        data = np.where(np.isinf(data), np.nan, data)  # resample_img only keeps nans (after extrapolating them)
+    out = np.zeros(target_shape + data.shape[3:], dtype=data.dtype)
+    place = []  # the target voxels inside of the source are a contiguous block along each axis
+    for axis, idx in enumerate(index):
+        inside = np.flatnonzero(idx >= 0)
+        place.append(slice(inside[0], inside[-1] + 1))
+        idx = idx[inside]
+        step = idx[1] - idx[0] if len(idx) > 1 else 1
+        vals, counts = np.unique(idx, return_counts=True)
+        if step > 0 and np.all(np.diff(idx) == step):
+            data = data[(slice(None),) * axis + (slice(idx[0], idx[-1] + 1, step),)]
+        elif np.all(np.diff(vals) == 1):
+            data = np.repeat(data[(slice(None),) * axis + (slice(vals[0], vals[-1] + 1),)], counts, axis=axis)
+        else:
+            data = np.take(data, idx, axis=axis)
+    out[tuple(place)] = data
+    return out
+
+
+def resample_to_grid(full_fileName, target_affine, target_shape, interpolation='nearest'):
+    """
+    Resample an image file to a target grid (resample_nearest for nearest neighbour, nilearn's resample_img otherwise),
+    through a cache keyed on the identity of the file (path, mtime, size), the target affine and shape, and the
+    interpolation
+    The in-memory cache is used if it has a budget (see set_resample_cache_size), and resampled images are also saved
+    to / loaded from RESAMPLE_CACHE_DIR (or $TRACTREC_RESAMPLE_CACHE_DIR) if set
+    Returns the resampled data READ-ONLY whenever it comes from (or goes into) a cache, copy it if you need to modify it
+    """
+    import os
+    import hashlib
+    import numpy as np
+    from nilearn.image import resample_img
+    target_affine = np.asarray(target_affine, dtype=np.float64)
+    target_shape = tuple([int(dim) for dim in target_shape])
+    key = (get_file_key(full_fileName), target_affine.tobytes(), target_shape, interpolation)
+    USE_MEMORY = _RESAMPLE_CACHE.max_bytes > 0
+    if USE_MEMORY:
+        data = _RESAMPLE_CACHE.get(key)
+        if data is not None:
+            return data
+    cache_dir = RESAMPLE_CACHE_DIR
+    if cache_dir is None:
+        cache_dir = os.environ.get('TRACTREC_RESAMPLE_CACHE_DIR')
+    cache_fname = None
+    data = None
+    if cache_dir is not None:
+        cache_fname = os.path.join(cache_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npy')
+        if os.path.isfile(cache_fname):
+            data = np.load(cache_fname)
+    if data is None:
+        if interpolation == 'nearest':
+            data = np.array(resample_nearest(full_fileName, target_affine, target_shape))
+        else:
+            data = resample_img(full_fileName, target_affine, target_shape, interpolation=interpolation).get_data()
+            data = np.asarray(data)
+        if cache_fname is not None:  # written under a temporary name and moved, so readers never see half a file
+            try:
+                os.makedirs(cache_dir)
+            except OSError:  # already there (possibly made by another worker just now)
+                pass
+            tmp_fname = "{0}.{1}.tmp.npy".format(cache_fname[:-len('.npy')], os.getpid())
+            np.save(tmp_fname, data)
+            os.rename(tmp_fname, cache_fname)
+    if USE_MEMORY or cache_fname is not None:
+        data.flags.writeable = False  # shared between callers, so nobody gets to change it
+    if USE_MEMORY:
+        _RESAMPLE_CACHE.put(key, data, data.nbytes)
+    return data
+
+
 # XXX add mnc saving
 # def imgSave(full_fileName, data, aff, data_type='float32', CLOBBER=True):
 
-def niiSave(full_fileName, data, aff, header=None, data_type='float32', CLOBBER=True, VERBOSE=False):
+class AsyncNiiWriter(object):
+    """
+    Bounded pool of background threads for writing nii files with niiSave, so that computation does not wait on gzip
+    save() returns a concurrent.futures.Future immediately and blocks only once queue_depth writes are already
+    waiting, so at most queue_depth arrays are held in memory. The writer takes ownership of the array that you pass
+    in: do not modify it after calling save() (pass a copy if you need to keep working on it)
+    flush() (or leaving a with block) waits for all pending writes and raises the first error that occurred
+        - nthreads:         number of writing threads
+        - queue_depth:      maximum number of writes pending (queued or in progress)
+    """
+    def __init__(self, nthreads=2, queue_depth=4):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        self.queue_depth = queue_depth
+        self._pool = ThreadPoolExecutor(max_workers=nthreads)
+        self._slots = threading.BoundedSemaphore(queue_depth)
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def save(self, full_fileName, data, aff, **kwargs):
+        """
+        Queue niiSave(full_fileName, data, aff, **kwargs), returns a Future (result is the file name)
+        """
+        self._slots.acquire()  # wait here if the queue is full
+        try:
+            future = self._pool.submit(self._save, full_fileName, data, aff, kwargs)
+        except:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.append(future)
+        return future
+
+    def _save(self, full_fileName, data, aff, kwargs):
+        try:
+            niiSave(full_fileName, data, aff, **kwargs)
+            return full_fileName
+        finally:
+            self._slots.release()
+
+    def flush(self):
+        """
+        Wait for all pending writes to finish, raises the first exception raised by any of them
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+        error = None
+        for future in pending:
+            if future.exception() is not None and error is None:
+                error = future.exception()
+        if error is not None:
+            raise error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+_NII_WRITER = None
+
+
+def get_nii_writer():
+    """
+    The process-wide AsyncNiiWriter used by niiSave(..., ASYNC=True), created on first use
+    """
+    global _NII_WRITER
+    if _NII_WRITER is None:
+        _NII_WRITER = AsyncNiiWriter()
+    return _NII_WRITER
+
+
+def flush_nii_writes():
+    """
+    Wait for all files queued with niiSave(..., ASYNC=True) to be written
+    """
+    if _NII_WRITER is not None:
+        _NII_WRITER.flush()
+
+
+WRITE_CHUNK_BYTES = 1024 ** 2  # approximate size of the pieces that niiSave casts and writes at a time
+
+
+def iter_last_axis_chunks(data, chunk_bytes=WRITE_CHUNK_BYTES, itemsize=None):
+    """
+    Yield consecutive views of data along its last axis, each about chunk_bytes in size
+    In fortran order (nifti on-disk order), the chunks together are the whole array, in order
+    """
+    import numpy as np
+    if itemsize is None:
+        itemsize = data.dtype.itemsize
+    slice_bytes = max(1, int(np.prod(data.shape[:-1])) * itemsize)
+    step = max(1, chunk_bytes // slice_bytes)
+    for start in range(0, data.shape[-1], step):
+        yield data[..., start:start + step]
+
+
+def get_min_max(data, chunk_bytes=WRITE_CHUNK_BYTES):
+    """
+    Min and max of an array in a single pass over it, one cache-sized chunk at a time
+    (the same as np.min(data), np.max(data), but the data is only read from memory once)
+    """
+    import numpy as np
+    data = np.asanyarray(data)
+    if data.ndim == 0 or data.size == 0:
+        return np.min(data), np.max(data)
+    data_min = None
+    data_max = None
+    for chunk in iter_last_axis_chunks(data, chunk_bytes):
+        chunk_min = np.min(chunk)
+        chunk_max = np.max(chunk)
+        data_min = chunk_min if data_min is None else np.minimum(data_min, chunk_min)
+        data_max = chunk_max if data_max is None else np.maximum(data_max, chunk_max)
+    return data_min, data_max
+
+
+def write_nii_by_chunk(full_fileName, img, data_min, data_max, nthreads=1, compresslevel=None,
+                       chunk_bytes=WRITE_CHUNK_BYTES):
+    """
+    Stream a Nifti1Image to a .nii or .nii.gz file, casting its data to the output dtype one chunk at a time
+    Only handles the cases where nibabel would write the values as they are (no scaling), i.e., to a float dtype or
+    from an integer dtype whose range (data_min, data_max) fits the integer output dtype
+    Returns False without writing anything if the image needs scaling (or is anything else unusual) so that you can
+    fall back to nibabel's writer
+    """
+    import gzip
+    import numpy as np
+
+    data = np.asanyarray(img.dataobj)
+    hdr = img.header.copy()
+    out_dtype = hdr.get_data_dtype()
+    if not (full_fileName.endswith('.nii') or full_fileName.endswith('.nii.gz')) or data.ndim == 0 or \
+            data.size == 0 or data.dtype.kind not in 'biuf' or out_dtype.kind not in 'iuf':
+        return False
+    if out_dtype.kind in 'iu':
+        if data.dtype.kind == 'f':  # nibabel rescales floats into integer types
+            return False
+        if data.dtype.kind in 'iu' and (data_min < np.iinfo(out_dtype).min or data_max > np.iinfo(out_dtype).max):
+            return False
+    hdr.set_slope_inter(None, None)  # what nibabel writes for unscaled data
+
+    if full_fileName.endswith('.gz'):
+        if nthreads != 1 or compresslevel is not None:
+            import parallel_gzip as pgz
+            fileobj = pgz.ParallelGzipWriter(full_fileName, compresslevel=compresslevel or 1, nthreads=nthreads)
+        else:
+            fileobj = gzip.GzipFile(full_fileName, 'wb', compresslevel=1)  # nibabel's default
+    else:
+        fileobj = open(full_fileName, 'wb')
+    with fileobj:
+        hdr.write_to(fileobj)  # also sets vox_offset to fit any extensions
+        fileobj.write(b'\x00' * (int(hdr.get_data_offset()) - fileobj.tell()))
+        for chunk in iter_last_axis_chunks(data, chunk_bytes, itemsize=max(data.dtype.itemsize,
+                                                                           out_dtype.itemsize)):
+            chunk = np.asarray(chunk, dtype=out_dtype, order='F')
+            fileobj.write(memoryview(chunk.T))  # .T of a fortran ordered array is c-contiguous, same bytes
+    return True
+
+
+def niiSave(full_fileName, data, aff, header=None, data_type='float32', CLOBBER=True, VERBOSE=False, nthreads=1,
+            compresslevel=None, ASYNC=False):
     """
     Convenience function to write nii data to file
     Input:
@@ -41,19 +594,38 @@ def niiSave(full_fileName, data, aff, header=None, data_type='float32', CLOBBER=
         - header:			header data to write to file (use img.header to get the header of root file)
         - data_type:        numpy data type ('uint32', 'float32' etc)
         - CLOBBER:          overwrite existing file
+        - nthreads:         threads for gzip compression of .nii.gz files (None for all cpus). Output is standard gzip
+        - compresslevel:    gzip compression level 1-9 (None: nibabel's default of 1)
+        - ASYNC:            write in the background with the shared AsyncNiiWriter (see get_nii_writer) and return a
+                            Future. Do not modify data afterwards, and call flush_nii_writes() before reading the file
     """
     import os
     import nibabel as nb
-    import numpy as np
+    if ASYNC:
+        return get_nii_writer().save(full_fileName, data, aff, header=header, data_type=data_type, CLOBBER=CLOBBER,
+                                     VERBOSE=VERBOSE, nthreads=nthreads, compresslevel=compresslevel)
     img = nb.Nifti1Image(data, aff, header=header)
-    img.header['cal_min'] = np.min(data)
-    img.header['cal_max'] = np.max(data)
+    data_min, data_max = get_min_max(data)
+    img.header['cal_min'] = data_min
+    img.header['cal_max'] = data_max
 
     if data_type is not None:  # if there is a particular data_type chosen, set it
         # data=data.astype(data_type)
         img.set_data_dtype(data_type)
     if not (os.path.isfile(full_fileName)) or CLOBBER:
-        img.to_filename(full_fileName)
+        if write_nii_by_chunk(full_fileName, img, data_min, data_max, nthreads=nthreads,
+                              compresslevel=compresslevel):
+            pass  # cast and written one chunk at a time, no copy of the whole array
+        elif full_fileName.endswith('.gz') and (nthreads != 1 or compresslevel is not None):
+            import parallel_gzip as pgz
+            from nibabel.fileholders import FileHolder
+            if compresslevel is None:
+                compresslevel = 1
+            with pgz.ParallelGzipWriter(full_fileName, compresslevel=compresslevel, nthreads=nthreads) as f:
+                fh = FileHolder(fileobj=f)
+                img.to_file_map({'header': fh, 'image': fh})
+        else:
+            img.to_filename(full_fileName)
     else:
         print("This file exists and CLOBBER was set to false, file not saved.")
     if VERBOSE:
@@ -226,6 +798,50 @@ def erode_mask(img_data, iterations=1, mask=None, structure=None, LIMIT_EROSION=
     return img_data
 
 
+def erode_labels(label_data, label_ids, iterations=1, structure=None, n_jobs=1):
+    """
+    Erode each label of a label image on its own (erode_mask of label_data==label_id), IN PLACE
+    Each label is only eroded within its bounding box (from ndimage.find_objects, padded by one voxel), so the cost
+    depends on the size of the labels rather than of the volume. Labels that would disappear completely are left as
+    they are (as are labels that are not in the image)
+    INPUT:
+        - label_data    - integer label array, modified in place
+        - label_ids     - labels to erode
+        - iterations    - number of iterations for erosion
+        - structure     - as defined by ndimage (will be 3,1 (no diags) if None)
+        - n_jobs        - number of labels to erode at the same time (threads, -1 for all cpus)
+    Returns label_data, list of the label_ids that were not eroded
+    """
+    import numpy as np
+    import scipy.ndimage as ndimage
+
+    label_ids = np.ravel(label_ids)
+    max_label = int(max(label_ids.max(), 0)) if len(label_ids) > 0 else 0
+    objects = ndimage.find_objects(label_data, max_label=max_label) if max_label > 0 else []
+
+    def erode_label(label_id):
+        if label_id > 0:
+            if label_id > len(objects) or objects[int(label_id) - 1] is None:  # not in the image
+                return False
+            bbox = tuple([slice(max(sl.start - 1, 0), sl.stop + 1) for sl in objects[int(label_id) - 1]])
+        else:  # find_objects only does positive labels, so erode 0 (background) and below on the full volume
+            bbox = tuple([slice(None)] * label_data.ndim)
+        region = label_data[bbox]  # a view, so changes go straight into label_data
+        single_mask = region == label_id
+        eroded = erode_mask(single_mask.astype(np.uint8), iterations, structure=structure)
+        if not np.any(eroded):
+            return False
+        region[np.logical_and(single_mask, eroded == 0)] = 0  # only touches this label, so labels can run in parallel
+        return True
+
+    if n_jobs == 1:
+        was_eroded = [erode_label(label_id) for label_id in label_ids]
+    else:
+        from joblib import Parallel, delayed
+        was_eroded = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(erode_label)(label_id) for label_id in label_ids)
+    return label_data, [label_id for label_id, eroded in zip(label_ids, was_eroded) if not eroded]
+
+
 def generate_overlap_mask(mask1, mask2, structure=None):
     """
     Create an overlap mask where a dilated version of mask1 overlaps mask2 (logical AND operation)
@@ -281,8 +897,8 @@ def map_values_to_label_file(values_label_lut_csv_fname, label_img_fname,
     #TODO: for some reason this doesn't always work -- you will need to look into it to make sure that it works when the .nii file has MORE indices than you expect given the matrix
 
     :param values_label_lut_csv_fname: csv file mapping values to index in label_img_fname
-    :param label_img_fname: label file (nii or other)
-    :param out_mapped_label_fname: ouptut file name (nii/nii.gz only)
+    :param label_img_fname: label file (nii or other), or SparseVolume/saved SparseVolume (.npz)
+    :param out_mapped_label_fname: ouptut file name (nii/nii.gz only, or .npz to save as a SparseVolume)
     :param value_colName: name of column with values (default: Value)
     :param label_idx_colName:name of column with index numbers (default: Index)
     :param SKIP_ZERO_IDX: skips 0 (usually background) {True, False}
@@ -292,9 +908,14 @@ def map_values_to_label_file(values_label_lut_csv_fname, label_img_fname,
     import numpy as np
     import pandas as pd
     import os
+    import sparse_volume as spv
     
+    SPARSE = spv.is_sparse(label_img_fname)
     if out_mapped_label_fname is None:
-        out_mapped_label_fname = os.path.splitext(os.path.splitext(label_img_fname)[0])[0] + "_value_mapped.nii.gz" #takes care of two . extensions if necessary
+        if not isinstance(label_img_fname, basestring):
+            raise ValueError("out_mapped_label_fname is required when label_img_fname is a SparseVolume")
+        out_mapped_label_fname = os.path.splitext(os.path.splitext(label_img_fname)[0])[0] + "_value_mapped" #takes care of two . extensions if necessary
+        out_mapped_label_fname += spv.SPARSE_EXT if SPARSE else ".nii.gz"
     
     if not MATCH_VALUE_TO_LABEL_VIA_MATRIX: #we expect a csv file
         df=pd.read_csv(values_label_lut_csv_fname)
@@ -307,7 +928,11 @@ def map_values_to_label_file(values_label_lut_csv_fname, label_img_fname,
     if SKIP_ZERO_IDX and 0 in indices:
         indices = np.delete(indices, np.where(indices == 0))
 
-    d,a,h = imgLoad(label_img_fname,RETURN_HEADER=True)
+    if SPARSE: #only the labelled voxels are mapped
+        label_vol = spv.load_sparse(label_img_fname)
+        d = label_vol.values
+    else:
+        d,a,h = imgLoad(label_img_fname,RETURN_HEADER=True)
     d_out = np.zeros_like(d).astype(np.float32)
 
     for idx,index in enumerate(indices):
@@ -315,7 +940,16 @@ def map_values_to_label_file(values_label_lut_csv_fname, label_img_fname,
             print("{}, {}".format(index, values[idx]))
         d_out[d==index] = values[idx]
 
-    niiSave(out_mapped_label_fname,d_out,a,header=h)
+    if SPARSE:
+        d_out = spv.SparseVolume(label_vol.indices, d_out, label_vol.shape, label_vol.affine)
+        if not spv.is_sparse_fname(out_mapped_label_fname):
+            d_out, a, h = d_out.to_dense(), d_out.affine, None
+    elif spv.is_sparse_fname(out_mapped_label_fname):
+        d_out = spv.SparseVolume.from_dense(d_out, a)
+    if spv.is_sparse_fname(out_mapped_label_fname):
+        d_out.save(out_mapped_label_fname)
+    else:
+        niiSave(out_mapped_label_fname,d_out,a,header=h)
     return out_mapped_label_fname
 
 def map_values_to_coordinates(values, coordinates, reference_fname, out_mapped_fname=None, return_mapped_data=True):
@@ -333,12 +967,394 @@ def map_values_to_coordinates(values, coordinates, reference_fname, out_mapped_f
     if return_mapped_data or out_mapped_fname is None:
         return d_out
     
+def get_label_index(mask, mask_ids):
+    """
+    Index of the voxels of every label in a single pass over the mask (compressed sparse row style)
+    Input:
+        - mask:         label array
+        - mask_ids:     label values to index
+    Returns label_vals (sorted unique mask_ids), vox_idx, offsets: the flat (C-order) indices of the voxels of
+    label_vals[i] are vox_idx[offsets[i]:offsets[i+1]], in C-order
+    """
+    import numpy as np
+    label_vals = np.unique(np.asarray(mask_ids).ravel())
+    flat_mask = np.asarray(mask).ravel()
+    if len(label_vals) == 0:
+        return label_vals, np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64)
+    group = np.searchsorted(label_vals, flat_mask)
+    group[group == len(label_vals)] = 0
+    vox = np.flatnonzero(label_vals[group] == flat_mask)
+    group = group[vox].astype(utils.get_label_dtype(len(label_vals)))  # small ints, for a fast (radix) sort
+    vox_idx = vox[np.argsort(group, kind='stable')]  # grouped by label, still in C-order within each label
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(group, minlength=len(label_vals)))))
+    return label_vals, vox_idx, offsets
+
+
+LABEL_INDEX_TAG = '_labelidx_'  # label index sidecars are <label file without extension>_labelidx_<settings hash>.npz
+
+
+def get_label_bbox(vox_idx, offsets, shape):
+    """
+    Bounding box of the voxels of every label of a label index (see get_label_index)
+    Returns array of shape (n_labels, ndim, 2) of [start, stop) voxel coordinates along each axis, i.e.,
+    the voxels of label i are all within data[tuple(slice(*bbox[i, ax]) for ax in range(ndim))]
+    Labels without voxels have an empty box (0, 0) along every axis
+    """
+    import numpy as np
+    n_labels = len(offsets) - 1
+    bbox = np.zeros((n_labels, len(shape), 2), dtype=np.int64)
+    count = np.diff(offsets)
+    has_vox = count > 0
+    if not np.any(has_vox):
+        return bbox
+    starts = offsets[:-1][has_vox]
+    coords = np.unravel_index(vox_idx, shape)
+    for ax in range(len(shape)):
+        bbox[has_vox, ax, 0] = np.minimum.reduceat(coords[ax], starts)
+        bbox[has_vox, ax, 1] = np.maximum.reduceat(coords[ax], starts) + 1
+    return bbox
+
+
+def get_label_index_fname(mask_fname, settings):
+    """
+    File name of the label index sidecar of a label file for a given set of settings (dictionary of everything that
+    changes which voxels belong to which label: the files, their thresholds, erosion, the target grid, ...)
+    The name contains a hash of the settings, so each combination has its own sidecar next to the label file
+    """
+    import os
+    import hashlib
+    if mask_fname.endswith('.nii.gz'):
+        base = mask_fname[:-len('.nii.gz')]
+    else:
+        base = os.path.splitext(mask_fname)[0]
+    settings_hash = hashlib.sha1(repr(sorted(settings.items())).encode('utf-8')).hexdigest()[:16]
+    return base + LABEL_INDEX_TAG + settings_hash + '.npz'
+
+
+def save_label_index(index_fname, label_vals, vox_idx, offsets, shape, affine=None, BBOX=True):
+    """
+    Save a label index (see get_label_index) as .npz, with the shape and affine of the grid it indexes and (if BBOX)
+    the bounding box of every label. Written to a temporary file and moved, so parallel readers never see half of it
+    """
+    import os
+    import numpy as np
+    shape = np.array(shape, dtype=np.int64)
+    index = {'label_vals': label_vals, 'offsets': offsets, 'shape': shape,
+             'vox_idx': np.asarray(vox_idx).astype(utils.get_label_dtype(max(int(np.prod(shape)) - 1, 0)))}
+    if affine is not None:
+        index['affine'] = affine
+    if BBOX:
+        index['bbox'] = get_label_bbox(vox_idx, offsets, tuple(shape))
+    tmp_fname = "{0}.{1}.tmp.npz".format(index_fname[:-len('.npz')], os.getpid())
+    np.savez(tmp_fname, **index)
+    os.rename(tmp_fname, index_fname)
+    return index_fname
+
+
+def load_label_index(index_fname):
+    """
+    Load a label index saved with save_label_index
+    Returns label_vals, vox_idx, offsets, shape, bbox (None if it was saved without bounding boxes)
+    """
+    import numpy as np
+    with np.load(index_fname) as npz:
+        bbox = npz['bbox'] if 'bbox' in npz.files else None
+        return npz['label_vals'], npz['vox_idx'], npz['offsets'], tuple(npz['shape']), bbox
+
+
+def get_grouped_stats(values, offsets):
+    """
+    count, sum, mean, std, min, max, and (exact) median of consecutive groups of values, all groups at once
+    values[offsets[i]:offsets[i+1]] is group i. Sums are accumulated in float64, std is the population std (np.std),
+    min/max are in the dtype of values, and the median in the dtype that np.median would return
+    Empty groups have a count of 0, nan for sum/mean/std/median, and 0 for min/max
+    Returns dictionary of arrays with one entry per group: 'count','sum','mean','std','min','max','median'
+    """
+    import numpy as np
+    values = np.asarray(values)
+    offsets = np.asarray(offsets)
+    n_groups = len(offsets) - 1
+    count = np.diff(offsets)
+    has_data = count > 0
+    starts = offsets[:-1][has_data]
+    group = np.repeat(np.arange(n_groups), count)
+
+    stats = {'count': count}
+    for key in ['sum', 'mean', 'std']:
+        stats[key] = np.full(n_groups, np.nan)
+    stats['median'] = np.full(n_groups, np.nan, dtype=values.dtype if values.dtype.kind == 'f' else np.float64)
+    stats['min'] = np.zeros(n_groups, dtype=values.dtype)
+    stats['max'] = np.zeros(n_groups, dtype=values.dtype)
+    if len(starts) == 0:
+        return stats
+
+    values64 = values.astype(np.float64)
+    stats['sum'][has_data] = np.add.reduceat(values64, starts)
+    stats['mean'][has_data] = stats['sum'][has_data] / count[has_data]
+    dev = values64 - stats['mean'][group]
+    stats['std'][has_data] = np.sqrt(np.add.reduceat(dev * dev, starts) / count[has_data])
+    del dev, values64
+    stats['min'][has_data] = np.minimum.reduceat(values, starts)
+    stats['max'][has_data] = np.maximum.reduceat(values, starts)
+
+    # medians from the sorted groups, each group is contiguous so it is sorted in place on its own (much faster than
+    # sorting everything by group and value)
+    sorted_values = values.copy()
+    for start, stop in zip(offsets[:-1][has_data], offsets[1:][has_data]):
+        sorted_values[start:stop].sort()
+    lower = sorted_values[starts + (count[has_data] - 1) // 2]
+    upper = sorted_values[starts + count[has_data] // 2]
+    stats['median'][has_data] = np.mean(np.vstack((lower, upper)), axis=0)  # same dtype rules as np.median
+    if values.dtype.kind == 'f':  # np.median is nan if there is a nan in the group
+        has_nan = np.bincount(group, weights=np.isnan(values), minlength=n_groups) > 0
+        stats['median'][has_nan] = np.nan
+    return stats
+
+
+def merge_grouped_stats(labels, count, sum, m2, minn, maxx):
+    """
+    Merge per-label summaries of parts of an image (e.g., slabs) into one summary per label
+    Input: arrays with one entry per part and label, where the same label can appear any number of times
+        - labels:       label of each entry
+        - count, sum:   number and sum of the values
+        - m2:           sum of squared deviations from the mean of the entry's values (count * std**2)
+        - minn, maxx:   min and max of the values (ignored where count is 0)
+    Returns labels (sorted, unique), count, sum, m2, minn, maxx (float64, +/-inf for min/max of labels without values)
+    m2 is merged with Chan et al.'s pairwise update, so the std of the merged values is as accurate as in one pass
+    """
+    import numpy as np
+    order = np.argsort(labels, kind='stable')
+    labels = np.asarray(labels)[order]
+    count = np.asarray(count, dtype=np.float64)[order]
+    sum = np.asarray(sum, dtype=np.float64)[order]
+    m2 = np.asarray(m2, dtype=np.float64)[order]
+    has_data = count > 0
+    minn = np.where(has_data, np.asarray(minn, dtype=np.float64)[order], np.inf)
+    maxx = np.where(has_data, np.asarray(maxx, dtype=np.float64)[order], -np.inf)
+    if len(labels) == 0:
+        return labels, count, sum, m2, minn, maxx
+    starts = np.flatnonzero(np.concatenate(([True], labels[1:] != labels[:-1])))
+    group = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(labels))))
+    tot_count = np.add.reduceat(count, starts)
+    tot_sum = np.add.reduceat(np.where(has_data, sum, 0), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        part_mean = np.where(has_data, sum / np.where(has_data, count, 1), 0)
+        tot_mean = tot_sum / tot_count
+    dev = np.where(has_data, part_mean - tot_mean[group], 0)
+    tot_m2 = np.add.reduceat(np.where(has_data, m2 + count * dev * dev, 0), starts)
+    return (labels[starts], tot_count, tot_sum, tot_m2, np.minimum.reduceat(minn, starts),
+            np.maximum.reduceat(maxx, starts))
+
+
+def get_sketch_bucket(values, sketch_bits=7):
+    """
+    Bucket of each value in a log-scale histogram (the float32 sign, exponent, and first sketch_bits bits of the
+    mantissa), for mergeable quantile sketches. Buckets are integers in the order of the values, and each bucket spans a
+    relative width of at most 2**-sketch_bits, so any value in a bucket is within 2**-(sketch_bits + 1) (relative) of
+    its midpoint (get_sketch_value), whatever the range of the data
+    """
+    import numpy as np
+    bits = np.asarray(values, dtype=np.float32).view(np.uint32).astype(np.int64)
+    key = np.where(bits >= 2 ** 31, 2 ** 32 - 1 - bits, bits + 2 ** 31)  # negatives in reverse, below the positives
+    return key >> (23 - sketch_bits)
+
+
+def get_sketch_value(bucket, sketch_bits=7):
+    """
+    Midpoint of sketch buckets (see get_sketch_bucket), float64
+    """
+    import numpy as np
+    shift = 23 - sketch_bits
+    bucket = np.asarray(bucket, dtype=np.int64)
+    edges = []
+    for key in [bucket << shift, ((bucket + 1) << shift) - 1]:
+        bits = np.where(key >= 2 ** 31, key - 2 ** 31, 2 ** 32 - 1 - key).astype(np.uint32)
+        edges.append(bits.view(np.float32).astype(np.float64))
+    return (edges[0] + edges[1]) / 2
+
+
+def extract_stats_by_slab(img_fname, mask_fname, thresh_mask_fname=None, ROI_mask_fname=None, thresh_val=None,
+                          thresh_type=None, label_subset=None, SKIP_ZERO_LABEL=True, nonzero_stats=True,
+                          min_val=None, max_val=None, volume_idx=0, slab_size=16, median='exact', sketch_bits=7,
+                          VERBOSE=False):
+    """
+    Per-label statistics of an image, reading all of the images in slabs along the 3rd dimension (see iter_img_slabs),
+    so that memory is set by the slab size rather than the size of the images (e.g., for 0.3mm ex-vivo or 7T images)
+    Only mergeable per-label summaries are kept between slabs: count, sum, sum of squared deviations, min, max, and a
+    log-scale histogram of the values (see get_sketch_bucket) for the median
+    All images must be on the same grid (resample them first), thresholding, ROI masking, nonzero_stats, and clipping
+    are the same as in extract_stats_from_masked_image
+    Input:
+        - img_fname, mask_fname, ...    - as for extract_stats_from_masked_image
+        - slab_size:                    number of slices per slab
+        - median:                       {'exact','sketch'}
+                                        - exact: a second pass over the images collects only the values in the
+                                          histogram buckets that hold the median, which is then exact
+                                        - sketch: one pass, the median is the midpoint of its bucket, within a relative
+                                          error of 2**-(sketch_bits+1) (0.4% for the default 7 bits)
+        - sketch_bits:                  mantissa bits of the histogram buckets (more bits, more accurate but larger)
+    Returns dictionary of per-label arrays (float64) 'label_val' (labels that were found, or label_subset, sorted),
+    'count', 'sum', 'mean', 'std', 'min', 'max', 'median', same conventions as get_grouped_stats
+    """
+    import os
+    import numpy as np
+    import nibabel as nb
+
+    if median not in ['exact', 'sketch']:
+        raise ValueError("median must be 'exact' or 'sketch', not {0}".format(median))
+    if thresh_mask_fname is not None and thresh_type not in ['upper', 'lower']:
+        raise ValueError("set a valid thresh_type: 'upper' or 'lower'")
+    fnames = [fname for fname in [img_fname, mask_fname, thresh_mask_fname, ROI_mask_fname] if fname is not None]
+    d_img = nb.load(img_fname)
+    for fname in fnames[1:]:
+        img = nb.load(fname)
+        if img.shape[:3] != d_img.shape[:3] or not np.allclose(img.affine, d_img.affine):
+            raise ValueError("Slab-wise extraction needs all images on the same grid, resample {0} to the grid of "
+                             "{1} first".format(fname, img_fname))
+    del d_img
+    n_buckets = 2 ** (9 + sketch_bits)  # per label
+
+    def iter_label_values():
+        # (labels found in the slab, label of each value, values) for every slab, after all of the masking
+        slabs = [iter_img_slabs(fname, slab_size, volume_idx=volume_idx if fname == img_fname else 0)
+                 for fname in fnames]
+        for parts in zip(*slabs):
+            if VERBOSE:
+                print(parts[0][0]),
+            d = parts[0][2]
+            mask = parts[1][2]
+            if os.path.splitext(mask_fname)[-1] == ".mnc":  # same label values as extract_stats_from_masked_image
+                mask = utils.cast_labels(np.rint(mask))
+            else:
+                mask = utils.cast_labels(mask)
+            if thresh_mask_fname is not None:
+                if thresh_type == 'upper':
+                    mask[parts[2][2] > thresh_val] = 0
+                else:
+                    mask[parts[2][2] < thresh_val] = 0
+            if ROI_mask_fname is not None:
+                mask[parts[-1][2] < 1] = 0
+            if label_subset is None:
+                slab_ids = np.unique(mask)
+                if SKIP_ZERO_LABEL:
+                    slab_ids = slab_ids[slab_ids != 0]
+            else:
+                slab_ids = label_subset
+            slab_vals, vox_idx, offsets = get_label_index(mask, slab_ids)
+            values = d.ravel()[vox_idx]
+            group = np.repeat(np.arange(len(slab_vals)), np.diff(offsets))
+            del d, mask, vox_idx
+            if nonzero_stats:
+                keep = values > 0
+                values = values[keep]
+                group = group[keep]
+            if not max_val is None:
+                values[values > max_val] = max_val
+            if not min_val is None:
+                values[values < min_val] = min_val
+            yield slab_vals, group, values
+
+    # pass 1: summaries and histograms per label, merged after every slab
+    summary = [np.zeros(0)] + [np.zeros(0)] * 5  # labels, count, sum, m2, min, max
+    n_nan = [np.zeros(0), np.zeros(0)]  # labels, number of nans (so that the median is nan, as with np.median)
+    sketch = [np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)]  # labels, buckets, counts
+    values_dtype = None
+    for slab_vals, group, values in iter_label_values():
+        values_dtype = values.dtype
+        count = np.bincount(group, minlength=len(slab_vals))
+        has_data = count > 0
+        values64 = values.astype(np.float64)
+        sum = np.bincount(group, weights=values64, minlength=len(slab_vals))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dev = values64 - (sum / count)[group]
+        m2 = np.bincount(group, weights=dev * dev, minlength=len(slab_vals))
+        del dev, values64
+        order = np.argsort(group, kind='stable')
+        starts = np.concatenate(([0], np.cumsum(count)))[:-1][has_data]
+        minn = np.zeros(len(slab_vals))
+        maxx = np.zeros(len(slab_vals))
+        if len(starts) > 0:
+            minn[has_data] = np.minimum.reduceat(values[order], starts)
+            maxx[has_data] = np.maximum.reduceat(values[order], starts)
+        del order
+        summary = merge_grouped_stats(np.concatenate((summary[0], slab_vals)), np.concatenate((summary[1], count)),
+                                      np.concatenate((summary[2], sum)), np.concatenate((summary[3], m2)),
+                                      np.concatenate((summary[4], minn)), np.concatenate((summary[5], maxx)))
+        is_nan = np.isnan(values) if values.dtype.kind == 'f' else np.zeros(len(values), dtype=bool)
+        n_nan = [np.concatenate((n_nan[0], slab_vals)), np.concatenate(
+            (n_nan[1], np.bincount(group, weights=is_nan, minlength=len(slab_vals))))]
+        key = np.unique(group[~is_nan] * n_buckets + get_sketch_bucket(values[~is_nan], sketch_bits),
+                        return_counts=True)
+        sketch_labels = np.concatenate((sketch[0], slab_vals[key[0] // n_buckets]))
+        sketch_buckets = np.concatenate((sketch[1], key[0] % n_buckets))
+        sketch_counts = np.concatenate((sketch[2], key[1]))
+        order = np.lexsort((sketch_buckets, sketch_labels))
+        sketch_labels, sketch_buckets, sketch_counts = sketch_labels[order], sketch_buckets[order], sketch_counts[order]
+        starts = np.flatnonzero(np.concatenate(([True], (sketch_labels[1:] != sketch_labels[:-1]) |
+                                                (sketch_buckets[1:] != sketch_buckets[:-1])))) \
+            if len(sketch_labels) > 0 else np.zeros(0, dtype=int)
+        sketch = [sketch_labels[starts], sketch_buckets[starts],
+                  np.add.reduceat(sketch_counts, starts) if len(starts) > 0 else np.zeros(0, dtype=np.int64)]
+    if VERBOSE:
+        print("")
+
+    label_vals, count, sum, m2, minn, maxx = summary
+    n_nan = merge_grouped_stats(n_nan[0], n_nan[1], n_nan[1], np.zeros(len(n_nan[1])), n_nan[1], n_nan[1])[1]
+    out = {'label_val': label_vals, 'count': count, 'sum': np.where(count > 0, sum, np.nan)}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out['mean'] = sum / count
+        out['std'] = np.sqrt(m2 / count)
+    out['min'] = np.where(count > 0, minn, 0)
+    out['max'] = np.where(count > 0, maxx, 0)
+
+    # median: the bucket of each middle rank from the histogram (cumulative counts over labels and buckets)
+    out['median'] = np.full(len(label_vals), np.nan)
+    sketch_count = np.bincount(np.searchsorted(label_vals, sketch[0]), weights=sketch[2],
+                               minlength=len(label_vals)).astype(np.int64)
+    has_data = (sketch_count > 0) & (n_nan == 0)
+    if np.any(has_data):
+        cum = np.cumsum(sketch[2])
+        label_start = np.concatenate(([0], np.cumsum(sketch_count)))[:-1]  # ranks before each label
+        n = sketch_count[has_data]
+        middle = []  # (bucket position, rank of the value within its bucket) of the lower and upper middle values
+        for rank in [(n - 1) // 2, n // 2]:
+            pos = np.searchsorted(cum, label_start[has_data] + rank, side='right')
+            middle.append((pos, label_start[has_data] + rank - (cum[pos] - sketch[2][pos])))
+        if median == 'sketch':
+            out['median'][has_data] = (get_sketch_value(sketch[1][middle[0][0]], sketch_bits) +
+                                       get_sketch_value(sketch[1][middle[1][0]], sketch_bits)) / 2
+        else:
+            # pass 2: collect only the values in the buckets that hold the middle values, then pick them out
+            rows = np.flatnonzero(has_data)
+            target_keys = np.unique(np.concatenate([rows * n_buckets + sketch[1][pos] for pos, rank in middle]))
+            collected_label = []
+            collected_values = []
+            for slab_vals, group, values in iter_label_values():
+                row = np.searchsorted(label_vals, slab_vals)[group]
+                is_target = np.isin(row * n_buckets + get_sketch_bucket(values, sketch_bits), target_keys)
+                collected_label.append(row[is_target])
+                collected_values.append(values[is_target])
+            collected_label = np.concatenate(collected_label)
+            collected_values = np.concatenate(collected_values).astype(values_dtype, copy=False)
+            order = np.lexsort((collected_values, collected_label))
+            collected_values = collected_values[order]
+            first = np.searchsorted(collected_label[order], rows)  # start of each label in the collected values
+            lower_pos, lower_rank = middle[0]
+            upper_pos, upper_rank = middle[1]
+            lower = collected_values[first + lower_rank]
+            # the upper middle value is after the whole lower bucket if it is in the next bucket
+            upper = collected_values[first + upper_rank + np.where(upper_pos != lower_pos, sketch[2][lower_pos], 0)]
+            out['median'][has_data] = np.mean(np.vstack((lower, upper)), axis=0)  # same dtype rules as np.median
+    return out
+
+
 def extract_stats_from_masked_image(img_fname, mask_fname, thresh_mask_fname=None, combined_mask_output_fname=None,
                                     ROI_mask_fname=None, thresh_val=None,
                                     thresh_type=None, result='all', label_subset=None, SKIP_ZERO_LABEL=True,
                                     nonzero_stats=True,
                                     erode_vox=None, min_val=None, max_val=None, VERBOSE=False, USE_LABEL_RES=False,
-                                    volume_idx=0):
+                                    volume_idx=0, LABEL_INDEX=False, label_index_cache=None, erode_n_jobs=1,
+                                    BY_SLAB=False, slab_size=16, median='exact', VOX_COORD=True, ASYNC_WRITES=False):
     #TODO - THIS SHOULD BE CHECKED TO MAKE SURE THAT IT WORKS WITH ALL INPUTS - ASSUMPTIONS ABOUT TRANSFORMS WERE MADE XXX
     #TODO - works for NII and MNC, but NOT tested for combining the two of them XXX
     #TODO - Add an additional flag to remove 0s that are present in the metric file from analysis
@@ -352,9 +1368,12 @@ def extract_stats_from_masked_image(img_fname, mask_fname, thresh_mask_fname=Non
         - volume output based on whichever resolution you chose with USE_LABEL_RES
        Input:
          - img_fname:                   3D or 4D image (if 4D, set volume_idx to select volume)
+                                        or dictionary of {metric name: image} of one subject, in which case the masks are
+                                        only processed once (per grid) and a dictionary of results is returned
          - mask_fname:                  3D mask in same space, single or multiple labels (though not necessarily same res)
          - thresh_mask_fname:           3D mask for thresholding, can be binary or not
          - combined_mask_output_fname:  output final binary mask to this file and a _metric file - will split on periods (used for confirmation of region overlap)
+                                        (written before returning, unless ASYNC_WRITES)
          - ROI_mask_fname               3D binary mask for selecting only this region for extraction (where mask=1)
          - thresh_val:                  upper value for thresholding thresh_mask_fname, values above/below this are set to 0
          - thresh_type:                 {'upper' = > thresh_val = 0,'lower' < thresh_val = 0}
@@ -365,14 +1384,36 @@ def extract_stats_from_masked_image(img_fname, mask_fname, thresh_mask_fname=Non
          - SKIP_ZERO_LABEL:             skip where label_val==0 {True,False} (usually the background label)  - XXX probably does not work properly when False :-/
          - nonzero_stats:               calculate without 0s in img_fname, or with {True,False}
          - erode_vox                    number of voxels to erode mask by (simple dilation-erosion, then erosion, None for no erosion)
+                                        each label is eroded on its own, within its bounding box (see erode_labels)
+         - erode_n_jobs                 number of labels to erode at the same time (threads)
          - min_val:                     set min val for clipping of metric (eg., for FA maps, set to 0)
          - max_val:                     set max val for clipping of metric (eg., for FA maps, set to 1.0)
          - VERBOSE                      verbose reporting or not (default: False)
          - USE_LABEL_RES                otherwise uses the res of the img_fname (default: False)
          - volume_idx                   select volume of 4D img_fname that is selected (default=0, skipped if 3D file)
+                                        or 'all' / a list of volumes, to extract from each of them in one pass: the masks
+                                        are processed once and the volumes are read one at a time (see iter_img_volumes).
+                                        volume, mean, median, std, minn, maxx, sum, and vox_count are then arrays of
+                                        labels x volumes (in the order of volume_idx), and data/vox_coord are empty
+         - LABEL_INDEX                  keep the voxel index of every label (after resampling, thresholding, ROI masking,
+                                        and erosion) in a sidecar .npz next to mask_fname (see get_label_index_fname),
+                                        later calls with the same label file, masks, settings, and metric grid (e.g.,
+                                        other metrics of the same subject) load it instead of recomputing the mask
+         - label_index_cache            dictionary to keep label indices in (in memory, keyed like the sidecars), so that
+                                        calls that share it only process the masks once
+         - BY_SLAB                      read all images slab_size slices at a time and only keep per-label summaries
+                                        (see extract_stats_by_slab), for images that do not fit in memory. All images must
+                                        be on the same grid, erode_vox and combined_mask_output_fname are not supported,
+                                        and data/vox_coord are empty
+         - median                       {'exact','sketch'} with BY_SLAB: exact median from a second pass over the images,
+                                        or within 0.4% (relative) of it from the first pass only
+         - VOX_COORD                    compute the voxel coordinates of every label (vox_coord), set to False if you only
+                                        need the values (vox_idx, the flat index of every value in data, is always kept)
+         - ASYNC_WRITES                 write the combined_mask_output_fname files in the background, errors are raised by
+                                        flush_nii_writes() (call it before opening them)
 
        Output: (in data structure composed of numpy array(s))
-         - data, volume, mean, median, std, minn, maxx
+         - data, vox_coord, vox_idx, shape, affine, volume, mean, median, std, minn, maxx, vox_count
          - or all in data structure if result='all'
          - note: len(data)= num vox that the values were extracted from (i.e., [len(a_idx) for a_idx in res.data])
 
@@ -382,14 +1423,40 @@ def extract_stats_from_masked_image(img_fname, mask_fname, thresh_mask_fname=Non
     """
     import os
     import numpy as np
-    from nilearn.image import resample_img
+
+    if isinstance(img_fname, dict):  # several metrics of one subject, all reduced against the same label index
+        if label_index_cache is None:
+            label_index_cache = {}
+        all_results = {}
+        for metric_name, metric_fname in img_fname.items():
+            metric_output_fname = combined_mask_output_fname
+            if combined_mask_output_fname is not None:
+                metric_output_fname = combined_mask_output_fname.split('.')[0] + "_" + metric_name + ".nii.gz"
+            all_results[metric_name] = extract_stats_from_masked_image(
+                metric_fname, mask_fname, thresh_mask_fname=thresh_mask_fname,
+                combined_mask_output_fname=metric_output_fname, ROI_mask_fname=ROI_mask_fname, thresh_val=thresh_val,
+                thresh_type=thresh_type, result=result, label_subset=label_subset, SKIP_ZERO_LABEL=SKIP_ZERO_LABEL,
+                nonzero_stats=nonzero_stats, erode_vox=erode_vox, min_val=min_val, max_val=max_val, VERBOSE=VERBOSE,
+                USE_LABEL_RES=USE_LABEL_RES, volume_idx=volume_idx, LABEL_INDEX=LABEL_INDEX,
+                label_index_cache=label_index_cache, erode_n_jobs=erode_n_jobs, BY_SLAB=BY_SLAB, slab_size=slab_size,
+                median=median, VOX_COORD=VOX_COORD, ASYNC_WRITES=ASYNC_WRITES)
+        return all_results
 
     class return_results(object):
         # output results as an object with these values
-        def __init__(self, label_val, data, vox_coord, volume, mean, median, std, minn, maxx, sum, settings):
+        def __init__(self, label_val, data, vox_coord, volume, mean, median, std, minn, maxx, sum, settings,
+                     vox_count=None, vox_idx=None, shape=None, affine=None):
             self.label_val = np.array(label_val)
-            self.data = np.array(data)
-            self.vox_coord = np.array(vox_coord)
+            self.data = np.empty(len(data), dtype=object)  # one array per label, of different lengths
+            self.vox_coord = np.empty(len(vox_coord), dtype=object)
+            self.vox_idx = np.empty(len(data), dtype=object)  # flat index of each value of data (empty for no data)
+            for idx in range(len(data)):
+                self.data[idx] = data[idx]
+                self.vox_coord[idx] = vox_coord[idx]
+                if vox_idx is not None:
+                    self.vox_idx[idx] = vox_idx[idx]
+            self.shape = shape  # and affine of the grid that the values were extracted on
+            self.affine = affine
             self.volume = np.array(volume)
             self.mean = np.array(mean)
             self.median = np.array(median)
@@ -398,6 +1465,9 @@ def extract_stats_from_masked_image(img_fname, mask_fname, thresh_mask_fname=Non
             self.maxx = np.array(maxx)
             self.sum = np.array(sum)
             self.settings = settings
+            if vox_count is None:  # number of values that the stats were calculated from
+                vox_count = [len(a_idx) for a_idx in data]
+            self.vox_count = np.array(vox_count)
 
         def __str__(self):
             # defines what is returned when print is called on this class
@@ -421,6 +1491,7 @@ def extract_stats_from_masked_image(img_fname, mask_fname, thresh_mask_fname=Non
     d_label_val = []
     d_data = []
     d_vox_coord = []
+    d_vox_idx = []
     d_volume = []
     d_mean = []
     d_median = []
@@ -440,31 +1511,92 @@ def extract_stats_from_masked_image(img_fname, mask_fname, thresh_mask_fname=Non
                   'erode_vox': erode_vox,
                   'min_val': min_val,
                   'max_val': max_val,
-                  'USE_LABEL_RES': USE_LABEL_RES}
-
-    d, daff, dr, dh = imgLoad(img_fname, RETURN_RES=True, RETURN_HEADER=True)
-
-    if len(np.shape(d))>3:
+                  'USE_LABEL_RES': USE_LABEL_RES,
+                  'volume_idx': volume_idx}
+
+    d, daff, dr, dh = imgLoad(img_fname, RETURN_RES=True, RETURN_HEADER=True, LAZY=True)
+
+    volume_idxs = None  # volumes to extract from, if there is more than one
+    if isinstance(volume_idx, basestring):
+        if volume_idx != 'all':
+            raise ValueError("volume_idx must be an index, a list of indices, or 'all', not " + volume_idx)
+        volume_idxs = list(range(d.shape[3] if len(d.shape) > 3 else 1))
+    elif np.ndim(volume_idx) > 0:
+        volume_idxs = [int(idx) for idx in np.ravel(volume_idx)]
+    if volume_idxs is not None:
+        if len(volume_idxs) == 0:
+            raise ValueError("No volumes were selected with volume_idx")
+        volume_idx = volume_idxs[0]  # the masks are prepared on (and debug files written with) the first volume
+        d_settings['volume_idx'] = volume_idxs
+
+    if BY_SLAB:  # per-label summaries merged slab by slab, the full images are never in memory
+        if erode_vox is not None or combined_mask_output_fname is not None or volume_idxs is not None:
+            raise ValueError("BY_SLAB does not support erode_vox, combined_mask_output_fname, or several volumes")
+        slab_stats = extract_stats_by_slab(img_fname, mask_fname, thresh_mask_fname=thresh_mask_fname,
+                                           ROI_mask_fname=ROI_mask_fname, thresh_val=thresh_val,
+                                           thresh_type=thresh_type, label_subset=label_subset,
+                                           SKIP_ZERO_LABEL=SKIP_ZERO_LABEL, nonzero_stats=nonzero_stats,
+                                           min_val=min_val, max_val=max_val, volume_idx=volume_idx,
+                                           slab_size=slab_size, median=median, VERBOSE=VERBOSE)
+        mask_ids = slab_stats['label_val'] if label_subset is None else np.ravel(label_subset)
+        rows = np.searchsorted(slab_stats['label_val'], mask_ids)
+        vox_vol = np.prod(dr)
+        count = slab_stats['count'][rows]
+        empty = count == 0  # as in the default path, labels without data get zeros (and a vox_count of 1)
+        out = {}
+        for key in ['mean', 'median', 'std', 'min', 'max', 'sum']:
+            out[key] = np.where(empty, 0, slab_stats[key][rows])
+        results = return_results(mask_ids, [], [], count * vox_vol, out['mean'], out['median'], out['std'],
+                                 out['min'], out['max'], out['sum'] * vox_vol, d_settings,
+                                 vox_count=np.where(empty, 1, count).astype(int))
+        if result == 'all':
+            return results
+        return getattr(results, {'min': 'minn', 'max': 'maxx'}.get(result, result), None)
+
+    if len(d.shape)>3:
         #we sent 4d data!
         if VERBOSE:
-            print("You are trying to extract metrics from a single volume of a 4d file, it should work (but takes longer, sorry)... ")
-        print(" Extracting from volume index: " + str(volume_idx))
-        print("    - data shape: " + str(np.shape(d)))
-        d = d[:,:,:,volume_idx] #select the volume that was requested
-        
-    mask, maff, mr, mh = imgLoad(mask_fname, RETURN_RES=True, RETURN_HEADER=True)
+            print("You are trying to extract metrics from a single volume of a 4d file, only this volume will be read from disk.")
+        if volume_idxs is None:
+            print(" Extracting from volume index: " + str(volume_idx))
+        else:
+            print(" Extracting from {0} volumes".format(len(volume_idxs)))
+        print("    - data shape: " + str(d.shape))
+    d = get_img_volume(d, volume_idx) #select the volume that was requested (reads the whole file if 3d)
+
+    label_index = None  # (label_vals, vox_idx, offsets) from the cache or the sidecar of the label file, if there is one
+    if LABEL_INDEX or label_index_cache is not None:
+        label_index_fname = get_label_index_fname(mask_fname, {
+            'label': get_file_key(mask_fname),
+            'thresh_mask': None if thresh_mask_fname is None else get_file_key(thresh_mask_fname),
+            'ROI_mask': None if ROI_mask_fname is None else get_file_key(ROI_mask_fname),
+            'thresh_val': thresh_val, 'thresh_type': thresh_type, 'erode_vox': erode_vox,
+            'label_subset': None if label_subset is None else np.ravel(label_subset).tolist(),
+            'SKIP_ZERO_LABEL': SKIP_ZERO_LABEL, 'USE_LABEL_RES': USE_LABEL_RES,
+            'grid': (np.round(daff, 6).tolist(), tuple(np.shape(d)))})
+        if label_index_cache is not None and label_index_fname in label_index_cache:
+            label_index = label_index_cache[label_index_fname]
+        elif LABEL_INDEX and os.path.isfile(label_index_fname):
+            label_index = load_label_index(label_index_fname)[0:3]
+            if VERBOSE:
+                print(" Using label index: " + label_index_fname)
 
-    if os.path.splitext(mask_fname)[
-        -1] == ".mnc":  # test if the extension is mnc, and make sure we have integers in this case...
-        if VERBOSE:
-            print(" Looks like you are using mnc files.")
-            print(
-                " Make sure that ALL of your input data is in the same space and mnc format (i.e., don't mix mnc and nii.gz)")
-            print(
-                " I will also force all your label values to be integers as a hack to fix non-integer values stored in the file. np.rint(labels).astype(int)")
-        mask = np.rint(mask).astype(int)  # round with rint and the convert to int
-    else: #cast labels into integers
-        mask = mask.astype(int)
+    if label_index is not None:  # only the header is needed, the voxels of every label come from the index
+        mask, maff, mr, mh = imgLoad(mask_fname, RETURN_RES=True, RETURN_HEADER=True, LAZY=True)
+    else:
+        mask, maff, mr, mh = imgLoad(mask_fname, RETURN_RES=True, RETURN_HEADER=True, CACHE=True)
+
+        if os.path.splitext(mask_fname)[
+            -1] == ".mnc":  # test if the extension is mnc, and make sure we have integers in this case...
+            if VERBOSE:
+                print(" Looks like you are using mnc files.")
+                print(
+                    " Make sure that ALL of your input data is in the same space and mnc format (i.e., don't mix mnc and nii.gz)")
+                print(
+                    " I will also force all your label values to be integers as a hack to fix non-integer values stored in the file. np.rint(labels)")
+            mask = utils.cast_labels(np.rint(mask))  # round with rint and the convert to int
+        else: #cast labels into the smallest integer type that holds them (also gives us a writeable copy of cached data)
+            mask = utils.cast_labels(mask)
 
     # dumb way to do this,but too much coffee today
     if USE_LABEL_RES:
@@ -477,9 +1609,9 @@ def extract_stats_from_masked_image(img_fname, mask_fname, thresh_mask_fname=Non
             print(mr),
         # see if we need to resample the img to the mask
         if not np.array_equal(np.diagonal(maff), np.diagonal(daff)):
-            d = resample_img(img_fname, maff, np.shape(mask), interpolation='nearest').get_data()
-            if len(np.shape(d))>3:
-                d = d[:,:,:,volume_idx]
+            import nibabel as nb
+            # resample only the volume that we selected, rather than the whole 4d file
+            d = resample_nearest(nb.Nifti1Image(d, daff), maff, np.shape(mask))
     else:  # default way, use img_fname resolution
         chosen_aff = daff
         chosen_header = dh
@@ -489,20 +1621,20 @@ def extract_stats_from_masked_image(img_fname, mask_fname, thresh_mask_fname=Non
             print(" Any calculation of volume will be based on metric_file resolution: "),
             print(dr)
         # see if we need to resample the mask to the img
-        if not np.array_equal(np.diagonal(maff), np.diagonal(daff)):
+        if label_index is None and not np.array_equal(np.diagonal(maff), np.diagonal(daff)):
             if VERBOSE:
                 print("   -->Resampling mask to image space with nearest neighbour interpolation. No registration performed.<--\n")
-            mask = resample_img(mask_fname, daff, np.shape(d), interpolation='nearest').get_data()
+            mask = utils.cast_labels(resample_to_grid(mask_fname, daff, np.shape(d), interpolation='nearest'))
 
         else:  # they are the same and we already loaded the data
             pass
 
     # if we have passed an additional thresholding mask, move to the same space,
     # thresh at the given thresh_val, and remove from our mask
-    if thresh_mask_fname is not None:
-        thresh_mask, thresh_maff = imgLoad(thresh_mask_fname)
+    if thresh_mask_fname is not None and label_index is None:
+        thresh_mask, thresh_maff = imgLoad(thresh_mask_fname, CACHE=True)
         if not np.array_equal(np.diagonal(thresh_maff), np.diagonal(chosen_aff)):
-            thresh_mask = resample_img(thresh_mask_fname, chosen_aff, chosen_shape, interpolation='nearest').get_data()
+            thresh_mask = resample_to_grid(thresh_mask_fname, chosen_aff, chosen_shape, interpolation='nearest')
         else:
             pass  # we already have the correct data
 
@@ -514,16 +1646,18 @@ def extract_stats_from_masked_image(img_fname, mask_fname, thresh_mask_fname=Non
             print("set a valid thresh_type: 'upper' or 'lower'")
             return
 
-    if ROI_mask_fname is not None:
-        ROI_mask, ROI_maff = imgLoad(ROI_mask_fname)
+    if ROI_mask_fname is not None and label_index is None:
+        ROI_mask, ROI_maff = imgLoad(ROI_mask_fname, CACHE=True)
         if not np.array_equal(np.diagonal(ROI_maff), np.diagonal(chosen_aff)):
-            ROI_mask = resample_img(ROI_mask_fname, chosen_aff, chosen_shape, interpolation='nearest').get_data()
+            ROI_mask = resample_to_grid(ROI_mask_fname, chosen_aff, chosen_shape, interpolation='nearest')
         else:  # we already have the correct data
             pass
 
         mask[ROI_mask < 1] = 0  # remove from the final mask
 
-    if label_subset is None:
+    if label_subset is None and label_index is not None:
+        mask_ids = label_index[0]  # the labels that were in the mask when the index was built
+    elif label_subset is None:
         mask_ids = np.unique(mask)
         # print(mask)
         if SKIP_ZERO_LABEL:
@@ -533,68 +1667,153 @@ def extract_stats_from_masked_image(img_fname, mask_fname, thresh_mask_fname=Non
 
     if len(mask_ids) == 1:  # if we only have one, we need to make it iterable
         mask_ids = [mask_ids]
-    if erode_vox is not None:  # we can also erode each individual mask to get rid of some partial voluming issues (does no erosion if mask vox count falls to 0)
-        single_mask = np.zeros_like(mask)
-        for mask_id in mask_ids:
-            single_mask[mask == mask_id] = 1
-            temp_mask = np.copy(single_mask)
-            single_mask = erode_mask(single_mask, erode_vox)
-            temp_mask[
-                np.logical_and(mask == mask_id, single_mask == 0)] = 0  # to check how many vox's we will have left over
-            if np.sum(
-                    temp_mask) > 0:  # if we know that there is still at least one mask voxel leftover... we use the erosion
-                mask[np.logical_and(mask == mask_id, single_mask == 0)] = 0
-            else:
-                print("Label id: " + str(
-                    mask_id) + ': Not enough voxels to erode!')  # This intelligence has also been added to erode_mask, but leaving it explicit here
-            single_mask = single_mask * 0  # clear the single mask
-        del single_mask
+    if erode_vox is not None and label_index is None:  # we can also erode each individual mask to get rid of some partial voluming issues (does no erosion if mask vox count falls to 0)
+        for mask_id in erode_labels(mask, mask_ids, erode_vox, n_jobs=erode_n_jobs)[1]:
+            print("Label id: " + str(mask_id) + ': Not enough voxels to erode!')  # This intelligence has also been added to erode_mask, but leaving it explicit here
+
+    # one pass over the volume for all labels: group the voxels by label (or read the groups from the sidecar)
+    if label_index is None:
+        label_index = get_label_index(mask, mask_ids)
+        if LABEL_INDEX:
+            try:
+                save_label_index(label_index_fname, *label_index, shape=chosen_shape, affine=chosen_aff)
+            except (IOError, OSError):
+                print("OH SHIT, could not write the label index: " + label_index_fname)
+    if label_index_cache is not None:
+        label_index_cache[label_index_fname] = label_index
+    label_vals, vox_idx, coord_offsets = label_index
+    del mask  # everything below works from the index
 
     if combined_mask_output_fname is not None:
         if VERBOSE:
             print(" Debug files:")
             print("  " + combined_mask_output_fname)
             print("  " + combined_mask_output_fname.split('.')[0] + "_metric.nii.gz")
-        mask_t = np.zeros_like(mask)
-        for mask_id in mask_ids:
-            mask_t[mask==mask_id] = mask_id
-        niiSave(combined_mask_output_fname, mask_t, chosen_aff, data_type='uint16', header=chosen_header)
-        niiSave(combined_mask_output_fname.split('.')[0] + "_metric.nii.gz", d, chosen_aff, header=chosen_header)
+        mask_t = np.zeros(chosen_shape, dtype=utils.cast_labels(label_vals).dtype)
+        mask_t.ravel()[vox_idx] = np.repeat(label_vals, np.diff(coord_offsets))
+        # with ASYNC_WRITES, written in the background: d is not modified below and mask_t is handed over to the writer
+        niiSave(combined_mask_output_fname, mask_t, chosen_aff, data_type=mask_t.dtype, header=chosen_header,
+                ASYNC=ASYNC_WRITES)
+        niiSave(combined_mask_output_fname.split('.')[0] + "_metric.nii.gz", d, chosen_aff, header=chosen_header,
+                ASYNC=ASYNC_WRITES)
         del mask_t
 
     if VERBOSE:
         print("Mask index extraction: "),
 
+    if volume_idxs is not None:  # every volume goes through the same index, with one volume in memory at a time
+        rows = [np.searchsorted(label_vals, np.ravel(mask_id)[0]) for mask_id in mask_ids]
+        vol_stats = dict([(key, np.zeros((len(rows), len(volume_idxs)))) for key in
+                          ['count', 'mean', 'median', 'std', 'min', 'max', 'sum']])
+        volume_cols = {}  # columns of each volume in the output (a volume can be asked for more than once)
+        for col, idx in enumerate(volume_idxs):
+            volume_cols.setdefault(idx, []).append(col)
+        group_all = np.repeat(np.arange(len(label_vals)), np.diff(coord_offsets))
+        for idx, dv in iter_img_volumes(img_fname, sorted(volume_cols)):
+            if USE_LABEL_RES and not np.array_equal(np.diagonal(maff), np.diagonal(daff)):
+                import nibabel as nb
+                dv = resample_nearest(nb.Nifti1Image(dv, daff), maff, chosen_shape)
+            dx_all = np.asarray(dv).ravel()[vox_idx]
+            del dv
+            group = group_all
+            if nonzero_stats:
+                keep = dx_all > 0
+                dx_all = dx_all[keep]
+                group = group[keep]
+                del keep
+            if not max_val is None:
+                dx_all[dx_all > max_val] = max_val
+            if not min_val is None:
+                dx_all[dx_all < min_val] = min_val
+            stats = get_grouped_stats(dx_all, np.concatenate(([0], np.cumsum(
+                np.bincount(group, minlength=len(label_vals))))))
+            for key in vol_stats:
+                vol_stats[key][:, volume_cols[idx]] = np.asarray(stats[key], dtype=np.float64)[rows][:, None]
+        # as for a single volume, labels without data get zeros (and a vox_count of 1, the length of their [0])
+        empty = vol_stats['count'] == 0
+        for key in ['mean', 'median', 'std', 'min', 'max', 'sum']:
+            vol_stats[key][empty] = 0
+        vox_count = vol_stats['count'].astype(int)
+        vox_count[empty] = 1
+        results = return_results(mask_ids, [], [], vol_stats['count'] * vox_vol, vol_stats['mean'],
+                                 vol_stats['median'], vol_stats['std'], vol_stats['min'], vol_stats['max'],
+                                 vol_stats['sum'] * vox_vol, d_settings, vox_count=vox_count)
+        if VERBOSE:
+            print("")
+        if result == 'all':
+            return results
+        return getattr(results, {'min': 'minn', 'max': 'maxx'}.get(result, result), None)
+
+    # a single gather of the metric values of all labels, then every group is reduced at once
+    group = np.repeat(np.arange(len(label_vals)), np.diff(coord_offsets))
+    dx_all = np.asarray(d).ravel()[vox_idx]
+    zero_coord = None
+    if nonzero_stats and VOX_COORD and 0 in label_vals:
+        # as before the index, voxels where the metric is 0 are moved to label 0, so its coordinates are those of
+        # label 0 and of every voxel (of any label, or none) where the metric is 0
+        g = np.searchsorted(label_vals, 0)
+        zero_coord = np.column_stack(np.unravel_index(np.union1d(
+            vox_idx[coord_offsets[g]:coord_offsets[g + 1]], np.flatnonzero(np.asarray(d).ravel() == 0)),
+            chosen_shape))
+    if nonzero_stats:  # voxels where the metric is 0 are not part of the label (coordinates included)
+        keep = dx_all != 0
+        vox_idx = vox_idx[keep]
+        dx_all = dx_all[keep]
+        group = group[keep]
+        coord_offsets = np.concatenate(([0], np.cumsum(np.bincount(group, minlength=len(label_vals)))))
+        del keep
+    if VOX_COORD:
+        vox_coord_all = np.column_stack(np.unravel_index(vox_idx, chosen_shape))
+    if nonzero_stats:
+        keep = dx_all > 0
+        dx_all = dx_all[keep]
+        group = group[keep]
+        vox_idx = vox_idx[keep]
+        del keep
+    if not max_val is None:
+        dx_all[dx_all > max_val] = max_val
+    if not min_val is None:
+        dx_all[dx_all < min_val] = min_val
+    data_offsets = np.concatenate(([0], np.cumsum(np.bincount(group, minlength=len(label_vals)))))
+    del group
+    stats = get_grouped_stats(dx_all, data_offsets)
+
+    empty_dx = np.array([0])  # NO DATA WAS RECOVERED FROM A MASK, reported as zeros?
     for mask_id in mask_ids:
         if VERBOSE:
             print(mask_id),
-        dx = np.ma.masked_array(d, np.ma.make_mask(np.logical_not(mask == mask_id))).compressed()
-        if nonzero_stats:
-            dx = dx[dx > 0]
-            mask[d == 0] = 0 #this is necessary because we need the full 3d information to calculate the voxel coordinates
-        if not max_val is None:
-            dx[dx > max_val] = max_val
-        if not min_val is None:
-            dx[dx < min_val] = min_val
-        if len(dx) == 0:  # NO DATA WAS RECOVERED FROM THIS MASK, report as zeros?
-            dx = np.array([0])
-            d_volume.append(0)  # volume is a special case, need to set explicitly
-        else:
-            d_volume.append(len(dx) * vox_vol)
+        g = np.searchsorted(label_vals, np.ravel(mask_id)[0])
         # keep track of these as we loop, convert to structure later on
         d_label_val.append(mask_id)
-        d_data.append(dx)
-        #print(np.where(dx==mask_id))
-        d_vox_coord.append(np.column_stack(np.where(mask==mask_id))) #x,y,z coordinates of this voxel, not sure if works
-        d_mean.append(np.mean(dx))  # XXX could put a check here to set the values to NaN or None if there is no data
-        d_median.append(np.median(dx))
-        d_std.append(np.std(dx))
-        d_min.append(np.min(dx))
-        d_max.append(np.max(dx))
-        d_sum.append(np.sum(dx) * vox_vol) #sum over all non-zero and then multiply by per-vox volume to get an estimate of size
+        if zero_coord is not None and label_vals[g] == 0:
+            d_vox_coord.append(zero_coord)
+        elif VOX_COORD:
+            d_vox_coord.append(vox_coord_all[coord_offsets[g]:coord_offsets[g + 1]]) #x,y,z coordinates of this voxel
+        else:
+            d_vox_coord.append(np.zeros((0, len(chosen_shape)), dtype=int))
+        d_vox_idx.append(vox_idx[data_offsets[g]:data_offsets[g + 1]])
+        if stats['count'][g] == 0:
+            d_data.append(empty_dx)
+            d_volume.append(0)  # volume is a special case, need to set explicitly
+            d_mean.append(np.mean(empty_dx, dtype=np.float64))
+            d_median.append(np.median(empty_dx))
+            d_std.append(np.std(empty_dx, dtype=np.float64))
+            d_min.append(np.min(empty_dx))
+            d_max.append(np.max(empty_dx))
+            d_sum.append(np.sum(empty_dx, dtype=np.float64) * vox_vol)
+        else:
+            d_data.append(dx_all[data_offsets[g]:data_offsets[g + 1]])
+            d_volume.append(stats['count'][g] * vox_vol)
+            d_mean.append(stats['mean'][g])  # XXX could put a check here to set the values to NaN or None if there is no data
+            d_median.append(stats['median'][g])
+            d_std.append(stats['std'][g])
+            d_min.append(stats['min'][g])
+            d_max.append(stats['max'][g])
+            d_sum.append(stats['sum'][g] * vox_vol) #sum over all non-zero and then multiply by per-vox volume to get an estimate of size
     if VERBOSE:
         print("")
-    results = return_results(d_label_val, d_data, d_vox_coord, d_volume, d_mean, d_median, d_std, d_min, d_max, d_sum, d_settings)
+    results = return_results(d_label_val, d_data, d_vox_coord, d_volume, d_mean, d_median, d_std, d_min, d_max, d_sum,
+                             d_settings, vox_idx=d_vox_idx, shape=chosen_shape, affine=chosen_aff)
 
     if result == 'all':
         return results
@@ -615,15 +1834,60 @@ def extract_stats_from_masked_image(img_fname, mask_fname, thresh_mask_fname=Non
     elif result == 'sum':
         return results.sum
 
+def get_label_volumes(label_fname, label_vals, thresh_mask_fname=None, ROI_mask_fname=None, thresh_val=None,
+                      thresh_type=None, volume_idx=0):
+    """
+    Volume of each label of a label file, from a single read of the file and a single bincount (rather than the full
+    masked statistics of extract_stats_from_masked_image with the label file as its own metric, which gives the same
+    volumes). Threshold and ROI masks are resampled to the grid of the label file, as with USE_LABEL_RES=True
+    Input:
+        - label_fname:          3D (or 4D, see volume_idx) label file
+        - label_vals:           label values to report, only positive labels have a volume
+        - thresh_mask_fname, ROI_mask_fname, thresh_val, thresh_type
+                                - as for extract_stats_from_masked_image
+        - volume_idx:           volume of a 4D label file
+    Returns volume (voxel count * voxel volume from the header), vox_count (arrays in the order of label_vals)
+    """
+    import os
+    import numpy as np
+    labels, aff, res = imgLoad(label_fname, RETURN_RES=True, LAZY=True)
+    labels = get_img_volume(labels, volume_idx)
+    if os.path.splitext(label_fname)[-1] == ".mnc":
+        labels = np.rint(labels)
+    labels = utils.cast_labels(labels)
+    if thresh_mask_fname is not None:
+        thresh_mask, thresh_aff = imgLoad(thresh_mask_fname, CACHE=True)
+        if not np.array_equal(np.diagonal(thresh_aff), np.diagonal(aff)):
+            thresh_mask = resample_to_grid(thresh_mask_fname, aff, labels.shape, interpolation='nearest')
+        if thresh_type == 'upper':
+            labels[thresh_mask > thresh_val] = 0
+        elif thresh_type == 'lower':
+            labels[thresh_mask < thresh_val] = 0
+        else:
+            raise ValueError("set a valid thresh_type: 'upper' or 'lower'")
+    if ROI_mask_fname is not None:
+        ROI_mask, ROI_aff = imgLoad(ROI_mask_fname, CACHE=True)
+        if not np.array_equal(np.diagonal(ROI_aff), np.diagonal(aff)):
+            ROI_mask = resample_to_grid(ROI_mask_fname, aff, labels.shape, interpolation='nearest')
+        labels[ROI_mask < 1] = 0
+    label_vals = np.ravel(label_vals)
+    positive = labels[labels > 0] if labels.min() < 0 else labels.ravel()  # bincount needs non-negative values
+    counts = np.bincount(positive, minlength=int(max(label_vals.max(), 0)) + 1 if len(label_vals) else 1)
+    vox_count = np.where(label_vals > 0, counts[np.clip(label_vals, 0, len(counts) - 1).astype(int)], 0)
+    return vox_count * np.prod(res[0:3]), vox_count
+
+
 def extract_label_volume(label_files,IDs=None, label_df=None,
                          label_subset_idx=None, label_tag="label_",
                          thresh_mask_files=None, ROI_mask_files=None,
                          thresh_val=None, max_val=None,thresh_type=None,
-                         zfill_num=3, VERBOSE=False, volume_idx=0, DEBUG_DIR=None):
+                         zfill_num=3, VERBOSE=False, volume_idx=0, DEBUG_DIR=None, n_jobs=1):
     """
     wrapper for extract_quantitative metric to calculate volume from label files,
     assumes: ALL_FILES_ORDERED= True
              USE_LABEL_RES    = True
+    each label file is read once and counted with a single bincount (see get_label_volumes), n_jobs files at a time
+    (a threshold or ROI mask on another grid is resampled for every subject unless set_resample_cache_size is set)
 
     :param label_files:
     :param IDs:
@@ -638,6 +1902,7 @@ def extract_label_volume(label_files,IDs=None, label_df=None,
     :param zfill_num:
     :param VERBOSE:
     :param volume_idx:
+    :param n_jobs:
     :return:
     """
     df = extract_quantitative_metric(label_files, label_files, 
@@ -653,22 +1918,133 @@ def extract_label_volume(label_files,IDs=None, label_df=None,
                                      erode_vox=None, zfill_num=zfill_num,
                                      DEBUG_DIR=DEBUG_DIR, VERBOSE=VERBOSE,
                                      USE_LABEL_RES=True, ALL_FILES_ORDERED=True,
-                                     volume_idx=volume_idx)
+                                     volume_idx=volume_idx, n_jobs=n_jobs)
     return df
 
+def write_df(df, out_file):
+    """
+    Write a dataframe to .parquet or .feather (both need pyarrow, and load much faster than csv), or .csv, by extension
+    The index is not written, put anything that you need from it in a column first
+    """
+    if out_file.endswith('.parquet'):
+        df.to_parquet(out_file, index=False)
+    elif out_file.endswith('.feather'):
+        df.reset_index(drop=True).to_feather(out_file)
+    elif out_file.endswith('.csv'):
+        df.to_csv(out_file, index=False)
+    else:
+        raise ValueError("Results can be written as .parquet, .feather, or .csv, not " + out_file)
+    return out_file
+
+
+def extract_subject_metrics(ID, metric_file, label_file, RETURN_DATA=False, RAGGED_DATA=False, FLUSH_WRITES=False,
+                            **kwargs):
+    """
+    Extraction for a single subject of extract_quantitative_metric (runs in a worker process when n_jobs>1)
+    Calls extract_stats_from_masked_image(metric_file, label_file, **kwargs) and catches any error, so that one bad
+    subject is recorded rather than stopping (or silently disappearing from) the whole run
+    Input:
+        - ID, metric_file, label_file   - subject ID and its files (metric_file can be a dictionary {metric name: file},
+                                          then the masks are processed once for all metrics)
+        - RETURN_DATA                   - also return the full results object (voxel values and coordinates)
+        - RAGGED_DATA                   - with RETURN_DATA, return only the voxel values and their flat indices, as
+                                          compact arrays (see ragged.get_subject_data), and skip the coordinates
+        - FLUSH_WRITES                  - wait for the debug files to be written before returning (for workers)
+        - kwargs                        - passed to extract_stats_from_masked_image
+    Returns dictionary with 'ID', 'stats' (per-label arrays 'mean','median','std','volume','vox_count','sum', called
+    '<metric name>_mean', ... for a dictionary of metrics), 'res' (results object, or dictionary of them, if
+    RETURN_DATA, otherwise None), and 'error' (None, or the traceback as a string)
+    """
+    import traceback
+    if kwargs.get('VERBOSE'):
+        print(ID)
+        print(" metric    : " + str(metric_file))
+        print(" label     : " + label_file)
+        print(" thresh    : " + str(kwargs.get('thresh_mask_fname')))
+        print(" thresh_val: " + str(kwargs.get('thresh_val')))
+        print(""),
+    else:
+        print(ID),
+    sub_res = {'ID': ID, 'stats': None, 'res': None, 'error': None}
+    if RETURN_DATA and RAGGED_DATA:
+        kwargs['VOX_COORD'] = False
+    try:
+        res = extract_stats_from_masked_image(metric_file, label_file, result='all', **kwargs)
+        sub_res['stats'] = {}
+        for metric_name, metric_res in (res.items() if isinstance(metric_file, dict) else [(None, res)]):
+            prefix = "" if metric_name is None else metric_name + "_"
+            sub_res['stats'].update({prefix + 'mean': metric_res.mean, prefix + 'median': metric_res.median,
+                                     prefix + 'std': metric_res.std, prefix + 'volume': metric_res.volume,
+                                     prefix + 'vox_count': metric_res.vox_count,
+                                     prefix + 'sum': metric_res.sum})
+        if RETURN_DATA and RAGGED_DATA:
+            import ragged
+            if isinstance(metric_file, dict):
+                res = dict([(metric_name, ragged.get_subject_data(metric_res)) for metric_name, metric_res
+                            in res.items()])
+            else:
+                res = ragged.get_subject_data(res)
+        if RETURN_DATA:
+            sub_res['res'] = res
+    except Exception:
+        sub_res['error'] = traceback.format_exc()
+    if FLUSH_WRITES:
+        try:
+            flush_nii_writes()
+        except Exception as e:  # the stats are still good, only a debug file is missing
+            print("OH SHIT, could not write a debug file for {0}: {1}".format(ID, e))
+    return sub_res
+
+
+def extract_subject_label_volume(ID, label_file, thresh_mask_fname=None, ROI_mask_fname=None, label_subset=None,
+                                 thresh_val=None, thresh_type=None, volume_idx=0, VERBOSE=False):
+    """
+    Label volumes of a single subject for extract_quantitative_metric (see get_label_volumes), with the same output as
+    extract_subject_metrics ('stats' are 'volume' and 'vox_count', labels without voxels have a vox_count of 1 as there)
+    """
+    import traceback
+    import numpy as np
+    if VERBOSE:
+        print(ID)
+        print(" label     : " + label_file)
+        print(" thresh    : " + str(thresh_mask_fname))
+        print(" thresh_val: " + str(thresh_val))
+        print(""),
+    else:
+        print(ID),
+    sub_res = {'ID': ID, 'stats': None, 'res': None, 'error': None}
+    try:
+        volume, vox_count = get_label_volumes(label_file, label_subset, thresh_mask_fname=thresh_mask_fname,
+                                              ROI_mask_fname=ROI_mask_fname, thresh_val=thresh_val,
+                                              thresh_type=thresh_type, volume_idx=volume_idx)
+        sub_res['stats'] = {'volume': volume, 'vox_count': np.where(vox_count == 0, 1, vox_count)}
+    except Exception:
+        sub_res['error'] = traceback.format_exc()
+    return sub_res
+
+
 def extract_quantitative_metric(metric_files, label_files, IDs=None, label_df=None, label_subset_idx=None,
                                 label_tag="label_", metric='all', label_idx_colname = None,
                                 thresh_mask_files=None, ROI_mask_files=None, thresh_val=None, max_val=None,
                                 thresh_type=None, erode_vox=None, zfill_num=3,
                                 DEBUG_DIR=None, VERBOSE=False,
                                 USE_LABEL_RES=False, ALL_FILES_ORDERED=False,
-                                n_jobs=1,volume_idx=0):
+                                n_jobs=1,volume_idx=0, catalog=None, out_file=None, out_layout='wide',
+                                checkpoint_file=None, LABEL_INDEX=False, RAGGED_DATA=False, data_file=None,
+                                id_pattern=None):
 
     """
     Extracts voxel-wise data for given set of matched label_files and metric files. Returns pandas dataframe of results
     CAREFUL: IDs are currently defined as the last directory of the input metric_files element
+    Label, threshold, and ROI files are loaded with imgLoad(CACHE=True), so a single file shared across subjects is only
+    read once if you give the image cache a budget first (e.g., set_img_cache_size(2 * 1024**3))
+    Masks that are not on the grid of the metric are resampled through resample_to_grid, so an atlas is only resampled
+    once per grid if you give the resampling cache a budget (and/or a directory) with set_resample_cache_size
     INPUT:
         - metric_files      - list of files for the metric that you are extracting
+                            - or dictionary of {metric name: list of files} (e.g., {'FA': FA_files, 'MD': MD_files}),
+                              each subject's masks are then processed once and reduced against every metric, and the
+                              columns are called <label>_<metric name>_<stat> (metric_file_<metric name> for the files)
         - label_files       - list of label files matched to each file in metric_files (currently restricted to ID at the beginning of file name ==> ID_*)
         - IDs               - list of IDs for matching files - no easy way to get around this :-/
         - label_df          - pandas dataframe of label index (index set with pd.set_index) and description (Label)
@@ -691,10 +2067,41 @@ def extract_quantitative_metric(metric_files, label_files, IDs=None, label_df=No
         - VERBOSE           - verbose reporting or not (default: False)
         - USE_LABEL_RES     - otherwise uses the res of the img_fname (default: False)
         - ALL_FILES_ORDERED - set to True if you know that all of your input lists of files are matched correctly
+        - id_pattern        - regular expression for the subject ID in a file path (see catalog.get_ID), e.g.,
+                              r'sub-([0-9]+)'
+                            - by default a file belongs to an ID if the ID appears in its path as whole tokens (not
+                              preceded or followed by a letter or digit, so '101' does not match '1101_FA.nii.gz')
+                            - missing and duplicated files are reported for all subjects before anything is extracted
+                              (see catalog.match_files), those subjects are not processed
         - volume_idx        - select volume of 4D img_fname that is selected (default=0, skipped if 3D file)
+        - n_jobs            - number of subjects to process in parallel (separate processes, -1 for all cpus)
+        - out_file          - also write the results to this file, .parquet or .feather (needs pyarrow) or .csv
+        - out_layout        - layout of out_file {'wide','long'}
+                            - wide: the returned dataframe, one row per subject and one column per label and stat
+                            - long: one row per subject and label, with 'label_idx', 'label' (categorical, i.e.,
+                              dictionary encoded in parquet/feather), and one column per stat
+        - catalog           - catalog file from catalog.build_catalog. metric_files, label_files, thresh_mask_files and
+                              ROI_mask_files are then modality names in the catalog (or single files shared by all
+                              subjects), IDs is optional (default: all IDs with every modality), ALL_FILES_ORDERED=True
+        - checkpoint_file   - append-only record (.jsonl) of the subjects that have been extracted, see checkpoint.py
+                            - each subject is recorded as soon as it is done (every 4*n_jobs subjects when n_jobs>1),
+                              keyed by its ID, the hashes of its files, and the extraction settings
+                            - a rerun with the same file only extracts new subjects, subjects whose files or settings
+                              changed, and subjects that failed. Not used for metric='data'
+        - LABEL_INDEX       - keep the voxel index of every label in a sidecar next to each label file, so that
+                              extracting other metrics with the same label files (and masks) does not redo the masking
+                              (see extract_stats_from_masked_image)
+        - RAGGED_DATA       - with metric='data', return the voxel values of all subjects as a single RaggedData (see
+                              ragged.py: one flat array of values, their flat voxel indices, and offsets per subject and
+                              label, coordinates computed on request) instead of a list of results objects
+                            - subjects that failed are kept, without values, and labels without data are empty
+                            - a dictionary of RaggedData (one per metric) if metric_files is a dictionary
+        - data_file         - save the RaggedData to this .npz (implies RAGGED_DATA), <data_file>_<metric name>.npz for
+                              a dictionary of metrics. Read it back with ragged.load_ragged, which memory-maps it
 
     OUTPUT:
-        - df_4d             - pandas dataframe of results
+        - df_4d             - pandas dataframe of results, rows in the order of the subjects. Subjects that failed are
+                              kept with empty values and the traceback in the 'error' column (None otherwise)
     """
 
     import os
@@ -704,21 +2111,52 @@ def extract_quantitative_metric(metric_files, label_files, IDs=None, label_df=No
 
     USE_SINGLE_LABEL_FILE=False
 
-    if n_jobs<1:
+    if n_jobs is None or n_jobs==0:
         n_jobs=1
 
+    metric_names = None  # names of the metrics if metric_files is a dictionary of them
+    if isinstance(metric_files, dict):
+        metric_names = list(metric_files.keys())
+
+    if catalog is not None:  # look the files up by ID instead of matching them
+        import catalog as cat
+        if metric_names is None:
+            IDs, (metric_files, label_files, thresh_mask_files, ROI_mask_files) = cat.get_catalog_files(
+                catalog, [metric_files, label_files, thresh_mask_files, ROI_mask_files], IDs=IDs)
+        else:
+            IDs, all_files = cat.get_catalog_files(
+                catalog, [metric_files[name] for name in metric_names] + [label_files, thresh_mask_files,
+                                                                          ROI_mask_files], IDs=IDs)
+            metric_files = dict(zip(metric_names, all_files[:len(metric_names)]))
+            label_files, thresh_mask_files, ROI_mask_files = all_files[len(metric_names):]
+        ALL_FILES_ORDERED = True
+
     if metric is 'data': #only used if we have requested "data", in which case we get the volumes in the df and the raw data in a list of results objects from extract_stats_from_masked_image
         all_res_data = []
+    RAGGED_DATA = metric == 'data' and (RAGGED_DATA or data_file is not None)
+    if data_file is not None and not data_file.endswith('.npz'):
+        print("data_file must be an .npz file: " + data_file)
+        return
         
     if ALL_FILES_ORDERED:
         print("You have set ALL_FILES_ORDERED=True, I will not check your input lists for ordering.")
 
     cols = ['ID', 'metric_file', 'label_file', 'thresh_file', 'thresh_val', 'thresh_type',
             'ROI_mask']  # used to link it to the other measures and to confirm that the masks were used in the correct order so that the values are correct
+    if metric_names is not None:
+        cols = cols[0:1] + ['metric_file_' + name for name in metric_names] + cols[2:]
+    n_info = len(cols)  # columns before the label columns
 
     # if we only pass a single subject, make it a list so that we can loop over it without crashing
-    if isinstance(metric_files, basestring):
-        metric_files = [metric_files]
+    if metric_names is not None:
+        metric_files = dict([(name, [files] if isinstance(files, basestring) else files)
+                             for name, files in metric_files.items()])
+        metric_file_lists = metric_files
+    else:
+        if isinstance(metric_files, basestring):
+            metric_files = [metric_files]
+        metric_file_lists = {None: metric_files}
+    first_metric_files = metric_file_lists[(metric_names or [None])[0]]  # IDs are taken from these if not given
     if isinstance(label_files, basestring):
         label_files = [label_files]
     if isinstance(thresh_mask_files, basestring):
@@ -732,7 +2170,7 @@ def extract_quantitative_metric(metric_files, label_files, IDs=None, label_df=No
         print("Label numbers were extracted from the first label file")
         print("label_id = 0 was removed")
 
-        label_subset_idx = np.unique(imgLoad(label_files[0])[0]).astype(int)
+        label_subset_idx = np.unique(imgLoad(label_files[0], CACHE=True)[0]).astype(int)
         if os.path.splitext(label_files[0])[-1] == ".mnc":
             print("Looks like you are using mnc files.")
             print(
@@ -743,6 +2181,12 @@ def extract_quantitative_metric(metric_files, label_files, IDs=None, label_df=No
         label_subset_idx = label_subset_idx[label_subset_idx != 0]
     elif isinstance(label_subset_idx,int):
         label_subset_idx = [label_subset_idx] #change to a list if it was only a single integer
+    if metric not in ['all', 'data', 'mean', 'median', 'std', 'volume', 'vox_count', 'sum']:
+        print("Incorrect metric selected.")
+        return
+    if isinstance(volume_idx, basestring) or np.ndim(volume_idx) > 0:
+        print("Select a single volume with volume_idx, use extract_stats_from_masked_image to extract from several.")
+        return
     if metric is not 'all':
         if metric is not 'data':
             metric_txt = metric
@@ -754,7 +2198,6 @@ def extract_quantitative_metric(metric_files, label_files, IDs=None, label_df=No
             for idx, label_id in enumerate(label_subset_idx):
                 col_name = label_tag + str(label_id).zfill(zfill_num) + "_" + metric_txt
                 cols.append(col_name)
-            df_4d = pd.DataFrame(columns=cols)
         else:
             if label_idx_colname is not(None): #if they did not explicitly
                 label_df.set_index(label_idx_colname)
@@ -766,7 +2209,6 @@ def extract_quantitative_metric(metric_files, label_files, IDs=None, label_df=No
             for idx, label_id in enumerate(label_subset_idx):
                 col_name = label_tag + str(label_id).zfill(zfill_num) + "_" + label_df.loc[label_id].Label + "_" + metric_txt
                 cols.append(col_name)
-            df_4d = pd.DataFrame(columns=cols)
     else: #we want all the metrics, so we need to create the columns for all of them
         if label_df is None:  # WHAT? you didn't provide a label to idx matching dataframe??
             print("label_df dataframe (label index to name mapping) was not defined")
@@ -789,7 +2231,6 @@ def extract_quantitative_metric(metric_files, label_files, IDs=None, label_df=No
             for idx, label_id in enumerate(label_subset_idx):
                 col_name = label_tag + str(label_id).zfill(zfill_num) + "_" + "vox_count"
                 cols.append(col_name)
-            df_4d = pd.DataFrame(columns=cols)
         else:
             for idx, label_id in enumerate(label_subset_idx):
                 col_name = label_tag + str(label_id).zfill(zfill_num) + "_" + label_df.loc[label_id].Label + "_" + "mean"
@@ -809,183 +2250,250 @@ def extract_quantitative_metric(metric_files, label_files, IDs=None, label_df=No
             for idx, label_id in enumerate(label_subset_idx):
                 col_name = label_tag + str(label_id).zfill(zfill_num) + "_" + label_df.loc[label_id].Label + "_" + "vox_count"
                 cols.append(col_name)
-            df_4d = pd.DataFrame(columns=cols)
 
     if DEBUG_DIR is not None:
         create_dir(DEBUG_DIR)  # this is where the combined_mask_output is 
         #going to go so that we can check to see what we actually did to our masks
 
     if IDs is None and not(ALL_FILES_ORDERED): #if this was set to True, then we just grab the correct index
-        IDs = [os.path.basename(os.path.dirname(metric_file)) for metric_file in metric_files]  # if ID was not set,
+        IDs = [os.path.basename(os.path.dirname(metric_file)) for metric_file in first_metric_files]  # if ID was not set,
         # we assume that we can generate it here as the last directory of the path to the metric_file
         print(
             "No IDs were specified, attempting to reconstruct them as the last subdirectory of the input metric files")
-        print(" e.g., " + os.path.basename(os.path.dirname(metric_files[0])))
+        print(" e.g., " + os.path.basename(os.path.dirname(first_metric_files[0])))
     elif IDs is None and ALL_FILES_ORDERED: # the user knows what they are doing, we will not use IDs to lookup the correct corresponding files
-        IDs = [os.path.basename(metric_file) for metric_file in metric_files]
-
+        IDs = [os.path.basename(metric_file) for metric_file in first_metric_files]
+
+    if isinstance(ROI_mask_files, basestring):
+        ROI_mask_files = [ROI_mask_files]
+    # a single threshold or ROI mask is used for everyone
+    shared_thresh_mask = thresh_mask_files[0] if thresh_mask_files is not None and len(thresh_mask_files) == 1 else None
+    shared_ROI_mask = ROI_mask_files[0] if ROI_mask_files is not None and len(ROI_mask_files) == 1 else None
+    metric_order = list(metric_file_lists.keys())
+    if not(ALL_FILES_ORDERED):  # grab the correct files to go with each ID, one pass over each list of files
+        import catalog as cat
+        match_lists = [metric_file_lists[metric_name] for metric_name in metric_order] + [
+            label_files, shared_thresh_mask or thresh_mask_files, shared_ROI_mask or ROI_mask_files]
+        match_names = ["metric" if metric_name is None else metric_name + " metric" for metric_name in metric_order]
+        matched = cat.match_files(IDs, match_lists, id_pattern=id_pattern,
+                                  names=match_names + ["label", "threshold mask", "ROI mask"])
+
+    jobs = []  # (idx, ID, files) of each subject that has all of its files
     for idx, ID in enumerate(IDs):
-        DATA_EXISTS = True
-        # grab the correct label and metric files to go with the ID
-
-        if VERBOSE:
-            print(ID)
-        else:
-            print(ID),
         if not(ALL_FILES_ORDERED):
-            metric_file = [s for s in metric_files if ID in s]  # make sure our label file is in the list that was passed
-            label_file = [s for s in label_files if ID in s]  # make sure our label file is in the list that was passed
-            if len(metric_file) > 1:
-                print("")
-                print("OH SHIT, too many metric files. This should not happen!")
-            elif len(metric_file) == 0:
-                print("")
-                print("OH SHIT, no matching metric file for: " + ID)
-                print("This subject has not been processed")
-                DATA_EXISTS = False
-
-            if len(label_file) > 1:
-                print("")
-                print("OH SHIT, too many label files. This should not happen!")
-            elif len(label_file) == 0:
-                print("")
-                print("OH SHIT, no matching label file for: " + ID)
-                print("This subject has not been processed")
-                DATA_EXISTS = False
+            sub_files = [files if files is None or isinstance(files, basestring) else files[idx] for files in matched]
+            if any([files is not None and sub_file is None for files, sub_file in zip(matched, sub_files)]):
+                continue  # missing or duplicated files were reported by match_files, this subject is not processed
+            metric_file = dict(zip(metric_order, sub_files[:len(metric_order)]))
+            label_file, thresh_mask_fname, ROI_mask_fname = sub_files[len(metric_order):]
         else: #files should already be ordered
-            metric_file = metric_files[idx]
+            metric_file = dict([(metric_name, files[idx]) for metric_name, files in metric_file_lists.items()])
             if not(USE_SINGLE_LABEL_FILE):
                 label_file = label_files[idx]
             else:
                 label_file = label_files[0]
-        if thresh_mask_files is not None:
-            if len(thresh_mask_files) == 1:  # if we only provide one mask, we use this for everyone
-                thresh_mask_fname = thresh_mask_files[0]
-            elif len(thresh_mask_files) > 1 and not(ALL_FILES_ORDERED):
-                thresh_mask_fname = [s for s in thresh_mask_files if ID in s]  # make sure our label file
-                                                                                # is in the list that was passed
-                if len(thresh_mask_fname) > 1:
-                    print("")
-                    print("OH SHIT, too many threshold mask files. This should not happen!")
-
-                elif len(thresh_mask_fname) == 0:
-                    print("")
-                    print("OH SHIT, no matching threshold mask file for: " + ID)
-                    DATA_EXISTS = False
-            else:
-                thresh_mask_fname = thresh_mask_files[idx]
-        else:
             thresh_mask_fname = None
+            if thresh_mask_files is not None:
+                thresh_mask_fname = shared_thresh_mask or thresh_mask_files[idx]
+            ROI_mask_fname = None
+            if ROI_mask_files is not None:
+                ROI_mask_fname = shared_ROI_mask or ROI_mask_files[idx]
 
-        if ROI_mask_files is not None:
-            if len(ROI_mask_files) == 1:  # if we only provide one mask, we use this for everyone
-                ROI_mask_fname = ROI_mask_files
-            elif len(ROI_mask_files) > 1 and not(ALL_FILES_ORDERED):
-                ROI_mask_fname = [s for s in ROI_mask_files if
-                                  ID in s]  # make sure our label file is in the list that was passed
-                if len(ROI_mask_fname) > 1:
-                    print("OH SHIT, too many threshold mask files. This should not happen!")
-
-                elif len(ROI_mask_fname) == 0:
-                    print("OH SHIT, no matching ROI mask file for: " + ID)
-                    DATA_EXISTS = False
+        if DEBUG_DIR is not None:
+            combined_mask_output_fname = os.path.join(DEBUG_DIR, ID + "_corrected_labels.nii.gz")
+        else:
+            combined_mask_output_fname = None
+        if metric_names is None:
+            metric_file = metric_file[None]
+        jobs.append((idx, ID, metric_file, label_file, thresh_mask_fname, ROI_mask_fname,
+                     combined_mask_output_fname))
+
+    # subjects are independent, so they are run in separate processes when n_jobs>1. Workers send back only the
+    # per-label summaries (unless metric='data'), pre_dispatch limits how many subjects are queued at once, and the
+    # results come back in the order of the subjects whatever order they finish in
+    stats_kwargs = {'thresh_val': thresh_val, 'thresh_type': thresh_type, 'label_subset': label_subset_idx,
+                    'erode_vox': erode_vox, 'max_val': max_val, 'VERBOSE': VERBOSE, 'USE_LABEL_RES': USE_LABEL_RES,
+                    'volume_idx': volume_idx, 'LABEL_INDEX': LABEL_INDEX}
+    # volumes of the label files themselves only need the label files: one read and one bincount per subject
+    LABEL_VOLUME = (metric in ['volume', 'vox_count'] and metric_names is None and erode_vox is None and
+                    DEBUG_DIR is None and all([job[2] == job[3] for job in jobs]))
+    if metric == 'all':
+        stat_names = ['mean', 'median', 'sum', 'std', 'volume', 'vox_count']  # same order as the columns
+    else:
+        stat_names = [metric_txt]
+    if metric_names is None:
+        stat_keys = stat_names  # keys of the stats in the results of extract_subject_metrics
+    else:  # the same columns for every metric, with the metric name in front of the stat
+        stat_keys = [metric_name + "_" + stat_name for metric_name in metric_names for stat_name in stat_names]
+
+    # with a checkpoint file, subjects whose files and settings are unchanged since they were recorded are read back
+    # instead of extracted, and each completed subject is appended to the file as soon as its batch is done
+    done_res = {}  # job index: result read from the checkpoint
+    todo = list(range(len(jobs)))
+    if checkpoint_file is not None and metric == 'data':
+        print("The voxel data of metric='data' is not checkpointed, checkpoint_file is ignored")
+        checkpoint_file = None
+    if checkpoint_file is not None:
+        import checkpoint as ckpt
+        records = ckpt.read_checkpoint(checkpoint_file)
+        known_files = ckpt.get_known_files(records)
+        hashes = {}  # files shared by subjects (e.g., a single label file) are only hashed once
+        settings = ckpt.get_settings(dict([(key, val) for key, val in stats_kwargs.items()
+                                           if key not in ['VERBOSE', 'LABEL_INDEX']]))  # do not change the results
+        if LABEL_VOLUME:  # only volume and vox_count are recorded, keep these records apart from the full ones
+            settings['engine'] = 'label_volume'
+        job_keys = []
+        job_files = []
+        todo = []
+        for job_idx, (idx, ID, metric_file, label_file, thresh_mask_fname, ROI_mask_fname,
+                      combined_mask_output_fname) in enumerate(jobs):
+            files = {'label': ckpt.get_file_info(label_file, known_files, hashes),
+                     'thresh_mask': ckpt.get_file_info(thresh_mask_fname, known_files, hashes),
+                     'ROI_mask': ckpt.get_file_info(ROI_mask_fname, known_files, hashes)}
+            if metric_names is None:
+                files['metric'] = ckpt.get_file_info(metric_file, known_files, hashes)
+            else:
+                for metric_name in metric_names:
+                    files['metric_' + metric_name] = ckpt.get_file_info(metric_file[metric_name], known_files, hashes)
+            key = ckpt.get_record_key(ID, files, settings)
+            job_keys.append(key)
+            job_files.append(files)
+            if key in records and all([stat_key in records[key]['stats'] for stat_key in stat_keys]):
+                done_res[job_idx] = {'ID': ID, 'stats': dict([(name, np.array(val, dtype=float)) for name, val
+                                                               in records[key]['stats'].items()]),
+                                     'res': None, 'error': None}
             else:
-                ROI_mask_fname = ROI_mask_files[idx]
+                todo.append(job_idx)
+        print("Checkpoint {0}: {1} of {2} subjects already extracted, {3} to go".format(
+            checkpoint_file, len(done_res), len(jobs), len(todo)))
+
+    def run_jobs(parallel, job_idxs):
+        if LABEL_VOLUME:
+            volume_kwargs = dict([(key, stats_kwargs[key]) for key in ['label_subset', 'thresh_val', 'thresh_type',
+                                                                      'volume_idx', 'VERBOSE']])
+            jobs_args = [(jobs[job_idx][1], jobs[job_idx][3], jobs[job_idx][4], jobs[job_idx][5])
+                         for job_idx in job_idxs]
+            if parallel is None:
+                return [extract_subject_label_volume(*job_args, **volume_kwargs) for job_args in jobs_args]
+            return parallel(delayed(extract_subject_label_volume)(*job_args, **volume_kwargs)
+                            for job_args in jobs_args)
+        if parallel is None:
+            return [extract_subject_metrics(jobs[job_idx][1], jobs[job_idx][2], jobs[job_idx][3],
+                                            thresh_mask_fname=jobs[job_idx][4], ROI_mask_fname=jobs[job_idx][5],
+                                            combined_mask_output_fname=jobs[job_idx][6],
+                                            RETURN_DATA=metric == 'data', RAGGED_DATA=RAGGED_DATA, ASYNC_WRITES=True,
+                                            **stats_kwargs)
+                    for job_idx in job_idxs]
+        return parallel(delayed(extract_subject_metrics)(jobs[job_idx][1], jobs[job_idx][2], jobs[job_idx][3],
+                                                         thresh_mask_fname=jobs[job_idx][4],
+                                                         ROI_mask_fname=jobs[job_idx][5],
+                                                         combined_mask_output_fname=jobs[job_idx][6],
+                                                         RETURN_DATA=metric == 'data', RAGGED_DATA=RAGGED_DATA,
+                                                         ASYNC_WRITES=True, FLUSH_WRITES=True, **stats_kwargs)
+                        for job_idx in job_idxs)
+
+    def checkpoint_batch(job_idxs, batch_res):
+        if checkpoint_file is not None:  # failed subjects are not recorded, so they are tried again next time
+            ckpt.append_records(checkpoint_file,
+                                [ckpt.make_record(job_keys[job_idx], jobs[job_idx][1], job_files[job_idx], settings,
+                                                  sub_res['stats'])
+                                 for job_idx, sub_res in zip(job_idxs, batch_res) if sub_res['error'] is None])
+
+    if checkpoint_file is None:
+        batch_size = max(len(todo), 1)  # everything at once, no need to stop between batches
+    elif n_jobs == 1:
+        batch_size = 1  # every subject is written as soon as it is done
+    else:
+        from joblib import cpu_count
+        batch_size = 4 * (cpu_count() if n_jobs < 0 else n_jobs)
+    if n_jobs == 1:
+        for start in range(0, len(todo), batch_size):
+            batch_res = run_jobs(None, todo[start:start + batch_size])
+            checkpoint_batch(todo[start:start + batch_size], batch_res)
+            done_res.update(zip(todo[start:start + batch_size], batch_res))
+    elif len(todo) > 0:
+        print("Extracting {0} subjects with {1} processes".format(len(todo), n_jobs))
+        with Parallel(n_jobs=n_jobs, pre_dispatch='2*n_jobs') as parallel:  # the workers are kept between batches
+            for start in range(0, len(todo), batch_size):
+                batch_res = run_jobs(parallel, todo[start:start + batch_size])
+                checkpoint_batch(todo[start:start + batch_size], batch_res)
+                done_res.update(zip(todo[start:start + batch_size], batch_res))
+    all_res = [done_res[job_idx] for job_idx in range(len(jobs))]
+
+    # collect everything in preallocated arrays (subjects x stats x labels) and build the dataframe once
+    label_names = [col[:-len("_" + stat_names[0])] for col in cols[n_info:n_info + len(label_subset_idx)]]
+    if metric_names is not None:
+        cols = cols[0:n_info] + [label_name + "_" + stat_key for stat_key in stat_keys for label_name in label_names]
+    values = np.full((len(jobs), len(stat_keys), len(label_subset_idx)), np.nan)
+    info = {col: [] for col in cols[0:n_info] + ['error']}
+    for row, (job, sub_res) in enumerate(zip(jobs, all_res)):
+        idx, ID, metric_file, label_file, thresh_mask_fname, ROI_mask_fname, combined_mask_output_fname = job
+        #remove any None values, so that pandas treats it properly when writing to csv
+        if thresh_mask_fname is None:
+            thresh_mask_fname = "None"
+        if ROI_mask_fname is None:
+            ROI_mask_fname = "None"
+        info['ID'].append(str(ID))  # XXX there should be a more comprehensive solution to this
+        if metric_names is None:
+            info['metric_file'].append(metric_file)
         else:
-            ROI_mask_fname = None
-
-        #
-        ## STOP THESE CHECKS COULD BE REMOVED
-
-        if DATA_EXISTS:
-            try:
-                if DEBUG_DIR is not None:
-                    combined_mask_output_fname = os.path.join(DEBUG_DIR, ID + "_corrected_labels.nii.gz")
-                else:
-                    combined_mask_output_fname = None
-                if not(ALL_FILES_ORDERED):
-                    metric_file = metric_file[0]  # break them out of the list they were stored as
-                    label_file = label_file[0]
-                
-                    if thresh_mask_fname is not None:
-                        thresh_mask_fname = thresh_mask_fname[0]
-                    if ROI_mask_fname is not None:
-                        ROI_mask_fname = ROI_mask_fname[0]
-
-                if VERBOSE:
-                    print(" metric    : " + metric_file)
-                    print(" label     : " + label_file)
-                    print(" thresh    : " + str(thresh_mask_fname))
-                    print(" thresh_val: " + str(thresh_val))
-                    print(""),
-                res = extract_stats_from_masked_image(metric_file, label_file, thresh_mask_fname=thresh_mask_fname,
-                                                      combined_mask_output_fname=combined_mask_output_fname,
-                                                      ROI_mask_fname=ROI_mask_fname, thresh_val=thresh_val,
-                                                      thresh_type=thresh_type,
-                                                      label_subset=label_subset_idx, erode_vox=erode_vox, result='all',
-                                                      max_val=max_val, VERBOSE=VERBOSE, USE_LABEL_RES=USE_LABEL_RES,
-                                                      volume_idx=volume_idx)
-
-                #remove any None values, so that pandas treats it properly when writing to csv
-                if thresh_mask_fname is None:
-                    thresh_mask_fname = "None"
-                if ROI_mask_fname is None:
-                    ROI_mask_fname = "None"
-
-                # now put the data into the rows:
-                df_4d.loc[idx, 'ID'] = str(ID)  # XXX there should be a more comprehensive solution to this
-                df_4d.loc[idx, 'metric_file'] = metric_file
-                df_4d.loc[idx, 'label_file'] = label_file
-                df_4d.loc[idx, 'thresh_file'] = thresh_mask_fname
-                df_4d.loc[idx, 'thresh_val'] = thresh_val  # this is overkill, since it should always be the same
-                df_4d.loc[idx, 'thresh_type'] = thresh_type  # this is overkill, since it should always be the same
-                df_4d.loc[idx, 'ROI_mask'] = ROI_mask_fname
-                if (metric is 'all'):
-                    df_4d.loc[:,df_4d.columns[df_4d.columns.str.endswith(pat = '_mean')]] = res.mean
-                    df_4d.loc[:,df_4d.columns[df_4d.columns.str.endswith(pat = '_median')]] = res.median
-                    df_4d.loc[:,df_4d.columns[df_4d.columns.str.endswith(pat = '_std')]] = res.std
-                    df_4d.loc[:,df_4d.columns[df_4d.columns.str.endswith(pat = '_volume')]] = res.volume
-                    df_4d.loc[:,df_4d.columns[df_4d.columns.str.endswith(pat = '_vox_count')]] = [len(a_idx) for a_idx in res.data]
-                    df_4d.loc[:,df_4d.columns[df_4d.columns.str.endswith(pat = '_sum')]] = res.sum
-                    
-                    ## old way of doing this, but the indexing of pandas changed so this is no longer valid
-                    # df_4d.loc[idx, 7:7+1*len(label_subset_idx)] = res.mean
-                    # df_4d.loc[idx, 7+1*len(label_subset_idx):7+2*len(label_subset_idx)] = res.median
-                    # df_4d.loc[idx, 7+2*len(label_subset_idx):7+3*len(label_subset_idx)] = res.std
-                    # df_4d.loc[idx, 7+3*len(label_subset_idx):7+4*len(label_subset_idx)] = res.volume
-                    # df_4d.loc[idx, 7+4*len(label_subset_idx):7+5*len(label_subset_idx)] = [len(a_idx) for a_idx in res.data]  # gives num vox
-                    # df_4d.loc[idx, 7+5*len(label_subset_idx):7+6*len(label_subset_idx)] = res.sum  # gives num vox
-                #                elif metric is 'data':
-#                    data_string_list=[None]*len(res.data)
-#                    for string_list_idx,res_data_single_sub in enumerate(res.data):
-#                        data_string=""
-#                        for val in res_data_single_sub:
-#                            data_string=data_string+" "+"{0:.4f}".format(val)
-#                        data_string_list[string_list_idx]=data_string
-#                    df_4d.loc[idx,7::] = data_string_list
-                elif metric is 'data': #only provide the volume in the dataframe, full data is passed in the structure all_res_data
-                    df_4d.loc[idx, 7::] = res.volume
-                    all_res_data.append(res)
-                elif metric is 'mean':
-                    df_4d.loc[idx, 7::] = res.mean
-                elif metric is 'median':
-                    df_4d.loc[idx, 7::] = res.median
-                elif metric is 'std':
-                    df_4d.loc[idx, 7::] = res.std
-                elif metric is 'volume':
-                    df_4d.loc[idx, 7::] = res.volume
-                elif metric is 'vox_count':
-                    df_4d.loc[idx, 7::] = [len(a_idx) for a_idx in res.data]  # gives num vox
-                elif metric is 'sum':
-                    df_4d.loc[idx, 7::] = res.sum
-                else:
-                    print("Incorrect metric selected.")
-                    return
-            except:
-                print("")
-                print("##=====================================================================##")
-                print("Darn! There is something wrong with: " + ID)
-                print("##=====================================================================##")
+            for metric_name in metric_names:
+                info['metric_file_' + metric_name].append(metric_file[metric_name])
+        info['label_file'].append(label_file)
+        info['thresh_file'].append(thresh_mask_fname)
+        info['thresh_val'].append(thresh_val)  # this is overkill, since it should always be the same
+        info['thresh_type'].append(thresh_type)  # this is overkill, since it should always be the same
+        info['ROI_mask'].append(ROI_mask_fname)
+        info['error'].append(sub_res['error'])
+        if sub_res['error'] is not None:  # the row is kept, with the traceback in place of the values
+            print("")
+            print("##=====================================================================##")
+            print("Darn! There is something wrong with: " + str(ID))
+            print(sub_res['error'])
+            print("##=====================================================================##")
+            continue
+        for stat_idx, stat_key in enumerate(stat_keys):
+            values[row, stat_idx] = sub_res['stats'][stat_key]
+        if metric == 'data' and not RAGGED_DATA: #only provide the volume in the dataframe, full data is passed in the structure all_res_data
+            all_res_data.append(sub_res['res'])
+    if RAGGED_DATA:  # one row per subject (including the ones that failed), in one flat array of values
+        import ragged
+        data_IDs = [str(job[1]) for job in jobs]
+        if metric_names is None:
+            all_res_data = ragged.RaggedData.from_results([sub_res['res'] for sub_res in all_res], data_IDs,
+                                                          label_subset_idx)
+            if data_file is not None:
+                all_res_data.save(data_file)
+        else:
+            all_res_data = {}
+            for metric_name in metric_names:
+                all_res_data[metric_name] = ragged.RaggedData.from_results(
+                    [None if sub_res['res'] is None else sub_res['res'][metric_name] for sub_res in all_res],
+                    data_IDs, label_subset_idx)
+                if data_file is not None:
+                    all_res_data[metric_name].save(data_file[:-len(ragged.RAGGED_EXT)] + "_" + metric_name +
+                                                   ragged.RAGGED_EXT)
+
+    index = [job[0] for job in jobs]
+    info_df = pd.DataFrame(info, columns=cols[0:n_info] + ['error'], index=index)
+    df_4d = pd.concat([info_df[cols[0:n_info]],
+                       pd.DataFrame(values.reshape(len(jobs), -1), columns=cols[n_info:], index=index),
+                       info_df[['error']]], axis=1)
+    if out_file is not None:
+        if out_layout == 'long':
+            # one row per subject and label, label names stored once (categorical / dictionary encoded)
+            out_df = info_df.loc[np.repeat(index, len(label_subset_idx))].reset_index(drop=True)
+            out_df.insert(n_info, 'label_idx', np.tile(label_subset_idx, len(jobs)))
+            out_df.insert(n_info + 1, 'label', pd.Categorical(np.tile(label_names, len(jobs))))
+            for stat_idx, stat_key in enumerate(stat_keys):
+                out_df.insert(n_info + 2 + stat_idx, stat_key, values[:, stat_idx, :].ravel())
+        else:
+            out_df = df_4d
+        write_df(out_df, out_file)
+    try:  # debug files were written in the background while the next subject was processed
+        flush_nii_writes()
+    except Exception as e:  # the results are all there, only a debug file is missing
+        print("OH SHIT, could not write a debug file to {0}: {1}".format(DEBUG_DIR, e))
     print("")
     if metric is not 'data':
         return df_4d
@@ -1278,35 +2786,100 @@ def print_file_array(in_file_array):
         print(os.path.basename(line))
 
 
-def tract_seg3(files, out_basename='', segmentation_index=None, CLOBBER=False, BY_SLICE=False):
+def tract_seg_sparse(files, segmentation_index=None):
+    """
+    Winner takes all segmentation of sparse tract density volumes, with the same rules as tract_seg3: in each voxel the
+    volume with the largest (positive) value wins, ties go to the earlier volume
+    Memory use is proportional to the number of nonzero voxels in the inputs, rather than to the number of inputs
+    Input:
+        - files:                list of SparseVolumes, saved SparseVolumes (.npz), or image files (converted one at a time)
+        - segmentation_index:   custom index for each input (as in tract_seg3)
+    Returns hard_seg, seg_total, seg_part, seg_pct (SparseVolumes over every voxel that is in any input), or None if
+    segmentation_index does not have one value per input
+    """
+    import numpy as np
+    import sparse_volume as spv
+
+    float_dtype = get_float_dtype()
+    all_idx = []
+    all_val = []
+    all_lab = []
+    for file_idx, fn in enumerate(files):
+        vol = spv.load_sparse(fn)
+        if file_idx == 0:
+            shape = vol.shape
+            aff = vol.affine
+        elif vol.shape != shape:
+            raise ValueError("All volumes must have the same shape for segmentation ({0} is {1}, not {2})".format(
+                fn, vol.shape, shape))
+        all_idx.append(vol.indices.astype(np.int64))
+        all_val.append(vol.values.astype(float_dtype))
+        all_lab.append(np.repeat(file_idx + 1, vol.nnz))  # 1-based, as in tract_seg3
+        del vol
+    all_idx = np.concatenate(all_idx)
+    all_val = np.concatenate(all_val)
+    all_lab = np.concatenate(all_lab).astype(utils.get_label_dtype(len(files)))
+
+    vox_idx, vox_inv = np.unique(all_idx, return_inverse=True)
+    del all_idx
+    seg_total = np.bincount(vox_inv, weights=all_val, minlength=len(vox_idx))  # accumulated in float64
+
+    # sort by voxel, then largest value, then input order, the first entry of each voxel is its winner
+    order = np.lexsort((all_lab, -all_val, vox_inv))
+    first = order[np.concatenate(([0], np.flatnonzero(np.diff(vox_inv[order])) + 1))]
+    hard_seg = all_lab[first]
+    seg_part = all_val[first]
+    no_winner = seg_part <= 0  # the volume of zeros that pads the dense version wins (or ties) in these voxels
+    hard_seg[no_winner] = 0
+    seg_part[no_winner] = 0
+
+    if segmentation_index is not None:
+        if len(files) != len(segmentation_index):
+            print("")
+            print("====== YOU DID NOT ENTER THE CORRECT NUMBER OF VALUES FOR segmentation_index ======")
+            return None
+        key = np.concatenate(([0], segmentation_index))
+        hard_seg = key[hard_seg]
+
+    seg_pct = np.where(seg_total > 0, seg_part.astype(np.float32) / seg_total.astype(np.float32), 0)
+    return (spv.SparseVolume(vox_idx, hard_seg, shape, aff), spv.SparseVolume(vox_idx, seg_total, shape, aff),
+            spv.SparseVolume(vox_idx, seg_part, shape, aff), spv.SparseVolume(vox_idx, seg_pct, shape, aff))
+
+
+def tract_seg3(files, out_basename='', segmentation_index=None, CLOBBER=False, BY_SLICE=False, SPARSE=False):
     """
     2015_09
     Christopher J Steele
     Winner takes all segmentation of tract density images (.nii/.nii.gz)
 
     Input:
-        - files:                list of tract density files for segmentation (with full pathname)
+        - files:                list of tract density files for segmentation (with full pathname), SparseVolumes and
+                                saved SparseVolumes (.npz, see sparse_volume.py) are also accepted
         - out_basename:         basename for output
         - segmentation_index:   option to map default 1-based indexing (where the first input file is label 1)
                                 to custom index. Input must be a numpy array of len(files), and map to their order in files
         - CLOBBER:              over-write or not {True,False}
-        - BY_SLICE:             perform segmentation slice by slice (in 3rd dimension) to reduce memory requirements
-                                (note that this unzips each .nii.gz file once to reduce overhead, and zips when finished)
+        - BY_SLICE:             perform segmentation slab by slab (in 3rd dimension) to reduce memory requirements
+                                (each input is converted once into a chunk cache, see chunk_cache.py, the input files
+                                are not modified)
+        - SPARSE:               combine the inputs as lists of nonzero voxels (see tract_seg_sparse), so that memory
+                                scales with the nonzero voxels of the inputs rather than their number. Always used when
+                                any input is a SparseVolume
+    Input data are loaded in the package-wide float precision (float32 by default, see set_float_dtype)
     """
-    # improved version, processes by slice quickly after unzipping the input .gz files
-    # will also work on raw .nii files, but will zip them at the end :)
+    # improved version, processes by slab quickly from a chunked cache of the input files
 
     import os
     import numpy as np
     import nibabel as nb
-    import subprocess
+    import sparse_volume as spv
 
     print('You have input {num} files for segmentation'.format(num=len(files)))
     print('Your segmentation index is: {seg}'.format(seg=segmentation_index))
-    print_file_array(files)
+    print_file_array([fn if isinstance(fn, basestring) else repr(fn) for fn in files])
     print("Output basename: " + out_basename)
 
-    if os.path.dirname(out_basename) == '':  # if they didn't bother to set a path, same as input
+    if os.path.dirname(out_basename) == '' and isinstance(files[0], basestring):  # if they didn't bother to set a path, same as input
         out_dir = os.path.dirname(files[0])
     else:
         out_dir = os.path.dirname(out_basename)
@@ -1317,8 +2890,32 @@ def tract_seg3(files, out_basename='', segmentation_index=None, CLOBBER=False, B
     seg_pct_fname = os.path.join(out_dir, out_basename) + '_seg_pct.nii.gz'
 
     if not (os.path.isfile(seg_idx_fname)) or CLOBBER:  # if the idx file exists, don't bother doing this again
-        if not BY_SLICE:
-            data_list = [nb.load(fn).get_fdata()[..., np.newaxis] for fn in files]  # load all of the files
+        if SPARSE or any([spv.is_sparse(fn) for fn in files]):
+            print("Combining images as lists of nonzero voxels")
+            res = tract_seg_sparse(files, segmentation_index=segmentation_index)
+            if res is None:
+                return None
+            hard_seg, seg_total, seg_part, seg_pct = res
+            print("Nonzero voxels (all combined): " + str(hard_seg.nnz))
+
+            ##%%save
+            aff = hard_seg.affine
+            header = None
+            if isinstance(files[0], basestring) and not spv.is_sparse_fname(files[0]):
+                header = nb.load(files[0]).header
+
+            # outputs are images, so they are only made dense to be written
+            with AsyncNiiWriter(nthreads=4, queue_depth=4) as writer:
+                writer.save(seg_idx_fname, hard_seg.to_dense(), aff, header=header, data_type='uint32')
+                writer.save(seg_tot_fname, seg_total.to_dense(), aff, header=header, data_type='float32')
+                writer.save(seg_prt_fname, seg_part.to_dense(), aff, header=header, data_type='float32')
+                writer.save(seg_pct_fname, seg_pct.to_dense(), aff, header=header, data_type='float32')
+
+            print("All segmentation files have been written")
+
+        elif not BY_SLICE:
+            float_dtype = get_float_dtype()
+            data_list = [nb.load(fn).get_fdata(dtype=float_dtype)[..., np.newaxis] for fn in files]  # load all of the files
             combined = np.concatenate(data_list, axis=-1)  # concatenate all of the input data
 
             combined = np.concatenate((np.zeros_like(data_list[0]), combined),
@@ -1330,13 +2927,13 @@ def tract_seg3(files, out_basename='', segmentation_index=None, CLOBBER=False, B
             ##%% hard segmentation (tract w/ largest number of streamlines in each voxel wins)
             # uses argmax to return the index of the volume that has the largest value (adds 1 to be 1-based)
             hard_seg = combined.argmax(axis=-1)  # now we have a 1-based segmentation (largest number in each voxel)
-            hard_seg[combined.std(
-                axis=-1) == 0] = 0  # where there is no difference between volumes, this should be the mask, set to 0
+            hard_seg[combined.std(axis=-1,
+                                  dtype=np.float64) == 0] = 0  # where there is no difference between volumes, this should be the mask, set to 0
 
             ##%% create soft segmentation to show strength of the dominant tract in each voxel
             seg_part = np.zeros_like(hard_seg,dtype=np.float32)
             seg_temp = np.zeros_like(hard_seg,dtype=np.float32)
-            seg_total = combined.sum(axis=-1)
+            seg_total = combined.sum(axis=-1, dtype=np.float64)
 
             idx = 1
             for seg in files:
@@ -1387,73 +2984,68 @@ def tract_seg3(files, out_basename='', segmentation_index=None, CLOBBER=False, B
             aff = nb.load(files[0]).affine
             header = nb.load(files[0]).header
 
-            new_nii = nb.Nifti1Image(hard_seg.astype('uint32'), aff, header)
-            new_nii.set_data_dtype('uint32')
-            new_nii.to_filename(seg_idx_fname)
-
-            new_nii = nb.Nifti1Image(seg_total.astype('float32'), aff, header)
-            new_nii.set_data_dtype('float32')
-            new_nii.to_filename(seg_tot_fname)
-
-            new_nii = nb.Nifti1Image(seg_part.astype('float32'), aff, header)
-            new_nii.set_data_dtype('float32')
-            new_nii.to_filename(seg_prt_fname)
-
-            """
-            # this should give us a combined segmentation and % of seg that is from the one that won, but
-            # it does not currently work for all cases, so now just reports the percentage winner in each voxel
-            # without any indication of who won the segmentation
-            # XXX change to pct2 when it works :)
-            """
-            new_nii = nb.Nifti1Image(seg_pct, aff, header)
-            new_nii.set_data_dtype(
-                'float32')  # since our base file is where we get the datatype, set explicitly to float here
-            new_nii.to_filename(seg_pct_fname)
+            # the four outputs are compressed and written in parallel, with blocks waiting until they are all on disk
+            with AsyncNiiWriter(nthreads=4, queue_depth=4) as writer:
+                # niiSave casts to the output dtype chunk by chunk, so no full-size copies are needed here
+                writer.save(seg_idx_fname, hard_seg, aff, header=header, data_type='uint32')
+                writer.save(seg_tot_fname, seg_total, aff, header=header, data_type='float32')
+                writer.save(seg_prt_fname, seg_part, aff, header=header, data_type='float32')
+
+                """
+                # this should give us a combined segmentation and % of seg that is from the one that won, but
+                # it does not currently work for all cases, so now just reports the percentage winner in each voxel
+                # without any indication of who won the segmentation
+                # XXX change to pct2 when it works :)
+                """
+                # since our base file is where we get the datatype, set explicitly to float here
+                writer.save(seg_pct_fname, seg_pct, aff, header=header, data_type='float32')
 
             print("All segmentation files have been written")
 
-        else:  # we are going to process this for each slice separately to see what our mem usage looks like
-            print("Processing images slice by slice to conserve memory")
+        else:  # we are going to process this for each slab separately to see what our mem usage looks like
+            print("Processing images slab by slab to conserve memory")
+            import chunk_cache
 
-            # first we uncompress all of the data
-            for gz_file in files:
-                cmd = ['gunzip', gz_file]
-                subprocess.call(cmd)
+            # each input is converted once into a chunked cache (reused until the input changes), which serves slabs
+            # without decompressing whole files, and leaves the input files as they are
+            data_chunked = [chunk_cache.load_chunked(fn) for fn in files]
 
-            files_nii = [fn.strip('.gz') for fn in files]
-            files = files_nii
+            data_shape = data_chunked[0].shape
+            float_dtype = get_float_dtype()
 
-            data_shape = nb.load(files[0]).shape
-
-            hard_seg_full = np.zeros(data_shape)
-            seg_part_full = np.zeros(data_shape)
-            seg_total_full = np.zeros(data_shape)
+            # allocated in their output dtypes, since this is what they are written as
+            hard_seg_full = np.zeros(data_shape, dtype=np.uint32)
+            seg_part_full = np.zeros(data_shape, dtype=np.float32)
+            seg_total_full = np.zeros(data_shape, dtype=np.float32)
             seg_pct_full = np.zeros_like(hard_seg_full,dtype=np.float32)
 
             print("Data shape (single image): " + str(data_shape))
-            print("Slice: "),
+            print("Slab: "),
 
-            # loop over the last axis
-            for slice_idx in np.arange(0, data_shape[-1]):
-                print(slice_idx),
+            # loop over the last axis, one slab of chunks at a time
+            slab_size = data_chunked[0].chunk_shape[-1]
+            for slab_start in np.arange(0, data_shape[-1], slab_size):
+                slab = slice(slab_start, slab_start + slab_size)
+                print(slab_start),
 
-                data_list = [nb.load(fn).get_fdata()[:, :, slice_idx, np.newaxis] for fn in
-                             files]  # load all of the files
+                data_list = [np.asarray(d[:, :, slab], dtype=float_dtype)[..., np.newaxis] for d in
+                             data_chunked]  # load this slab of all of the files (as get_fdata would)
                 combined = np.concatenate(data_list, axis=-1)  # concatenate all of the input data
                 combined = np.concatenate((np.zeros_like(data_list[0]), combined),
                                           axis=-1)  # add a volume of zeros to padd axis and make calculations work correctly
-                if np.any(combined):  # if all voxels ==0, skip this slice entirely
+                del data_list
+                if np.any(combined):  # if all voxels ==0, skip this slab entirely
                     ##%% hard segmentation (tract w/ largest number of streamlines in each voxel wins)
                     # uses argmax to return the index of the volume that has the largest value (adds 1 to be 1-based)
                     hard_seg = combined.argmax(axis=-1)
                     # now we have a 1-based segmentation (largest number in each voxel), where number corresponds to input file order
-                    hard_seg[combined.std(
-                        axis=-1) == 0] = 0  # where there is no difference between volumes, this should be the mask, set to 0
+                    hard_seg[combined.std(axis=-1,
+                                          dtype=np.float64) == 0] = 0  # where there is no difference between volumes, this should be the mask, set to 0
 
-                    hard_seg_full[:, :, slice_idx] = hard_seg
+                    hard_seg_full[:, :, slab] = hard_seg
 
                     ##%% create soft segmentation to show strength of the dominant tract in each voxel
-                    seg_total_full[:, :, slice_idx] = combined.sum(axis=-1)
+                    seg_total_full[:, :, slab] = combined.sum(axis=-1, dtype=np.float64)
 
                     # declare empty matrices for this loop for partial and temp for calculating the partial (num of winning seg) file
                     seg_part = np.zeros_like(hard_seg,dtype=np.float32)
@@ -1461,12 +3053,12 @@ def tract_seg3(files, out_basename='', segmentation_index=None, CLOBBER=False, B
 
                     idx = 1
                     for seg in files:
-                        seg_temp = combined[:, :,
+                        seg_temp = combined[...,
                                    idx]  # get value at this voxel for this tract seg (-1 for 0-based index of volumes)
                         seg_part[hard_seg == idx] = seg_temp[hard_seg == idx]  # 1-based index of segmentation
                         idx += 1
 
-                    seg_part_full[:, :, slice_idx] = seg_part
+                    seg_part_full[:, :, slab] = seg_part
 
                     # recode simple 1-based index into user-defined index for hard_seg
                     if segmentation_index is not None:
@@ -1482,45 +3074,32 @@ def tract_seg3(files, out_basename='', segmentation_index=None, CLOBBER=False, B
                             print("====== YOU DID NOT ENTER THE CORRECT NUMBER OF VALUES FOR segmentation_index ======")
                             return None
 
-                        np.copyto(hard_seg_full[:, :, slice_idx], hard_seg_indexed)
+                        hard_seg_full[:, :, slab] = hard_seg_indexed
                         del hard_seg_indexed  # be free, my memory!
-                    seg_pct_full[:, :, slice_idx] = np.where(seg_total_full[:, :, slice_idx] > 0,
-                                                             seg_part.astype(np.float32) / seg_total_full[:, :,
-                                                                                           slice_idx].astype(
-                                                                 np.float32),
-                                                             0)  # where there is no std (regions with no tracts) return 0, otherwise do the division
+                    seg_pct_full[:, :, slab] = np.where(seg_total_full[:, :, slab] > 0,
+                                                        seg_part.astype(np.float32) / seg_total_full[:, :,
+                                                                                      slab].astype(np.float32),
+                                                        0)  # where there is no std (regions with no tracts) return 0, otherwise do the division
 
             ##%%save
             aff = nb.load(files[0]).affine
             header = nb.load(files[0]).header
 
-            new_nii = nb.Nifti1Image(hard_seg_full.astype('uint32'), aff, header)
-            new_nii.set_data_dtype('uint32')
-            new_nii.to_filename(seg_idx_fname)
-
-            new_nii = nb.Nifti1Image(seg_total_full.astype('float32'), aff, header)
-            new_nii.set_data_dtype('float32')
-            new_nii.to_filename(seg_tot_fname)
-
-            new_nii = nb.Nifti1Image(seg_part_full.astype('float32'), aff, header)
-            new_nii.set_data_dtype('float32')
-            new_nii.to_filename(seg_prt_fname)
-
-            """
-            # this should give us a combined segmentation and % of seg that is from the one that won, but
-            # it does not currently work for all cases, so now just reports the percentage winner in each voxel
-            # without any indication of who won the segmentation
-            # XXX change to pct2 when it works :)
-            """
-            new_nii = nb.Nifti1Image(seg_pct_full, aff, header)
-            new_nii.set_data_dtype(
-                'float32')  # since our base file is where we get the datatype, set explicitly to float here
-            new_nii.to_filename(seg_pct_fname)
-
-            # lets compress those files back to what they were, so everyone is happy with how much space they take
-            for nii_file in files:
-                cmd = ['gzip', nii_file]
-                subprocess.call(cmd)
+            # the four outputs are compressed and written in parallel, with blocks waiting until they are all on disk
+            with AsyncNiiWriter(nthreads=4, queue_depth=4) as writer:
+                # niiSave casts to the output dtype chunk by chunk, so no full-size copies are needed here
+                writer.save(seg_idx_fname, hard_seg_full, aff, header=header, data_type='uint32')
+                writer.save(seg_tot_fname, seg_total_full, aff, header=header, data_type='float32')
+                writer.save(seg_prt_fname, seg_part_full, aff, header=header, data_type='float32')
+
+                """
+                # this should give us a combined segmentation and % of seg that is from the one that won, but
+                # it does not currently work for all cases, so now just reports the percentage winner in each voxel
+                # without any indication of who won the segmentation
+                # XXX change to pct2 when it works :)
+                """
+                # since our base file is where we get the datatype, set explicitly to float here
+                writer.save(seg_pct_fname, seg_pct_full, aff, header=header, data_type='float32')
 
             print("")
             print("All segmentation files have been written")
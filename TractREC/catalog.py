@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 2026
+SQLite catalog of the image files in a study directory
+
+build_catalog scans a directory tree once and stores, for each file: subject ID, modality, path, shape, zooms,
+affine, dtype, file size, mtime, and a content hash. Rescans only re-read files whose mtime or size has changed, so
+keeping the catalog up to date is cheap. Batch functions (extract_quantitative_metric,
+run_diffusion_kurtosis_estimator_dipy, run_amico_noddi_dipy_v2) take catalog=<catalog file> and then accept modality
+names in place of their lists of files, so nothing needs to be globbed, substring-matched, or loaded to plan a run.
+Without a catalog, they match their lists of files to the IDs with match_files (one pass over each list).
+"""
+
+DEFAULT_PATTERNS = ['*.nii', '*.nii.gz', '*.mnc', '*bval*', '*bvec*']
+HASH_CHUNK_BYTES = 1024 ** 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path        TEXT PRIMARY KEY,
+    ID          TEXT,
+    modality    TEXT,
+    mtime       REAL,
+    size        INTEGER,
+    hash        TEXT,
+    shape       TEXT,
+    zooms       TEXT,
+    affine      TEXT,
+    dtype       TEXT
+);
+CREATE INDEX IF NOT EXISTS files_ID_modality ON files (ID, modality);
+"""
+
+
+def connect(catalog_fname):
+    """
+    Open (and create if necessary) the catalog database
+    """
+    import sqlite3
+    conn = sqlite3.connect(catalog_fname)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def hash_file(full_fileName, chunk_bytes=HASH_CHUNK_BYTES):
+    """
+    sha1 of the file contents, read in chunks
+    """
+    import hashlib
+    sha = hashlib.sha1()
+    with open(full_fileName, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_header_info(full_fileName):
+    """
+    Shape, zooms, affine, and dtype from the image header (the data is not read)
+    Returns a tuple of json strings, or Nones if nibabel cannot read the file (e.g., bvals/bvecs)
+    """
+    import json
+    import nibabel as nb
+    try:
+        img = nb.load(full_fileName)
+    except Exception:
+        return None, None, None, None
+    return (json.dumps([int(dim) for dim in img.shape]),
+            json.dumps([float(zoom) for zoom in img.header.get_zooms()]),
+            json.dumps(img.affine.tolist()),
+            str(img.get_data_dtype()))
+
+
+def get_ID(full_fileName, id_pattern=None):
+    """
+    Subject ID of a file: the first group (or the whole match) of the regular expression id_pattern searched in the
+    full path, or, by default, the last directory of the path (same convention as extract_quantitative_metric)
+    """
+    import os
+    import re
+    if id_pattern is None:
+        return os.path.basename(os.path.dirname(full_fileName))
+    match = re.search(id_pattern, full_fileName)
+    if match is None:
+        return None
+    if match.groups():
+        return match.group(1)
+    return match.group(0)
+
+
+def match_files(IDs, file_lists, id_pattern=None, names=None):
+    """
+    Match the files of several lists to subject IDs, with one pass over each list (rather than a search of every list
+    for every ID), for batch functions that are given lists of files instead of a catalog
+    By default an ID matches a file if it appears in its path as whole tokens, i.e., not preceded or followed by a letter
+    or digit: '101' matches '.../101/FA.nii.gz' and 'sub_101_FA.nii.gz', but not '1101_FA.nii.gz' or 'sub101_FA.nii.gz'
+    (IDs can have separators inside, e.g., 'sub-01'). With id_pattern, the ID of each file comes from get_ID instead.
+    Input:
+        - IDs:          list of subject IDs
+        - file_lists:   list of lists of files, entries that are None or a single file name (shared by all subjects) are
+                        passed through as they are
+        - id_pattern:   regular expression for the subject ID of a file (see get_ID), default: whole-token matching
+        - names:        names of the lists for the report (e.g., ['metric', 'label'])
+    Returns list of matched lists of files, each in the order of IDs, with None for IDs that have no file or more than
+    one in that list. These, and files that match more than one ID, are all reported here, before anything is run
+    """
+    import re
+    IDs = [str(ID) for ID in IDs]
+    ID_set = set(IDs)
+    separators = re.compile(r'([^0-9A-Za-z]+)')
+    max_tokens = max([len(separators.split(ID)) // 2 + 1 for ID in IDs] + [1])  # tokens in the longest ID
+
+    def get_file_IDs(full_fileName):
+        if id_pattern is not None:
+            ID = get_ID(full_fileName, id_pattern)
+            return [ID] if ID in ID_set else []
+        parts = separators.split(full_fileName)  # tokens at even positions, the separators between them at odd ones
+        if max_tokens == 1:
+            return sorted(ID_set.intersection(parts[0::2]))
+        n_tokens = len(parts) // 2 + 1
+        found = []
+        for start in range(n_tokens):
+            for stop in range(start + 1, min(start + max_tokens, n_tokens) + 1):
+                candidate = "".join(parts[2 * start:2 * stop - 1])
+                if candidate in ID_set and candidate not in found:
+                    found.append(candidate)
+        return found
+
+    out = []
+    for list_idx, files in enumerate(file_lists):
+        if files is None or isinstance(files, basestring):
+            out.append(files)
+            continue
+        name = "list {0}".format(list_idx) if names is None else names[list_idx]
+        index = {}
+        n_unmatched = 0
+        for full_fileName in files:
+            file_IDs = get_file_IDs(full_fileName)
+            if len(file_IDs) == 0:
+                n_unmatched += 1
+            elif len(file_IDs) > 1:
+                print("OH SHIT, {0} file matches several IDs ({1}): {2}".format(name, ", ".join(file_IDs),
+                                                                              full_fileName))
+            for ID in file_IDs:
+                index.setdefault(ID, []).append(full_fileName)
+        matched = []
+        for ID in IDs:
+            found = index.get(ID, [])
+            if len(found) == 1:
+                matched.append(found[0])
+                continue
+            if len(found) == 0:
+                print("OH SHIT, no matching {0} file for: {1}".format(name, ID))
+            else:
+                print("OH SHIT, {0} matching {1} files for {2}: {3}".format(len(found), name, ID, ", ".join(found)))
+            matched.append(None)
+        if n_unmatched > 0:
+            print("{0} of {1} {2} files do not match any ID".format(n_unmatched, len(files), name))
+        out.append(matched)
+    return out
+
+
+def get_modality(full_fileName, modalities=None):
+    """
+    Modality of a file: the first key of modalities ({'FA': '*_FA.nii.gz', ...}, fnmatch patterns on the file name)
+    whose pattern matches, or, by default (and when nothing matches), the file name without its extension(s)
+    """
+    import os
+    import fnmatch
+    fname = os.path.basename(full_fileName)
+    if modalities is not None:
+        for modality, pattern in modalities.items():
+            if fnmatch.fnmatch(fname, pattern):
+                return modality
+    for ext in ['.nii.gz', '.nii', '.mnc', '.gz']:
+        if fname.endswith(ext):
+            return fname[:-len(ext)]
+    return os.path.splitext(fname)[0]
+
+
+def build_catalog(catalog_fname, root_dir, patterns=DEFAULT_PATTERNS, id_pattern=None, modalities=None, HASH=True,
+                  VERBOSE=False):
+    """
+    Scan root_dir recursively and add every file matching patterns to the catalog, refreshing incrementally
+    Files whose mtime and size have not changed since the last scan are skipped, files that no longer exist under
+    root_dir are removed from the catalog
+    Input:
+        - catalog_fname:    sqlite file to create or update
+        - root_dir:         study directory to scan
+        - patterns:         list of fnmatch patterns for the file names to include
+        - id_pattern:       regular expression for the subject ID (see get_ID), default: last directory of the path
+        - modalities:       dict of {modality: fnmatch pattern} (see get_modality), default: file name w/o extension
+        - HASH:             compute a sha1 of each new or changed file (reads the whole file)
+        - VERBOSE:          print each file that is (re)cataloged
+    Returns dict of counts of 'added', 'updated', 'unchanged', and 'removed' files
+    """
+    import os
+    import fnmatch
+
+    root_dir = os.path.abspath(root_dir)
+    counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+    conn = connect(catalog_fname)
+    try:
+        known = {}
+        for path, mtime, size in conn.execute("SELECT path, mtime, size FROM files"):
+            if path.startswith(os.path.join(root_dir, '')):  # other studies can share the same catalog
+                known[path] = (mtime, size)
+        seen = set()
+        for dirpath, dirnames, fnames in os.walk(root_dir):
+            dirnames.sort()
+            for fname in sorted(fnames):
+                if not any([fnmatch.fnmatch(fname, pattern) for pattern in patterns]):
+                    continue
+                path = os.path.join(dirpath, fname)
+                if path == os.path.abspath(catalog_fname):
+                    continue
+                stat = os.stat(path)
+                seen.add(path)
+                if path in known and known[path] == (stat.st_mtime, stat.st_size):
+                    counts['unchanged'] += 1
+                    continue
+                if VERBOSE:
+                    print(path)
+                shape, zooms, affine, dtype = get_header_info(path)
+                file_hash = hash_file(path) if HASH else None
+                conn.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?,?,?)",
+                             (path, get_ID(path, id_pattern), get_modality(path, modalities), stat.st_mtime,
+                              stat.st_size, file_hash, shape, zooms, affine, dtype))
+                counts['updated' if path in known else 'added'] += 1
+        for path in set(known) - seen:
+            conn.execute("DELETE FROM files WHERE path = ?", (path,))
+            counts['removed'] += 1
+        conn.commit()
+    finally:
+        conn.close()
+    print("Catalog {0}: {added} added, {updated} updated, {unchanged} unchanged, {removed} removed".format(
+        catalog_fname, **counts))
+    return counts
+
+
+def query_catalog(catalog_fname, modality=None, IDs=None):
+    """
+    Catalog entries as a pandas dataframe (one row per file, sorted by ID and path), optionally restricted to a
+    modality (string or list) and/or list of IDs. shape, zooms, and affine are returned as tuples/numpy arrays
+    """
+    import json
+    import numpy as np
+    import pandas as pd
+
+    query = "SELECT * FROM files"
+    where = []
+    params = []
+    if modality is not None:
+        if isinstance(modality, basestring):
+            modality = [modality]
+        where.append("modality IN ({0})".format(",".join(["?"] * len(modality))))
+        params.extend(modality)
+    if len(where) > 0:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY ID, path"
+    conn = connect(catalog_fname)
+    try:
+        df = pd.read_sql_query(query, conn, params=params)
+    finally:
+        conn.close()
+    if IDs is not None:  # filtered here rather than in sql, which limits the number of parameters in a query
+        if isinstance(IDs, basestring):
+            IDs = [IDs]
+        df = df[df['ID'].isin([str(ID) for ID in IDs])].reset_index(drop=True)
+    df['shape'] = [tuple(json.loads(val)) if val is not None else None for val in df['shape']]
+    df['zooms'] = [tuple(json.loads(val)) if val is not None else None for val in df['zooms']]
+    df['affine'] = [np.array(json.loads(val)) if val is not None else None for val in df['affine']]
+    return df
+
+
+def get_catalog_files(catalog_fname, modalities, IDs=None):
+    """
+    Matched lists of files, one per modality, for every ID that has exactly one file of each modality
+    Entries of modalities that are None, lists, or existing files are passed through as they are (i.e., a single label
+    file or mask that is shared by all subjects), so that you can mix catalog lookups with fixed files
+    Input:
+        - catalog_fname:    catalog built with build_catalog
+        - modalities:       list of modality names (or None/file names, see above)
+        - IDs:              list of IDs to restrict to (default: every ID in the catalog with all modalities)
+    Returns IDs, [files_modality1, files_modality2, ...] (each list is in the same order as IDs, passed through entries
+    are returned as they were given)
+    """
+    import os
+
+    lookup = [modality for modality in modalities if isinstance(modality, basestring) and not os.path.isfile(modality)]
+    df = query_catalog(catalog_fname, modality=lookup, IDs=IDs)
+    counts = df.groupby(['ID', 'modality']).size()
+    for (ID, modality), count in counts[counts > 1].items():
+        print("OH SHIT, {0} {1} files for ID {2} in the catalog, this ID will be skipped".format(count, modality, ID))
+    found = {}
+    for ID, modality, path in zip(df['ID'], df['modality'], df['path']):
+        found.setdefault(ID, {}).setdefault(modality, []).append(path)
+    if IDs is None:
+        IDs = sorted(found.keys())
+    elif isinstance(IDs, basestring):
+        IDs = [IDs]
+    IDs = [str(ID) for ID in IDs]
+    out_IDs = []
+    for ID in IDs:
+        files = found.get(ID, {})
+        missing = [modality for modality in lookup if modality not in files]
+        if len(missing) > 0:
+            print("OH SHIT, no {0} file in the catalog for: {1}".format(", ".join(missing), ID))
+        elif all([len(files[modality]) == 1 for modality in lookup]):
+            out_IDs.append(ID)
+    out_files = []
+    for modality in modalities:
+        if modality in lookup:
+            out_files.append([found[ID][modality][0] for ID in out_IDs])
+        else:
+            out_files.append(modality)
+    return out_IDs, out_files
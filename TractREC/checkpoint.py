@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 2026
+Append-only checkpoint of the subjects that an extraction run has completed
+
+Each completed subject is one line of json (jsonl) with its ID, the files that it was extracted from (path, mtime,
+size, and a content hash), the extraction settings, and its per-label results. A record is keyed by a hash of all of
+these inputs, so a rerun with the same checkpoint file skips every subject whose files and settings have not changed
+and only processes new or changed ones. Lines are only ever appended (and flushed to disk as each batch completes), so
+a run that dies keeps everything completed up to that point. A partly written last line is ignored on reading.
+
+    df = extract_quantitative_metric(metric_files, label_files, checkpoint_file='FA_extraction.jsonl', n_jobs=32)
+"""
+
+_VERSION = 1
+
+
+def read_checkpoint(checkpoint_fname):
+    """
+    Records of a checkpoint file as a dictionary {key: record}, later records replace earlier ones with the same key
+    Returns an empty dictionary if the file does not exist yet
+    """
+    import os
+    import json
+    records = {}
+    if not os.path.isfile(checkpoint_fname):
+        return records
+    with open(checkpoint_fname) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:  # the last line of a run that was killed while writing
+                continue
+            if record.get('version') == _VERSION:
+                records[record['key']] = record
+    return records
+
+
+def append_records(checkpoint_fname, records):
+    """
+    Append records (list of dictionaries) to the checkpoint file, one json line each, and flush them to disk
+    """
+    import os
+    import json
+    if len(records) == 0:
+        return
+    lines = "".join([json.dumps(record) + "\n" for record in records])
+    if os.path.isfile(checkpoint_fname) and os.path.getsize(checkpoint_fname) > 0:
+        with open(checkpoint_fname, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":  # partly written line of a run that was killed, keep it from swallowing ours
+                lines = "\n" + lines
+    with open(checkpoint_fname, 'a') as f:
+        f.write(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def get_known_files(records):
+    """
+    {path: (mtime, size, hash)} of every file in the records, so that unchanged files do not need to be hashed again
+    """
+    known = {}
+    for record in records.values():
+        for file_info in record['files'].values():
+            if file_info is not None:
+                known[file_info['path']] = (file_info['mtime'], file_info['size'], file_info['hash'])
+    return known
+
+
+def get_file_info(full_fileName, known_files, hashes=None):
+    """
+    path, mtime, size and content hash of a file (None for None, e.g., no threshold mask)
+    The hash is reused from known_files if the mtime and size have not changed, and from hashes (a dictionary that
+    is filled as files are hashed, for files shared by many subjects) otherwise
+    """
+    import os
+    if full_fileName is None:
+        return None
+    from catalog import hash_file
+    path = os.path.abspath(full_fileName)
+    stat = os.stat(path)
+    if hashes is None:
+        hashes = {}
+    known = known_files.get(path)
+    if known is not None and known[0] == stat.st_mtime and known[1] == stat.st_size:
+        file_hash = known[2]
+    else:
+        if path not in hashes:
+            hashes[path] = hash_file(path)
+        file_hash = hashes[path]
+    return {'path': path, 'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': file_hash}
+
+
+def get_settings(settings):
+    """
+    json-serialisable copy of a dictionary of extraction settings (numpy arrays and scalars become lists and numbers)
+    """
+    import numpy as np
+    out = {}
+    for key, val in settings.items():
+        if isinstance(val, np.ndarray):
+            val = val.tolist()
+        elif isinstance(val, np.generic):
+            val = val.item()
+        elif isinstance(val, (list, tuple)):
+            val = [v.item() if isinstance(v, np.generic) else v for v in val]
+        out[key] = val
+    return out
+
+
+def get_record_key(ID, files, settings):
+    """
+    Key of a subject's record: sha1 of its ID, the content hashes of its files, and the settings
+    (paths and mtimes are not part of the key, so moving or touching a file does not invalidate its results)
+    """
+    import json
+    import hashlib
+    key = {'ID': str(ID), 'settings': settings,
+           'files': dict([(role, None if file_info is None else file_info['hash'])
+                          for role, file_info in files.items()])}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def make_record(key, ID, files, settings, stats):
+    """
+    Checkpoint record of a completed subject, stats is a dictionary of per-label arrays
+    """
+    import numpy as np
+    return {'version': _VERSION, 'key': key, 'ID': str(ID), 'files': files, 'settings': settings,
+            'stats': dict([(name, np.asarray(val).tolist()) for name, val in stats.items()])}
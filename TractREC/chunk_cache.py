@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 2026
+Chunked on-disk cache of image data for slab-wise processing
+
+An image is converted once into a directory of uncompressed .npy chunks (a grid over the three spatial axes, 4th
+dimension kept whole) plus a meta.json that records the source file's mtime and size. ChunkedImage then serves any
+slab (or any other slice) along any axis by memory-mapping only the chunks that it touches, so there is nothing to
+decompress and nothing is read twice. The cache is rebuilt automatically when the source file changes.
+
+    data = load_chunked('sub01_tract.nii.gz')
+    slab = data[:, :, 10:26]
+"""
+
+CHUNK_SHAPE = (64, 64, 16)  # spatial chunk size, ~256KB of float32 per 3D chunk
+CACHE_ROOT = None  # where caches go by default, None for $TRACTREC_CACHE_DIR or <tmp>/TractREC_chunks
+_META_FNAME = 'meta.json'
+_VERSION = 1
+
+
+def get_cache_dir(full_fileName):
+    """
+    Default cache directory for an image: CACHE_ROOT/<hash of the absolute path>
+    """
+    import os
+    import hashlib
+    import tempfile
+    cache_root = CACHE_ROOT
+    if cache_root is None:
+        cache_root = os.environ.get('TRACTREC_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'TractREC_chunks'))
+    path_hash = hashlib.sha1(os.path.abspath(full_fileName).encode('utf-8')).hexdigest()
+    return os.path.join(cache_root, path_hash)
+
+
+def get_chunk_fname(cache_dir, chunk_idx):
+    import os
+    return os.path.join(cache_dir, 'c_' + '_'.join([str(idx) for idx in chunk_idx]) + '.npy')
+
+
+def is_valid(cache_dir, full_fileName, chunk_shape=None):
+    """
+    True if cache_dir holds a complete cache of the current version of full_fileName (with chunks of chunk_shape, if
+    given)
+    """
+    import os
+    import json
+    meta_fname = os.path.join(cache_dir, _META_FNAME)
+    if not os.path.isfile(meta_fname):
+        return False
+    with open(meta_fname) as f:
+        meta = json.load(f)
+    stat = os.stat(full_fileName)
+    return (meta.get('version') == _VERSION and meta['source'] == os.path.abspath(full_fileName) and
+            meta['mtime'] == stat.st_mtime and meta['size'] == stat.st_size and
+            (chunk_shape is None or meta['chunk_shape'] == [int(dim) for dim in chunk_shape[:3]]))
+
+
+def build_chunk_cache(full_fileName, cache_dir=None, chunk_shape=CHUNK_SHAPE, VERBOSE=False):
+    """
+    Convert an image (anything nibabel can read) into a chunk cache, reading it one z-slab of chunk_shape[2] slices (of
+    one volume) at a time so that the whole volume is never in memory. Scaling is applied, so chunks hold what get_data
+    returns. The file is kept open and the slabs are read in file order (volume by volume), so a .nii.gz is decompressed
+    once, and each slab is written into the (memory-mapped) chunks that it overlaps
+    The cache is written to a temporary directory and moved into place when complete
+    Returns cache_dir
+    """
+    import os
+    import json
+    import shutil
+    import tempfile
+    import itertools
+    import numpy as np
+    import nibabel as nb
+    from numpy.lib.format import open_memmap
+
+    if cache_dir is None:
+        cache_dir = get_cache_dir(full_fileName)
+    parent_dir = os.path.dirname(os.path.abspath(cache_dir))
+    if not os.path.isdir(parent_dir):
+        os.makedirs(parent_dir)
+    if VERBOSE:
+        print("Building chunk cache for " + full_fileName + " in " + cache_dir)
+    stat = os.stat(full_fileName)
+    if full_fileName.endswith('.nii') or full_fileName.endswith('.nii.gz'):
+        img = nb.load(full_fileName, keep_file_open=True)
+    else:
+        img = nb.load(full_fileName)
+    shape = img.shape
+    if len(shape) < 3:
+        raise ValueError("Chunk caches are for 3D or 4D images, {0} has shape {1}".format(full_fileName, shape))
+    chunk_shape = tuple(chunk_shape[:3])
+    n_chunks = [int(np.ceil(shape[axis] / float(chunk_shape[axis]))) for axis in range(3)]
+
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix='.tmp_')
+    try:
+        dtype = None
+        for vol_idx in np.ndindex(*shape[3:]):  # a single () for a 3D image
+            for kk in range(n_chunks[2]):
+                z_slice = slice(kk * chunk_shape[2], min((kk + 1) * chunk_shape[2], shape[2]))
+                slab = np.asanyarray(img.dataobj[(slice(None), slice(None), z_slice) + vol_idx])
+                if dtype is None:
+                    dtype = slab.dtype
+                for ii, jj in itertools.product(range(n_chunks[0]), range(n_chunks[1])):
+                    x_slice = slice(ii * chunk_shape[0], min((ii + 1) * chunk_shape[0], shape[0]))
+                    y_slice = slice(jj * chunk_shape[1], min((jj + 1) * chunk_shape[1], shape[1]))
+                    chunk_fname = get_chunk_fname(tmp_dir, (ii, jj, kk))
+                    if os.path.isfile(chunk_fname):
+                        chunk = open_memmap(chunk_fname, mode='r+')
+                    else:
+                        chunk = open_memmap(chunk_fname, mode='w+', dtype=dtype,
+                                            shape=(x_slice.stop - x_slice.start, y_slice.stop - y_slice.start,
+                                                   z_slice.stop - z_slice.start) + tuple(shape[3:]))
+                    chunk[(slice(None),) * 3 + vol_idx] = slab[x_slice, y_slice]
+                    del chunk
+                del slab
+        meta = {'version': _VERSION, 'source': os.path.abspath(full_fileName), 'mtime': stat.st_mtime,
+                'size': stat.st_size, 'shape': [int(dim) for dim in shape], 'dtype': np.dtype(dtype).str,
+                'chunk_shape': list(chunk_shape), 'affine': img.affine.tolist()}
+        with open(os.path.join(tmp_dir, _META_FNAME), 'w') as f:
+            json.dump(meta, f)
+        if os.path.isdir(cache_dir):  # stale
+            shutil.rmtree(cache_dir)
+        os.rename(tmp_dir, cache_dir)
+    except:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return cache_dir
+
+
+def as_slice(idx):
+    """
+    slice equivalent to an array of indices if they are consecutive (step 1), otherwise the array itself
+    """
+    if len(idx) > 0 and idx[-1] - idx[0] == len(idx) - 1 and (len(idx) < 3 or (idx[1:] - idx[:-1] == 1).all()):
+        return slice(int(idx[0]), int(idx[-1]) + 1)
+    return idx
+
+
+class ChunkedImage(object):
+    """
+    Read-only, array-like view of a chunk cache. Supports shape, ndim, dtype, affine, len, np.asarray, and indexing with
+    any combination of integers, slices (with steps), and lists/arrays of indices (applied per axis, like np.ix_)
+    Only the chunks that a request touches are read (memory-mapped)
+    """
+    def __init__(self, cache_dir):
+        import os
+        import json
+        import numpy as np
+        with open(os.path.join(cache_dir, _META_FNAME)) as f:
+            meta = json.load(f)
+        self.cache_dir = cache_dir
+        self.source = meta['source']
+        self.shape = tuple(meta['shape'])
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(meta['dtype'])
+        self.chunk_shape = tuple(meta['chunk_shape'])
+        self.affine = np.array(meta['affine'])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        data = self[...]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def _normalise_key(self, key):
+        import numpy as np
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any([k is Ellipsis for k in key]):
+            pos = [idx for idx, k in enumerate(key) if k is Ellipsis][0]
+            key = key[:pos] + (slice(None),) * (self.ndim - len(key) + 1) + key[pos + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) > self.ndim:
+            raise IndexError("too many indices for ChunkedImage of shape {0}".format(self.shape))
+        indices = []
+        keep_axis = []
+        for axis, k in enumerate(key):
+            if isinstance(k, slice):
+                indices.append(np.arange(self.shape[axis])[k])
+                keep_axis.append(True)
+            elif np.ndim(k) == 0:
+                k = int(k)
+                if k < -self.shape[axis] or k >= self.shape[axis]:
+                    raise IndexError("index {0} is out of bounds for axis {1} with size {2}".format(
+                        k, axis, self.shape[axis]))
+                indices.append(np.array([k % self.shape[axis]]))
+                keep_axis.append(False)
+            else:
+                idx = np.asarray(k)
+                if idx.dtype == bool:
+                    idx = np.flatnonzero(idx)
+                indices.append(np.arange(self.shape[axis])[idx])
+                keep_axis.append(True)
+        return indices, keep_axis
+
+    def __getitem__(self, key):
+        import itertools
+        import numpy as np
+        indices, keep_axis = self._normalise_key(key)
+        out = np.empty([len(idx) for idx in indices], dtype=self.dtype)
+        if out.size > 0:
+            # for each spatial axis, which chunks are needed and where their values go in the output
+            per_axis = []
+            for axis in range(3):
+                chunk_ids = indices[axis] // self.chunk_shape[axis]
+                per_axis.append([(chunk_id, np.flatnonzero(chunk_ids == chunk_id))
+                                 for chunk_id in np.unique(chunk_ids)])
+            rest = [as_slice(idx) for idx in indices[3:]]
+            for parts in itertools.product(*per_axis):
+                chunk = np.load(get_chunk_fname(self.cache_dir, [part[0] for part in parts]), mmap_mode='r')
+                out_pos = [as_slice(part[1]) for part in parts]
+                local = [as_slice(indices[axis][part[1]] - part[0] * self.chunk_shape[axis])
+                         for axis, part in enumerate(parts)]
+                if all([isinstance(idx, slice) for idx in local + rest]):  # plain slab, read as a view of the chunk
+                    out[tuple(out_pos + [slice(None)] * len(rest))] = chunk[tuple(local + rest)]
+                else:
+                    out_pos = [np.arange(p.start, p.stop) if isinstance(p, slice) else p for p in out_pos]
+                    local = [np.arange(l.start, l.stop) if isinstance(l, slice) else l for l in local]
+                    rest_idx = [indices[3 + axis] for axis in range(len(rest))]
+                    out[np.ix_(*(out_pos + [np.arange(len(idx)) for idx in rest_idx]))] = \
+                        chunk[np.ix_(*(local + rest_idx))]
+                del chunk
+        return out.reshape([len(idx) for idx, keep in zip(indices, keep_axis) if keep])
+
+    def iter_slabs(self, axis=2, slab_size=None):
+        """
+        Yield (start, stop, slab) along an axis, by default in slabs that line up with the chunks
+        """
+        if slab_size is None:
+            slab_size = self.chunk_shape[axis] if axis < 3 else 1
+        for start in range(0, self.shape[axis], slab_size):
+            stop = min(start + slab_size, self.shape[axis])
+            key = [slice(None)] * self.ndim
+            key[axis] = slice(start, stop)
+            yield start, stop, self[tuple(key)]
+
+
+def load_chunked(full_fileName, cache_dir=None, chunk_shape=CHUNK_SHAPE, VERBOSE=False):
+    """
+    ChunkedImage for full_fileName, (re)building the chunk cache first if it is missing, the file has changed, or it was
+    built with a different chunk_shape
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir(full_fileName)
+    if not is_valid(cache_dir, full_fileName, chunk_shape=chunk_shape):
+        build_chunk_cache(full_fileName, cache_dir=cache_dir, chunk_shape=chunk_shape, VERBOSE=VERBOSE)
+    return ChunkedImage(cache_dir)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 2026
+Multithreaded block gzip for .nii.gz files
+
+Files are written as a series of independent gzip members (one per block), which is valid gzip: gunzip, zcat,
+python's gzip module, nibabel, fsl, and mrtrix all read them as a single stream. Each member header carries an extra
+field ('TR') with the compressed and uncompressed size of the block so that the reader can find the blocks without
+inflating them and decompress them in parallel. zlib releases the GIL, so plain threads give us the speedup.
+Files written by other tools are still read correctly, just with a single thread.
+"""
+
+import struct
+import zlib
+
+BLOCK_SIZE = 4 * 1024 ** 2  # uncompressed bytes per gzip member
+_EXTRA_ID = b'TR'
+_EXTRA_LEN = 8  # uint32 member size, uint32 uncompressed block size
+_HEADER_LEN = 10 + 2 + 4 + _EXTRA_LEN
+_FEXTRA = 4
+
+
+def _default_nthreads():
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+
+def compress_block(block, compresslevel=6):
+    """
+    Compress a block of bytes into a complete, self-contained gzip member (with our block size extra field)
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(block) + compressor.flush()
+    member_size = _HEADER_LEN + len(deflated) + 8
+    header = struct.pack('<BBBBIBBH2sHII', 0x1f, 0x8b, 8, _FEXTRA, 0, 0, 255, 4 + _EXTRA_LEN,
+                         _EXTRA_ID, _EXTRA_LEN, member_size, len(block))
+    trailer = struct.pack('<II', zlib.crc32(block) & 0xffffffff, len(block) & 0xffffffff)
+    return header + deflated + trailer
+
+
+class ParallelGzipWriter(object):
+    """
+    Write-only file object that compresses blocks of BLOCK_SIZE bytes on a pool of threads
+    Blocks are written to disk in order, at most 2*nthreads blocks are held in memory at any time
+    tell() reports the uncompressed position and seek() only accepts the current position, which is all that nibabel
+    needs to write an image into it
+        - fname:            output file name
+        - compresslevel:    zlib compression level (1=fastest ... 9=smallest)
+        - nthreads:         number of compression threads (None = number of cpus)
+        - block_size:       uncompressed bytes per gzip member
+    """
+    def __init__(self, fname, compresslevel=6, nthreads=None, block_size=BLOCK_SIZE):
+        from concurrent.futures import ThreadPoolExecutor
+        from collections import deque
+        if nthreads is None:
+            nthreads = _default_nthreads()
+        self.name = fname
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self._fileobj = open(fname, 'wb')
+        self._pool = ThreadPoolExecutor(max_workers=nthreads)
+        self._max_pending = 2 * nthreads
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._pos = 0
+        self._members = 0
+        self.closed = False
+
+    def write(self, data):
+        data = memoryview(data)
+        if data.format != 'B' or data.ndim != 1:
+            data = data.cast('B')
+        self._buffer += data
+        self._pos += len(data)
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset = self._pos + offset
+        if whence == 2 or offset != self._pos:
+            raise IOError("ParallelGzipWriter can only seek to its current position")
+        return self._pos
+
+    def seekable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def readable(self):
+        return False
+
+    def read(self, size=-1):  # nibabel only treats objects with both read and write as open files
+        raise IOError("ParallelGzipWriter is write-only")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if len(self._buffer) > 0 or self._members == 0:  # an empty file still needs one member to be valid gzip
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while len(self._pending) > 0:
+                self._fileobj.write(self._pending.popleft().result())
+        finally:
+            self._pool.shutdown(wait=True)
+            self._fileobj.close()
+            self.closed = True
+
+    def _submit(self, block):
+        self._pending.append(self._pool.submit(compress_block, block, self.compresslevel))
+        self._members += 1
+        while len(self._pending) > self._max_pending:  # keep memory bounded, write out the oldest block
+            self._fileobj.write(self._pending.popleft().result())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _find_members(buf):
+    """
+    Walk the gzip members in buf using our extra field, returns list of (start, size, raw_size)
+    or None if any member was not written by ParallelGzipWriter (we cannot find its end without inflating it)
+    """
+    members = []
+    start = 0
+    while start < len(buf):
+        if len(buf) - start < _HEADER_LEN:
+            return None
+        (id1, id2, cm, flg, _, _, _, xlen, si,
+         sublen, member_size, raw_size) = struct.unpack_from('<BBBBIBBH2sHII', buf, start)
+        if (id1, id2, cm) != (0x1f, 0x8b, 8) or flg != _FEXTRA or xlen != 4 + _EXTRA_LEN or si != _EXTRA_ID:
+            return None
+        members.append((start, member_size, raw_size))
+        start += member_size
+    return members
+
+
+def _inflate_member(buf, start, size, raw_size, out, out_start):
+    block = zlib.decompress(memoryview(buf)[start + _HEADER_LEN:start + size - 8], -zlib.MAX_WBITS)
+    crc, isize = struct.unpack_from('<II', buf, start + size - 8)
+    if len(block) != raw_size or (zlib.crc32(block) & 0xffffffff) != crc:
+        raise IOError("Corrupt gzip block at byte {0}".format(start))
+    out[out_start:out_start + raw_size] = block
+
+
+def read_gz(fname, nthreads=None):
+    """
+    Read and decompress a whole gzip file, returns a bytearray
+    Blocks written by ParallelGzipWriter are inflated in parallel on nthreads threads (None = number of cpus),
+    anything else falls back to single-threaded decompression
+    """
+    with open(fname, 'rb') as f:
+        buf = f.read()
+    members = _find_members(buf)
+    if members is None:
+        out = bytearray()
+        remaining = buf
+        while len(remaining) > 0:  # standard gzip, possibly with several members
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out += decompressor.decompress(remaining)
+            out += decompressor.flush()
+            remaining = decompressor.unused_data
+        return out
+
+    from concurrent.futures import ThreadPoolExecutor
+    if nthreads is None:
+        nthreads = _default_nthreads()
+    out = bytearray(sum([m[2] for m in members]))
+    out_start = 0
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        futures = []
+        for start, size, raw_size in members:
+            futures.append(pool.submit(_inflate_member, buf, start, size, raw_size, out, out_start))
+            out_start += raw_size
+        for future in futures:
+            future.result()  # raise any errors
+    return out
+
+
+def load_nii_gz(fname, nthreads=None):
+    """
+    Load a .nii.gz file with parallel decompression
+    The data array is built directly on top of the decompressed buffer (no extra copy), with nifti scaling applied
+    NIfTI-1 and NIfTI-2 headers are read from the buffer, anything else is handed to nb.load
+    Returns data, affine, header
+    """
+    import io
+    import numpy as np
+    import nibabel as nb
+
+    raw = read_gz(fname, nthreads=nthreads)
+    sizeof_hdr = [int(np.frombuffer(bytes(raw[:4]), dtype=endian + 'i4')[0]) for endian in '<>']
+    header_class = None
+    for klass in [nb.Nifti1Header, nb.Nifti2Header]:
+        if klass.sizeof_hdr in sizeof_hdr and len(raw) >= klass.sizeof_hdr + 4:
+            header_class = klass
+    if header_class is None:
+        img = nb.load(fname)
+        return np.asanyarray(img.dataobj), img.affine, img.header
+    vox_offset = int(header_class(bytes(raw[:header_class.sizeof_hdr]))['vox_offset'])
+    hdr_end = max(vox_offset, header_class.sizeof_hdr + 4)  # includes extensions
+    header = header_class.from_fileobj(io.BytesIO(bytes(raw[:hdr_end])))
+    data = np.ndarray(header.get_data_shape(), dtype=header.get_data_dtype(), buffer=raw,
+                      offset=int(header.get_data_offset()), order='F')
+    slope, inter = header.get_slope_inter()
+    data = nb.volumeutils.apply_read_scaling(data, slope, inter)  # same scaling that nibabel applies on load
+    return data, header.get_best_affine(), header
@@ -84,13 +84,11 @@ def smooth_data_array(arr, affine, fwhm=None, ensure_finite=True, copy=True):
     """
     import numpy as np
     import scipy.ndimage as ndimage
+    from TractREC import get_float_dtype
     
     if arr.dtype.kind == 'i':
-        if arr.dtype == np.int64:
-            arr = arr.astype(np.float64)
-        else:
-            # We don't need crazy precision
-            arr = arr.astype(np.float32)
+        # We don't need crazy precision, package-wide setting (float32 unless set_float_dtype says otherwise)
+        arr = arr.astype(get_float_dtype())
     if copy:
         arr = arr.copy()
 
@@ -169,8 +167,15 @@ def select_and_write_data_bvals_bvecs(data_fname,bvals_file,bvecs_file,out_dir=N
                 print("File exists, not overwriting.")
         else:
             if not(os.path.isfile(out_fname)) or CLOBBER:
-                data,aff=imgLoad(data_fname)
-                niiSave(out_fname,data[...,vol_list],aff,CLOBBER=CLOBBER)
+                from TractREC import imgLoad, niiSave, get_img_volume
+                data,aff=imgLoad(data_fname,LAZY=True) #read only the volumes that we keep, one at a time
+                data_sel=None
+                for out_idx,vol in enumerate(vol_list):
+                    vol_d=get_img_volume(data,vol)
+                    if data_sel is None:
+                        data_sel=np.zeros(vol_d.shape+(len(vol_list),),dtype=vol_d.dtype)
+                    data_sel[...,out_idx]=vol_d
+                niiSave(out_fname,data_sel,aff,CLOBBER=CLOBBER)
                 np.savetxt(bvals_fname,bvals[bvals<bval_max_cutoff])
                 np.savetxt(bvecs_fname,bvecs[:,bvals<bval_max_cutoff])
             else:
@@ -181,23 +186,27 @@ def DKE_by_slice(data,gtab,slices='all'):
     """
     Fits the DKE model by slice to decrease memory requirements
     Do all slices, or array subset thereof
+    data can be anything that can be sliced like an array, e.g., a chunk_cache.ChunkedImage or an image's dataobj,
+    so that only one slice at a time is read into memory
+    Results are returned in the package-wide float precision (see TractREC.set_float_dtype)
     """
     import dipy.reconst.dki as dki    
     import numpy as np
+    from TractREC import get_float_dtype
     
     print('Creating diffusion kurtosis model')
     dkimodel = dki.DiffusionKurtosisModel(gtab)
     n_contrasts=3 #number of contrasts that we are going to have output from the dki model
 
     
-    out_data=np.zeros(list(np.shape(data)[0:3])+[n_contrasts]) #replace the diff dir axis with our own for the results
+    out_data=np.zeros(list(data.shape[0:3])+[n_contrasts],dtype=get_float_dtype()) #replace the diff dir axis with our own for the results
     if slices is 'all':    
-        slices=np.arange(0,np.shape(data)[2])
+        slices=np.arange(0,data.shape[2])
     print("Performing diffusion kurtosis estimation by slice: "),    
     #lets loop across the z dimension - index 2
     for zslice in slices:
         print(zslice),
-        slice_d=data[:,:,zslice,:]
+        slice_d=np.asarray(data[:,:,zslice,:])
         
         dkifit=dkimodel.fit(slice_d)
         MK = dkifit.mk(0, 3)
@@ -221,6 +230,7 @@ def DKE(data_fname,bvals_fname,bvecs_fname,bval_max_cutoff=3200,out_dir=None,sli
     from dipy.segment.mask import median_otsu
     from dipy.denoise.noise_estimate import estimate_sigma
     from dipy.denoise.nlmeans import nlmeans
+    from TractREC import imgLoad, create_dir, AsyncNiiWriter
     import os
 
     GAUSS_SMTH_MULTIPLIER=1.25 #taken from the DKI papers
@@ -257,38 +267,40 @@ def DKE(data_fname,bvals_fname,bvecs_fname,bval_max_cutoff=3200,out_dir=None,sli
     DK_stats=DKE_by_slice(maskdata,gtab,slices=slices)
     del maskdata #clear this from mem, just in case it is huuuuge!
     
-    out_fname=out_fname_base+"MK.nii.gz"
-    niiSave(out_fname,DK_stats[...,0],aff)
-    out_fname=out_fname_base+"AK.nii.gz"
-    niiSave(out_fname,DK_stats[...,1],aff)
-    out_fname=out_fname_base+"RK.nii.gz"
-    niiSave(out_fname,DK_stats[...,2],aff)
-    del DK_stats #remove from mem
+    #outputs are written in the background while the next model runs, at most one set of MK/AK/RK waits in memory
+    with AsyncNiiWriter(nthreads=3, queue_depth=3) as writer:
+        out_fname=out_fname_base+"MK.nii.gz"
+        writer.save(out_fname,DK_stats[...,0],aff)
+        out_fname=out_fname_base+"AK.nii.gz"
+        writer.save(out_fname,DK_stats[...,1],aff)
+        out_fname=out_fname_base+"RK.nii.gz"
+        writer.save(out_fname,DK_stats[...,2],aff)
+        del DK_stats #remove from mem (once the writer is done with it)
     
-    if 'nlmeans' in SMTH_DEN:
-        print("")
-        print("Running the model on denoised data")
-        print("==========================================")    
-        DK_stats_den=DKE_by_slice(den,gtab,slices=slices)
-        out_fname=out_fname_base+"MK_den.nii.gz"
-        niiSave(out_fname,DK_stats_den[...,0],aff)
-        out_fname=out_fname_base+"AK_den.nii.gz"
-        niiSave(out_fname,DK_stats_den[...,1],aff)
-        out_fname=out_fname_base+"RK_den.nii.gz"
-        niiSave(out_fname,DK_stats_den[...,2],aff)
-        del DK_stats_den
+        if 'nlmeans' in SMTH_DEN:
+            print("")
+            print("Running the model on denoised data")
+            print("==========================================")    
+            DK_stats_den=DKE_by_slice(den,gtab,slices=slices)
+            out_fname=out_fname_base+"MK_den.nii.gz"
+            writer.save(out_fname,DK_stats_den[...,0],aff)
+            out_fname=out_fname_base+"AK_den.nii.gz"
+            writer.save(out_fname,DK_stats_den[...,1],aff)
+            out_fname=out_fname_base+"RK_den.nii.gz"
+            writer.save(out_fname,DK_stats_den[...,2],aff)
+            del DK_stats_den
     
-    if 'smth' in SMTH_DEN:
-        print("")
-        print("Running the model on smoothed data " + "(vox_dim*"+str(GAUSS_SMTH_MULTIPLIER)+")")
-        print("=========================================================")    
-        DK_stats_smth=DKE_by_slice(smth,gtab,slices=slices)
-        out_fname=out_fname_base+"MK_smth.nii.gz"
-        niiSave(out_fname,DK_stats_smth[...,0],aff)
-        out_fname=out_fname_base+"AK_smth.nii.gz"
-        niiSave(out_fname,DK_stats_smth[...,1],aff)
-        out_fname=out_fname_base+"RK_smth.nii.gz"
-        niiSave(out_fname,DK_stats_smth[...,2],aff)
+        if 'smth' in SMTH_DEN:
+            print("")
+            print("Running the model on smoothed data " + "(vox_dim*"+str(GAUSS_SMTH_MULTIPLIER)+")")
+            print("=========================================================")    
+            DK_stats_smth=DKE_by_slice(smth,gtab,slices=slices)
+            out_fname=out_fname_base+"MK_smth.nii.gz"
+            writer.save(out_fname,DK_stats_smth[...,0],aff)
+            out_fname=out_fname_base+"AK_smth.nii.gz"
+            writer.save(out_fname,DK_stats_smth[...,1],aff)
+            out_fname=out_fname_base+"RK_smth.nii.gz"
+            writer.save(out_fname,DK_stats_smth[...,2],aff)
 
 def create_python_exec(out_dir,code=["#!/usr/bin/python",""],name="CJS_py"):
     """
@@ -312,7 +324,7 @@ def create_python_exec(out_dir,code=["#!/usr/bin/python",""],name="CJS_py"):
     os.chmod(subFullName,st.st_mode | stat.S_IEXEC) #make executable
     return subFullName
     
-def run_diffusion_kurtosis_estimator_dipy(data_fnames,bvals_fnames,bvecs_fnames,out_root_dir,IDs,bval_max_cutoff=3200,slices='all',nthreads=4,mem=3.75,SMTH_DEN=None,IN_MEM=True,SUBMIT=False,CLOBBER=False):
+def run_diffusion_kurtosis_estimator_dipy(data_fnames,bvals_fnames,bvecs_fnames,out_root_dir,IDs,bval_max_cutoff=3200,slices='all',nthreads=4,mem=3.75,SMTH_DEN=None,IN_MEM=True,SUBMIT=False,CLOBBER=False,catalog=None,id_pattern=None):
     """
     Creates .py and .sub submission files for submission of DKE to SGE, submits if SUBMIT=True
     Pass matched lists of data filenames, bval filenames, and bvec filenames, along with a root directory for the output
@@ -332,31 +344,37 @@ def run_diffusion_kurtosis_estimator_dipy(data_fnames,bvals_fnames,bvecs_fnames,
         - IN_MEM            perform diffusion volume selection (based on bvals that were selected by bval_max_cutoff) in mem or with fslselectcols via command line
         - SUBMIT            submit to SGE (False=just create the .py and .sub submission files)
         - CLOBBER           force overwrite of output files (.py and .sub files are always overwritten regardless)
+        - catalog           catalog file from catalog.build_catalog, data_fnames, bvals_fnames, and bvecs_fnames are then
+                            modality names in the catalog (or single files shared by all subjects) and IDs can be None
+                            for every ID that has all three
+        - id_pattern        regular expression for the subject ID in a file path (see catalog.get_ID), by default the ID must
+                            appear in the path as whole tokens (see catalog.match_files, '101' does not match '1101_dwi.nii.gz')
         
     RETURNS: 
         - nothing, but dumps all DKE calcs (MK, RK, AK) in out_dir/ID
     """
     import os
+    from TractREC import create_dir, submit_via_qsub
     
     caller_path=os.path.dirname(os.path.abspath(__file__)) #path to this script, so we can add it to a sys.addpath statement
+    if catalog is not None: #files come back matched to the IDs, no need to search for them
+        import catalog as cat
+        IDs,(data_fnames,bvals_fnames,bvecs_fnames)=cat.get_catalog_files(catalog,[data_fnames,bvals_fnames,bvecs_fnames],IDs=IDs)
+    else: #we use the IDs as our master to lookup files in the provided lists, one pass over each list (missing and duplicated files are reported here)
+        import catalog as cat
+        data_fnames,bvals_fnames,bvecs_fnames=cat.match_files(IDs,[data_fnames,bvals_fnames,bvecs_fnames],id_pattern=id_pattern,names=['data','bvals','bvecs'])
     print("Running the dipy-based diffusion kurtosis estimator.")
     for idx,ID in enumerate(IDs):
-        fname=[s for s in data_fnames if ID in s] #we use the IDs as our master to lookup files in the provided lists, the full filename should have the ID SOMEWHERE!
-        bvals=[s for s in bvals_fnames if ID in s]
-        bvecs=[s for s in bvecs_fnames if ID in s]
+        fname=data_fnames[idx]
+        bvals=bvals_fnames if isinstance(bvals_fnames, basestring) else bvals_fnames[idx]
+        bvecs=bvecs_fnames if isinstance(bvecs_fnames, basestring) else bvecs_fnames[idx]
         out_dir=os.path.join(out_root_dir,ID)
         create_dir(out_dir)
         #check that we are pulling the correct files
-        if len(fname)>1 or len(bvals)>1 or len(bvecs)>1:
-            print("OH SHIT, too many possible files. This should not happen!")
-            DATA_EXISTS=False
-        elif len(fname)<1 or len(bvals)<1 or len(bvecs)<1:
-            print("OH SHIT, no matching file for this ID: " + ID)
+        if fname is None or bvals is None or bvecs is None:
+            print("OH SHIT, no single matching file for this ID: " + ID)
             DATA_EXISTS=False
         else:
-            fname=fname[0] #break it out of the list of one  
-            bvals=bvals[0]
-            bvecs=bvecs[0]
             DATA_EXISTS=True
             print(ID)
             print(" input:  "+ (fname))
@@ -460,7 +478,7 @@ def run_amico_noddi_dipy(subject_root_dir,out_root_dir,subject_dirs=None,b0_thr=
                             description="NODDI estimation with AMICO",SUBMIT=SUBMIT)
         print(py_sub_full_fname)
 
-def run_amico_noddi_dipy_v2(subject_root_dir,dwi_fnames,brain_mask_fnames,bvals_fnames,bvecs_fnames,out_root_dir,subject_dirs=None,b0_thr=0, bStep=[0,1000,2000,3000],nthreads=8,mem=2.5,CLOBBER=False,SUBMIT=False):
+def run_amico_noddi_dipy_v2(subject_root_dir,dwi_fnames,brain_mask_fnames,bvals_fnames,bvecs_fnames,out_root_dir,subject_dirs=None,b0_thr=0, bStep=[0,1000,2000,3000],nthreads=8,mem=2.5,CLOBBER=False,SUBMIT=False,catalog=None):
     """
     Updated version to take in params individually so that you can store the files however you want to.
 
@@ -477,6 +495,9 @@ def run_amico_noddi_dipy_v2(subject_root_dir,dwi_fnames,brain_mask_fnames,bvals_
     :param mem:
     :param CLOBBER:
     :param SUBMIT:
+    :param catalog: catalog file from catalog.build_catalog, the *_fnames are then modality names in the catalog (or single
+                    files shared by all subjects), subject_dirs are the IDs to run (None for all), and IDs are taken
+                    from the catalog rather than from the dwi file names
     :return:
     """
      #No... requires closer to 36GB for the HCP data
@@ -499,6 +520,11 @@ def run_amico_noddi_dipy_v2(subject_root_dir,dwi_fnames,brain_mask_fnames,bvals_
 #        subject_dirs=os.listdir(subject_root_dir)
 #        if "kernels" in subject_dirs: subject_dirs.remove("kernels") #don't try to do this for the kernels directory, which AMICO hard-codes here
 
+    single_bvals = False
+    single_bvecs = False
+    if catalog is not None:
+        import catalog as cat
+        IDs,(dwi_fnames,brain_mask_fnames,bvals_fnames,bvecs_fnames)=cat.get_catalog_files(catalog,[dwi_fnames,brain_mask_fnames,bvals_fnames,bvecs_fnames],IDs=subject_dirs)
     if isinstance(dwi_fnames, basestring):
         dwi_fnames=[dwi_fnames]
     if isinstance(bvals_fnames, basestring):
@@ -534,7 +560,10 @@ def run_amico_noddi_dipy_v2(subject_root_dir,dwi_fnames,brain_mask_fnames,bvals_
         else:
             bvecs_fname = bvecs_fnames[idx]
 
-        ID = os.path.basename(dwi_fname).split(".")[0]
+        if catalog is not None:
+            ID = IDs[idx]
+        else:
+            ID = os.path.basename(dwi_fname).split(".")[0]
         scheme_fname=os.path.join(os.path.dirname(bvals_fname),"bvals_bvecs_sanitised.scheme")
         mask_fname=brain_mask_fnames[idx]
         out_dir=os.path.join(out_root_dir,ID)
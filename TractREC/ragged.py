@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 2026
+Compact (ragged) storage of the voxel values of every subject and label, for metric='data' extractions
+
+The values of all subjects and labels are kept in one flat array, subject by subject and label by label, with the
+offsets of each (subject, label) block, and the flat (C-order) index of each value in its subject's grid. Coordinates
+are only computed when they are asked for. It is saved as a single uncompressed .npz whose arrays are memory-mapped
+when it is loaded, so voxel-level dumps of a whole cohort do not have to fit in memory.
+
+    df, data = extract_quantitative_metric(metric_files, label_files, metric='data', data_file='FA_voxels.npz')
+    data = load_ragged('FA_voxels.npz')
+    vals = data.get_values('sub01', 10)
+    coords = data.get_coordinates('sub01', 10)
+"""
+
+RAGGED_EXT = '.npz'
+
+
+class RaggedData(object):
+    """
+    Voxel values of subjects x labels in one flat array
+    Input:
+        - values:       values of all subjects and labels, subject by subject, then label by label
+        - offsets:      values[offsets[s, l]:offsets[s, l + 1]] are the values of subject s and label l
+                        (n_subjects x (n_labels + 1), offsets[s, -1] == offsets[s + 1, 0])
+        - vox_idx:      flat (C-order) index of each value in the grid of its subject
+        - shapes:       shape of the grid of each subject (n_subjects x ndim)
+        - IDs:          subject IDs
+        - label_vals:   label values
+        - affines:      voxel to world affine of the grid of each subject (n_subjects x 4 x 4, default: identity)
+    """
+    def __init__(self, values, offsets, vox_idx, shapes, IDs, label_vals, affines=None):
+        import numpy as np
+        offsets = np.asarray(offsets)
+        if len(values) != len(vox_idx):
+            raise ValueError("RaggedData needs one voxel index per value ({0} indices, {1} values)".format(
+                len(vox_idx), len(values)))
+        if offsets.shape != (len(IDs), len(label_vals) + 1):
+            raise ValueError("RaggedData offsets must be subjects x (labels + 1), not {0}".format(offsets.shape))
+        self.values = values
+        self.offsets = offsets
+        self.vox_idx = vox_idx
+        self.shapes = np.asarray(shapes)
+        self.IDs = np.asarray(IDs).astype(str)
+        self.label_vals = np.asarray(label_vals)
+        if affines is None:
+            affines = np.tile(np.eye(4), (len(IDs), 1, 1))
+        self.affines = np.asarray(affines)
+
+    @property
+    def n_subjects(self):
+        return len(self.IDs)
+
+    @property
+    def n_labels(self):
+        return len(self.label_vals)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return "RaggedData(subjects={0}, labels={1}, values={2}, dtype={3})".format(
+            self.n_subjects, self.n_labels, len(self.values), self.values.dtype)
+
+    @classmethod
+    def from_results(cls, all_res, IDs, label_vals):
+        """
+        RaggedData of the results objects of extract_stats_from_masked_image (or get_subject_data), one per subject
+        (None for subjects without results, which are then empty). Labels without data are empty (rather than [0])
+        """
+        import numpy as np
+        subjects = [get_subject_data(res) for res in all_res]
+        n_dim = max([len(sub['shape']) for sub in subjects if sub is not None] + [3])
+        counts = np.zeros((len(subjects), len(label_vals)), dtype=np.int64)
+        shapes = np.zeros((len(subjects), n_dim), dtype=np.int64)
+        affines = np.tile(np.eye(4), (len(subjects), 1, 1))
+        for row, sub in enumerate(subjects):
+            if sub is not None:
+                counts[row] = sub['counts']
+                shapes[row] = sub['shape']
+                affines[row] = sub['affine']
+        offsets = np.zeros((len(subjects), len(label_vals) + 1), dtype=np.int64)
+        offsets[:, 1:] = np.cumsum(counts, axis=1)
+        offsets += np.concatenate(([0], np.cumsum(offsets[:-1, -1])))[:, None]
+        subjects = [sub for sub in subjects if sub is not None]
+        if len(subjects) == 0:
+            return cls(np.zeros(0), offsets, np.zeros(0, dtype=np.int64), shapes, IDs, label_vals, affines)
+        values = np.concatenate([sub['values'] for sub in subjects])
+        vox_idx = np.concatenate([sub['vox_idx'] for sub in subjects])
+        return cls(values, offsets, vox_idx, shapes, IDs, label_vals, affines)
+
+    def get_index(self, ID, label_val):
+        """
+        (row, column) of a subject ID and label value
+        """
+        import numpy as np
+        rows = np.flatnonzero(self.IDs == str(ID))
+        cols = np.flatnonzero(self.label_vals == label_val)
+        if len(rows) == 0 or len(cols) == 0:
+            raise KeyError("No data for subject {0} and label {1}".format(ID, label_val))
+        return rows[0], cols[0]
+
+    def get_values(self, ID, label_val):
+        """
+        Values of one subject and label (a view, read from disk if memory-mapped)
+        """
+        row, col = self.get_index(ID, label_val)
+        return self.values[self.offsets[row, col]:self.offsets[row, col + 1]]
+
+    def get_vox_idx(self, ID, label_val):
+        """
+        Flat (C-order) index of the values of one subject and label in the grid of the subject
+        """
+        row, col = self.get_index(ID, label_val)
+        return self.vox_idx[self.offsets[row, col]:self.offsets[row, col + 1]]
+
+    def get_coordinates(self, ID, label_val):
+        """
+        Voxel coordinates of the values of one subject and label, array of shape (n_values, ndim)
+        """
+        import numpy as np
+        row, col = self.get_index(ID, label_val)
+        return np.column_stack(np.unravel_index(self.vox_idx[self.offsets[row, col]:self.offsets[row, col + 1]],
+                                                tuple(self.shapes[row])))
+
+    def get_subject(self, ID):
+        """
+        Dictionary {label value: values} of one subject
+        """
+        row = self.get_index(ID, self.label_vals[0])[0]
+        return dict([(label_val, self.values[self.offsets[row, col]:self.offsets[row, col + 1]])
+                     for col, label_val in enumerate(self.label_vals)])
+
+    def save(self, full_fileName):
+        """
+        Save as an uncompressed .npz (so that load_ragged can memory-map it)
+        """
+        import numpy as np
+        if not full_fileName.endswith(RAGGED_EXT):
+            raise ValueError("RaggedData is saved as {0} files, not {1}".format(RAGGED_EXT, full_fileName))
+        np.savez(full_fileName, values=np.asarray(self.values), offsets=self.offsets,
+                 vox_idx=np.asarray(self.vox_idx), shapes=self.shapes, IDs=self.IDs, label_vals=self.label_vals,
+                 affines=self.affines)
+        return full_fileName
+
+
+def get_subject_data(res):
+    """
+    Compact data of one subject: dictionary of 'values' and 'vox_idx' (all labels, one flat array each), 'counts' (per
+    label), 'shape', and 'affine', from a results object of extract_stats_from_masked_image
+    (returned as is if it already is one, None for None)
+    """
+    import numpy as np
+    if res is None or isinstance(res, dict):
+        return res
+    counts = np.array([len(label_idx) for label_idx in res.vox_idx], dtype=np.int64)
+    values = [label_data[:count] for label_data, count in zip(res.data, counts)]  # [0] for labels without data
+    return {'values': np.concatenate(values) if len(values) > 0 else np.zeros(0),
+            'vox_idx': np.concatenate(res.vox_idx) if len(counts) > 0 else np.zeros(0, dtype=np.int64),
+            'counts': counts, 'shape': tuple(res.shape),
+            'affine': np.eye(4) if res.affine is None else res.affine}
+
+
+def memmap_npz(full_fileName, name):
+    """
+    Memory-mapped array of an uncompressed member of an .npz file (np.load reads the members of .npz files in full)
+    Returns None if the member is compressed or holds python objects
+    """
+    import zipfile
+    import struct
+    import numpy as np
+    with zipfile.ZipFile(full_fileName) as zf:
+        info = zf.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(full_fileName, 'rb') as f:
+        f.seek(info.header_offset)
+        local_header = f.read(30)  # the name and extra fields of the local header can differ from the central one
+        name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        if dtype.hasobject:
+            return None
+        offset = f.tell()
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(full_fileName, dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def load_ragged(full_fileName, MMAP=True):
+    """
+    RaggedData from a saved .npz, values and voxel indices are memory-mapped (read from disk as they are used) unless
+    MMAP=False or the file was compressed
+    """
+    import numpy as np
+    with np.load(full_fileName) as npz:
+        small = dict([(name, npz[name]) for name in ['offsets', 'shapes', 'IDs', 'label_vals', 'affines']])
+        big = {}
+        for name in ['values', 'vox_idx']:
+            big[name] = memmap_npz(full_fileName, name) if MMAP else None
+            if big[name] is None:
+                big[name] = npz[name]
+    return RaggedData(big['values'], small['offsets'], big['vox_idx'], small['shapes'], small['IDs'],
+                      small['label_vals'], small['affines'])
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 2026
+Sparse (voxel list) representation of mostly-empty volumes
+
+Tract density maps, connectome node masks, and seed maps are usually >95% zeros. A SparseVolume keeps only the
+nonzero voxels: their flat (C-order) indices into the volume, their values, and the shape/affine of the volume that
+they came from. It is saved as a small .npz and converted back to a full array only when something needs one.
+
+    sv = SparseVolume.from_file('sub01_tract.nii.gz')
+    sv.save('sub01_tract.npz')
+    d = load_sparse('sub01_tract.npz').to_dense()
+
+tract_seg3, map_values_to_label_file, and the connectome tools in utils (mask2labels_multifile, matrix2voxel_map,
+tck2connectome_collection) accept SparseVolumes or their .npz files in place of image files.
+"""
+
+SPARSE_EXT = '.npz'
+
+
+class SparseVolume(object):
+    """
+    Nonzero voxels of a 3D (or 4D) volume: sorted, unique flat indices (C-order) and their values
+    Input:
+        - indices:  flat indices into a volume of shape (any order, they are sorted here)
+        - values:   value at each index (same length as indices)
+        - shape:    shape of the full volume
+        - affine:   voxel to world affine of the full volume (default: identity)
+    """
+    def __init__(self, indices, values, shape, affine=None):
+        import numpy as np
+        import utils
+        shape = tuple([int(dim) for dim in shape])
+        size = int(np.prod(shape))
+        indices = np.asarray(indices).ravel()
+        values = np.asarray(values).ravel()
+        if len(indices) != len(values):
+            raise ValueError("SparseVolume needs one value per index ({0} indices, {1} values)".format(
+                len(indices), len(values)))
+        if len(indices) > 0:
+            if indices.min() < 0 or indices.max() >= size:
+                raise ValueError("SparseVolume indices are outside of a volume of shape {0}".format(shape))
+            if np.any(indices[1:] < indices[:-1]):
+                order = np.argsort(indices, kind='mergesort')
+                indices = indices[order]
+                values = values[order]
+            if np.any(indices[1:] == indices[:-1]):
+                raise ValueError("SparseVolume indices must be unique")
+        self.indices = indices.astype(utils.get_label_dtype(max(size - 1, 0)), copy=False)
+        self.values = values
+        self.shape = shape
+        self.ndim = len(shape)
+        if affine is None:
+            affine = np.eye(4)
+        self.affine = np.asarray(affine)
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    @property
+    def size(self):
+        import numpy as np
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "SparseVolume(shape={0}, nnz={1}, dtype={2})".format(self.shape, self.nnz, self.dtype)
+
+    def __array__(self, dtype=None):
+        return self.to_dense(dtype=dtype)
+
+    @classmethod
+    def from_dense(cls, data, affine=None):
+        """
+        SparseVolume of the nonzero voxels of an array
+        """
+        import numpy as np
+        data = np.asanyarray(data)
+        indices = np.flatnonzero(data)
+        return cls(indices, data.ravel()[indices], data.shape, affine=affine)
+
+    @classmethod
+    def from_file(cls, full_fileName):
+        """
+        SparseVolume of an image file (anything nibabel can read, scaling applied) or a saved SparseVolume (.npz)
+        """
+        import numpy as np
+        import nibabel as nb
+        if is_sparse_fname(full_fileName):
+            with np.load(full_fileName) as npz:
+                return cls(npz['indices'], npz['values'], npz['shape'], affine=npz['affine'])
+        img = nb.load(full_fileName)
+        return cls.from_dense(np.asanyarray(img.dataobj), affine=img.affine)
+
+    def save(self, full_fileName, COMPRESS=True):
+        """
+        Save as .npz (indices, values, shape, affine), COMPRESS=False writes faster but larger files
+        """
+        import numpy as np
+        if not is_sparse_fname(full_fileName):
+            raise ValueError("SparseVolumes are saved as {0} files, not {1}".format(SPARSE_EXT, full_fileName))
+        save = np.savez_compressed if COMPRESS else np.savez
+        save(full_fileName, indices=self.indices, values=self.values, shape=np.array(self.shape),
+             affine=self.affine)
+        return full_fileName
+
+    def to_dense(self, dtype=None, fill_value=0):
+        """
+        Full array of the volume (voxels that are not in the list are fill_value)
+        """
+        import numpy as np
+        if dtype is None:
+            dtype = self.dtype
+        d = np.full(self.shape, fill_value, dtype=dtype)
+        d.ravel()[self.indices] = self.values
+        return d
+
+    def to_img(self, dtype=None):
+        """
+        Nifti1Image of the dense volume
+        """
+        import nibabel as nb
+        d = self.to_dense(dtype=dtype)
+        img = nb.Nifti1Image(d, self.affine)
+        img.set_data_dtype(d.dtype)
+        return img
+
+    def get_coordinates(self):
+        """
+        Voxel coordinates of the nonzero voxels, array of shape (nnz, ndim)
+        """
+        import numpy as np
+        return np.column_stack(np.unravel_index(self.indices, self.shape))
+
+
+def is_sparse_fname(full_fileName):
+    """
+    True if full_fileName is (the name of) a saved SparseVolume
+    """
+    return isinstance(full_fileName, basestring) and full_fileName.endswith(SPARSE_EXT)
+
+
+def is_sparse(img):
+    """
+    True for SparseVolumes and the file names of saved SparseVolumes
+    """
+    return isinstance(img, SparseVolume) or is_sparse_fname(img)
+
+
+def load_sparse(img):
+    """
+    SparseVolume from a SparseVolume (returned as is), a saved SparseVolume (.npz), or an image file
+    """
+    if isinstance(img, SparseVolume):
+        return img
+    return SparseVolume.from_file(img)
+
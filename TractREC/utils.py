@@ -21,6 +21,38 @@ def natural_sort(l):
     return sorted(l, key=alphanum_key)
 
 
+def get_label_dtype(max_label, min_label=0):
+    """
+    Smallest integer dtype that can hold labels from min_label to max_label
+    Unsigned (uint8, uint16, uint32, uint64) unless there are negative labels, then signed (int8 ... int64)
+    """
+    import numpy as np
+    if min_label >= 0:
+        candidates = [np.uint8, np.uint16, np.uint32, np.uint64]
+    else:
+        candidates = [np.int8, np.int16, np.int32, np.int64]
+    for dtype in candidates:
+        if min_label >= np.iinfo(dtype).min and max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError("Label range {0} to {1} does not fit in any integer dtype".format(min_label, max_label))
+
+
+def cast_labels(d):
+    """
+    Copy of a label array in the smallest integer dtype that holds its values (see get_label_dtype)
+    Non-integer values are truncated, as with d.astype(int)
+    """
+    import numpy as np
+    d = np.asanyarray(d)
+    if d.size == 0:
+        return d.astype(np.uint8)
+    min_label = d.min()
+    max_label = d.max()
+    if not (np.isfinite(min_label) and np.isfinite(max_label)):  # nan/inf, keep the old behaviour
+        return d.astype(int)
+    return d.astype(get_label_dtype(int(max_label), int(min_label)))
+
+
 def mask2voxelList(mask_img, out_file = None, coordinate_space = 'scanner', mask_threshold = 0, decimals = 2):
     """
     Calculate coordinates for all voxels greater than mask threshold
@@ -88,12 +120,12 @@ def generate_cubed_masks(mask_img, cubed_subset_dim, max_num_labels_per_mask = N
     aff = img.affine
     header = img.header
 
-    cubed_3d = get_cubed_array_labels_3d(np.shape(d), cubed_subset_dim).astype(np.uint32)
+    cubed_3d = get_cubed_array_labels_3d(np.shape(d), cubed_subset_dim)
     d = np.multiply(d, cubed_3d) # apply the cube to the data
 
     #extremely fast way to replace values, suggested here: http://stackoverflow.com/questions/13572448/change-values-in-a-numpy-array
     palette = np.unique(d) #INCLUDES 0
-    key = np.arange(0,len(palette))
+    key = np.arange(0,len(palette), dtype=get_label_dtype(len(palette)))
     index = np.digitize(d.ravel(), palette, right=True)
     d = key[index].reshape(d.shape)
 
@@ -114,13 +146,11 @@ def generate_cubed_masks(mask_img, cubed_subset_dim, max_num_labels_per_mask = N
         #return all_sets, num_sub_arrays, cube_labels_split
         for set in all_sets:
             superset = np.concatenate((cube_labels_split[set[0]], cube_labels_split[set[1]]), axis=0) #contains labels
-            d_temp = np.zeros(d.shape)
             new_idx = start_idx
 
             # this has been checked, and returns identical indices as with a simple loop
-            all_idxs = np.copy(non_zero_labels)
-            all_idxs[np.logical_not(np.in1d(non_zero_labels, superset))] = 0 #where our indices are not in the superset, set to 0
-            all_idxs[np.in1d(non_zero_labels, superset)] = np.arange(0,len(superset)) + start_idx #where they are in the index, reset them to increasing
+            all_idxs = np.zeros(len(non_zero_labels), dtype=get_label_dtype(len(superset) + start_idx))
+            all_idxs[np.in1d(non_zero_labels, superset)] = np.arange(0,len(superset)) + start_idx #where they are in the index, reset them to increasing (0 elsewhere)
             key = all_idxs #this is the vector of values that will be populated into the matrix
             palette = non_zero_labels
             index = np.digitize(d.ravel(), palette, right=True)
@@ -139,8 +169,8 @@ def generate_cubed_masks(mask_img, cubed_subset_dim, max_num_labels_per_mask = N
             print(out_file)
             print(out_file_lut)
 
-            img_out = nb.Nifti1Image(d_temp.astype(np.uint64), aff, header=header)
-            img_out.set_data_dtype("uint64")
+            img_out = nb.Nifti1Image(d_temp, aff, header=header)
+            img_out.set_data_dtype(d_temp.dtype)
             # print("Max label value/num voxels: {}".format(str(start_idx)))
             nb.loadsave.save(img_out, out_file)
             np.savetxt(out_file_lut, superset, delimiter=",", fmt="%d",header="value") #not the voxel locations, just the LUT TODO:change!
@@ -150,7 +180,7 @@ def generate_cubed_masks(mask_img, cubed_subset_dim, max_num_labels_per_mask = N
         all_out_files = out_file_base+"_all_.nii.gz"
         all_out_files_luts = None
     img = nb.Nifti1Image(d,aff,header)
-    img.set_data_dtype("uint64")
+    img.set_data_dtype(d.dtype)
     nb.save(img,out_file_base+"_all.nii.gz")
     print(out_file_base+"_all.nii.gz")
     return all_out_files, all_out_files_luts
@@ -202,30 +232,35 @@ def generate_connectome_nodes(mask_img, include_mask_img = None, cubed_subset_di
         print(out_file_base)
 
     img = nb.loadsave.load(mask_img)
-    d = img.get_data().astype(np.uint64)
+    d = img.get_data()
     aff = img.affine
     header = img.header
+    max_label = start_idx + np.sum(d == 1) # largest label we could create (one per voxel), so we know what dtype fits
 
     if include_mask_img is not None:
         img2 = nb.loadsave.load(include_mask_img)
-        d2 = img2.get_data().astype(np.uint64)
+        d2 = img2.get_data()
+        max_label = max_label + np.sum(d2 == 1)
+        d2 = d2.astype(get_label_dtype(max(max_label, np.max(d2))))
+    d = d.astype(get_label_dtype(max(max_label, np.max(d))))
 
     if cubed_subset_dim is not None:
         print("Generating labels and LUT file for cubed indices. This may take a while if you have many indices.")  # TODO: make this faster
-        cubed_3d = get_cubed_array_labels_3d(np.shape(d), cubed_subset_dim).astype(np.uint32)
+        cubed_3d = get_cubed_array_labels_3d(np.shape(d), cubed_subset_dim)
         d = np.multiply(d, cubed_3d) # apply the cube to the data
 
         #extremely fast way to replace values, suggested here: http://stackoverflow.com/questions/13572448/change-values-in-a-numpy-array
         palette = np.unique(d) #INCLUDES 0
-        key = np.arange(0,len(palette))
+        key = np.arange(0,len(palette), dtype=get_label_dtype(len(palette)))
         index = np.digitize(d.ravel(), palette, right=True)
         d = key[index].reshape(d.shape)
 
         if include_mask_img is not None:
             d2 = np.multiply(d2, cubed_3d)
             palette2 = np.unique(d2)  # INCLUDES 0
-            key = np.arange(0, len(palette2))
+            key = np.arange(0, len(palette2), dtype=get_label_dtype(len(palette2) + np.max(d)))
             key[1:] = key[1:] + np.max(d) #create the offset in the labels
+            d = d.astype(key.dtype) #so that the offset labels fit when we overwrite d with them below
             wm_first_label = np.max(d)+1
             wm_label_count = len(palette2)-1
             index = np.digitize(d2.ravel(), palette2, right=True)
@@ -234,7 +269,7 @@ def generate_connectome_nodes(mask_img, include_mask_img = None, cubed_subset_di
 
             #need to do this again in case we overwrote an index TODO: better way to do this?
             palette = np.unique(d) #INCLUDES 0
-            key = np.arange(0,len(palette))
+            key = np.arange(0,len(palette), dtype=get_label_dtype(len(palette)))
             wm_remapped_label = key[palette == wm_first_label]
             #save the new first label and number of labels for the second mask (wm)
             np.savetxt(out_file_base + "_subset_" + str(0).zfill(zfill_num) + "_" + str(0).zfill(zfill_num) + "_labels_lut_all_labels_wm_start_val_num.txt", np.array([wm_remapped_label,wm_label_count]), fmt = "%i")
@@ -290,7 +325,7 @@ def generate_connectome_nodes(mask_img, include_mask_img = None, cubed_subset_di
 
             #need to do this again in case we overwrote an index TODO: better way to do this?
             palette = np.unique(d) #INCLUDES 0
-            key = np.arange(0,len(palette))
+            key = np.arange(0,len(palette), dtype=get_label_dtype(len(palette)))
             wm_remapped_label = key[palette == wm_first_label]
             np.savetxt(out_file_base + "_subset_" + str(0).zfill(zfill_num) + "_" + str(0).zfill(zfill_num) + "_labels_lut_all_labels_wm_start_val_num.txt", np.array([wm_remapped_label,wm_label_count]), fmt = "%i")
             index = np.digitize(d.ravel(), palette, right=True)
@@ -320,7 +355,7 @@ def generate_connectome_nodes(mask_img, include_mask_img = None, cubed_subset_di
     np.savetxt(out_file_lut, lut[:,0].astype(int), delimiter=",", fmt="%d",header="index_label")
 
     img = nb.Nifti1Image(d, aff, header)
-    img.set_data_dtype("uint64")
+    img.set_data_dtype(d.dtype)
     nb.save(img, out_file_base + "_subset_" + str(0).zfill(zfill_num) + "_" + str(0).zfill(zfill_num) + "_all.nii.gz")
     print(out_file_base + "_subset_" + str(0).zfill(zfill_num) + "_" + str(0).zfill(zfill_num) + "_all.nii.gz")
 
@@ -342,12 +377,10 @@ def generate_connectome_nodes(mask_img, include_mask_img = None, cubed_subset_di
             idx += 1
             print("\nGenerating set {0} of {1} sets".format(idx,len(all_sets)))
             superset = np.concatenate((cube_labels_split[set[0]], cube_labels_split[set[1]]), axis=0) #contains labels
-            d_temp = np.zeros(d.shape)
 
             # this has been checked, and returns identical indices as with a simple loop
-            all_idxs = np.copy(non_zero_labels)
-            all_idxs[np.logical_not(np.in1d(non_zero_labels, superset))] = 0 #where our indices are not in the superset, set to 0
-            all_idxs[np.in1d(non_zero_labels, superset)] = np.arange(0,len(superset)) + start_idx #where they are in the index, reset them to increasing
+            all_idxs = np.zeros(len(non_zero_labels), dtype=get_label_dtype(len(superset) + start_idx))
+            all_idxs[np.in1d(non_zero_labels, superset)] = np.arange(0,len(superset)) + start_idx #where they are in the index, reset them to increasing (0 elsewhere)
             key = all_idxs #this is the vector of values that will be populated into the matrix
             palette = non_zero_labels
             index = np.digitize(d.ravel(), palette, right=True)
@@ -363,8 +396,8 @@ def generate_connectome_nodes(mask_img, include_mask_img = None, cubed_subset_di
                 print(out_file)
                 print(out_file_lut)
 
-            img_out = nb.Nifti1Image(d_temp.astype(np.uint64), aff, header=header)
-            img_out.set_data_dtype("uint64")
+            img_out = nb.Nifti1Image(d_temp, aff, header=header)
+            img_out.set_data_dtype(d_temp.dtype)
             nb.loadsave.save(img_out, out_file)
             np.savetxt(out_file_lut, superset, delimiter=",", fmt="%d",header="index_label") #not the voxel locations, just the LUT TODO:change? requires change in matrix combination
             all_out_files.append(out_file)
@@ -554,7 +587,7 @@ def tck2connectome_collection(tck_file, node_files, tck_weights_file = None, ass
     """
 
     :param tck_file:
-    :param node_files:
+    :param node_files:      node image(s), saved SparseVolumes (.npz) are written to a temporary .nii.gz for mrtrix
     :param tck_weights_file:
     :param assign_all_mask_img:    if not None, then we change the call to include all voxels in the mask rather than just endpoints (useful for inclusion of wm mask)
                                 automatically runs -assignment_all_voxels AND -assignment_end_voxels (files in 0, 1 of returned variable respectively)
@@ -564,13 +597,18 @@ def tck2connectome_collection(tck_file, node_files, tck_weights_file = None, ass
     """
     import subprocess
     import os
+    import tempfile
+    import sparse_volume as spv
     out_files = []
     out_files_assignEnd = []
     if not isinstance(node_files,list):
         node_files = [node_files] #make iterable
     for idx, node_file in enumerate(node_files):
         out_file = node_file.split(".")[0]
-        cmd = ["/home/chris/Documents/code/mrtrix3_devel/bin/tck2connectome", tck_file, node_file,
+        node_img = node_file
+        if spv.is_sparse_fname(node_file): #mrtrix needs an image, made dense only for as long as it runs
+            node_img = os.path.join(tempfile.mkdtemp(), os.path.basename(out_file) + ".nii.gz")
+        cmd = ["/home/chris/Documents/code/mrtrix3_devel/bin/tck2connectome", tck_file, node_img,
                "-nthreads", str(nthreads), "-force"]
         cmd_assignEnd = list(cmd) #need to copy the list, otherwise we share it :-(
         if tck_weights_file is not None:
@@ -597,10 +635,14 @@ def tck2connectome_collection(tck_file, node_files, tck_weights_file = None, ass
             if not CLOBBER:
                 print("The file already exists, not recreating it. (set CLOBBER=True if you want to overwrite)")
         else:
-            pass
+            if node_img is not node_file:
+                spv.load_sparse(node_file).to_img().to_filename(node_img)
             subprocess.call(cmd)
             if assign_all_mask_img is not None:
                 subprocess.call(cmd_assignEnd)
+        if node_img is not node_file:
+            import shutil
+            shutil.rmtree(os.path.dirname(node_img))
         out_files.append(out_file)
     if assign_all_mask_img is not None:
         return [out_files_assignEnd, out_files]
@@ -608,13 +650,15 @@ def tck2connectome_collection(tck_file, node_files, tck_weights_file = None, ass
         return out_files
 
 def mask2labels_multifile(mask_img, out_file_base = None, max_num_labels_per_mask = 1000, output_lut_file = False,
-                          decimals = 2, start_idx = 1, coordinate_space = "scanner", cubed_subset_dim = None):
+                          decimals = 2, start_idx = 1, coordinate_space = "scanner", cubed_subset_dim = None,
+                          SPARSE = False):
     """
     Convert simple binary mask to voxels that are labeled from 1..n.
-    Outputs as uint32 in the hopes that you don't have over the max (4294967295)
-    (i don't check, that is a crazy number of voxels...)
-    :param mask_img:        any 3d image format that nibabel can read
+    Outputs in the smallest unsigned integer type that holds the labels (see get_label_dtype)
+    :param mask_img:        any 3d image format that nibabel can read, or a SparseVolume/saved SparseVolume (.npz)
     :param out_file_base:   nift1 format, base file name will be appended with voxel parcels _?x?.nii.gz
+    :param SPARSE:          write the label files as SparseVolumes (_?x?.npz, see sparse_volume.py), since each holds
+                            only a few labelled voxels
     :param output_lut_file  ouptut a lut csv file for all voxels True/False (this could be large!)
     :param decimals:        number of decimals for output lut file
     :param start_idx:       value to start index at, normally =1, unless you are combining masks...?
@@ -624,30 +668,38 @@ def mask2labels_multifile(mask_img, out_file_base = None, max_num_labels_per_mas
     import nibabel as nb
     import numpy as np
     import itertools
+    import sparse_volume as spv
 
     if out_file_base is None:
         import os
         out_file_base = os.path.join(os.path.dirname(mask_img),os.path.basename(mask_img).split(".")[0]+"_index_label")
 
-    img = nb.loadsave.load(mask_img)
-    d = img.get_data().astype(np.uint64)
-    aff = img.affine
-    header = img.header
+    if spv.is_sparse(mask_img):
+        mask_vol = spv.load_sparse(mask_img)
+        d = mask_vol.to_dense()
+        aff = mask_vol.affine
+        header = None
+    else:
+        img = nb.loadsave.load(mask_img)
+        d = img.get_data()
+        aff = img.affine
+        header = img.header
 
     all_vox_locs = np.array(np.where(d==1)).T
     num_vox = np.shape(all_vox_locs)[0]
+    d = d.astype(get_label_dtype(max(num_vox + start_idx, np.max(d)))) #largest label that we can create is one per voxel
 
     if cubed_subset_dim is not None and cubed_subset_dim > 1:
         print("Generating cubed subsets of your binary input mask")
         cubed_3d = get_cubed_array_labels_3d(np.shape(d),cubed_subset_dim)
-        d = np.multiply(d, cubed_3d).astype(np.uint32) #apply the cube to the data
+        d = cast_labels(np.multiply(d, cubed_3d)) #apply the cube to the data
         # #print(np.unique(d))
         # for idx, val in enumerate(np.unique(d)):
         #     d[d==val] = idx + start_idx #move back to values based on start_idx (usually 1)
 
         #extremely fast way of re-assigning values
         palette = np.unique(d)
-        key = np.arange(0, len(palette)) + start_idx - 1 #offset as required
+        key = np.arange(0, len(palette), dtype=get_label_dtype(len(palette) + start_idx)) + start_idx - 1 #offset as required
         key[0] = 0 #retain 0 as the first index, since this is background
         key[0] = 0 #retain 0 as the first index, since this is background
         index = np.digitize(d.ravel(), palette, right=True)
@@ -670,7 +722,10 @@ def mask2labels_multifile(mask_img, out_file_base = None, max_num_labels_per_mas
         fir = subset[0]
         sec = subset[1]
         tail = "_label_subset_" + str(fir) + "_" + str(sec)
-        out_file = out_file_base + tail + ".nii.gz"
+        if SPARSE:
+            out_file = out_file_base + tail + spv.SPARSE_EXT
+        else:
+            out_file = out_file_base + tail + ".nii.gz"
         out_file_lut = out_file_base + tail + "_coords.csv"
         print(out_file)
         print(out_file_lut)
@@ -684,17 +739,19 @@ def mask2labels_multifile(mask_img, out_file_base = None, max_num_labels_per_mas
             for superset_idx in superset:
                 d[d_orig == superset_idx] = label_idx
                 label_idx += 1
-            d = d.astype(np.uint64)
         else:
             superset = np.concatenate((sub_vox_locs[fir], sub_vox_locs[sec]), axis = 0)
             for vox in superset:
                 d[vox[0], vox[1], vox[2]] = label_idx
                 label_idx += 1
 
-        img_out = nb.Nifti1Image(d, aff, header=header)
-        img_out.set_data_dtype("uint64")
-        #print("Max label value/num voxels: {}".format(str(start_idx)))
-        nb.loadsave.save(img_out, out_file)
+        if SPARSE:
+            spv.SparseVolume.from_dense(d, aff).save(out_file)
+        else:
+            img_out = nb.Nifti1Image(d, aff, header=header)
+            img_out.set_data_dtype(d.dtype)
+            #print("Max label value/num voxels: {}".format(str(start_idx)))
+            nb.loadsave.save(img_out, out_file)
 
         if coordinate_space is "voxel":
             np.savetxt(out_file_lut, superset, delimiter=",", fmt="%d")
@@ -713,15 +770,16 @@ def get_cubed_array_labels_3d(shape, cube_subset_dim = 10):
     Break a 3d array into cubes of cube_dim. Throw away extras if array is not a perfect cube
     :param shape:              - 3d matrix shape
     :param cube_subset_dim:    - size, in voxels, of one dimension of cube
-    :return:                   - matrix of labeled cubes (or appx) of size cube_dim*cube_dim*cube_dim
+    :return:                   - matrix of labeled cubes (or appx) of size cube_dim*cube_dim*cube_dim, in the smallest
+                                 unsigned integer type that holds the cube labels
     """
     import numpy as np
 
 
-    #we make the matrix cubic to make the calculations easier, toss out the extras at the end
+    #we number the cubes as if the matrix was cubic to make the calculations easier, cubes outside of shape are skipped
     max_dim = np.max(shape)
     num_cubes_per_dim = np.ceil(max_dim / cube_subset_dim).astype(int)
-    d = np.zeros((max_dim,max_dim,max_dim))
+    d = np.zeros(shape[0:3], dtype=get_label_dtype(num_cubes_per_dim ** 3))
 
     #determine the size of each cube based on the number of cubes that we will cut the supercube into (yes, this is basically the reverse of above)
     x_span = np.ceil(max_dim / num_cubes_per_dim).astype(int)
@@ -737,8 +795,8 @@ def get_cubed_array_labels_3d(shape, cube_subset_dim = 10):
                 x0 = ix*x_span
                 y0 = iy*y_span
                 z0 = iz*z_span
-                d[x0 : x0 + x_span, y0 : y0 + y_span, z0 : z0 + z_span] = cube_idx
-    return (d[0:shape[0],0:shape[1],0:shape[2]]).astype(np.uint64) #return only the dims that we requested, discard the extras at the edges
+                d[x0 : x0 + x_span, y0 : y0 + y_span, z0 : z0 + z_span] = cube_idx #slices past the edge of shape are empty
+    return d
 
 def gmwmvox2mesh(mask_img, mesh_format = "obj"):
     from skimage import measure
@@ -754,8 +812,7 @@ def gmwmvox2mesh(mask_img, mesh_format = "obj"):
 def mask2labels(mask_img, out_file = None, output_lut_file = False, decimals = 2, start_idx = 1):
     """
     Convert simple binary mask to voxels that are labeled from 1..n.
-    Outputs as uint64 in the hopes that you don't have over the max (4294967295)
-    (i don't check, that is a crazy number of voxels!)
+    Outputs in the smallest unsigned integer type that holds the labels (see get_label_dtype)
     :param mask_img:        any 3d image format that nibabel can read
     :param out_file:        nift1 format
     :param output_lut_file  ouptut a lut csv file for all voxels True/False (this could be large!)
@@ -771,11 +828,12 @@ def mask2labels(mask_img, out_file = None, output_lut_file = False, decimals = 2
         out_file = os.path.join(os.path.dirname(mask_img),os.path.basename(mask_img).split(".")[0]+"_index_label.nii.gz")
 
     img = nb.loadsave.load(mask_img)
-    d = img.get_data().astype(np.uint64)
+    d = img.get_data()
     aff = img.affine
     header = img.header
 
     vox_locs = np.array(np.where(d==1)).T
+    d = d.astype(get_label_dtype(max(len(vox_locs) + start_idx, np.max(d)))) #largest label that we can create is one per voxel
     for vox in vox_locs:
         d[vox[0], vox[1], vox[2]] = start_idx
         start_idx += 1
@@ -790,7 +848,7 @@ def mask2labels(mask_img, out_file = None, output_lut_file = False, decimals = 2
         np.savetxt(lut_file, lut, header = "index,x_coord,y_coord,z_coord",delimiter=",",fmt="%." + str(decimals) +"f")
 
     img_out = nb.Nifti1Image(d, aff, header=header)
-    img_out.set_data_dtype("uint64")
+    img_out.set_data_dtype(d.dtype)
     print("Max label value/num voxels: {}".format(str(start_idx)))
     nb.loadsave.save(img_out,out_file)
     return out_file, start_idx
@@ -852,29 +910,39 @@ def plot_coo_matrix(m):
     ax.set_yticks([])
     return fig
 
-def matrix2voxel_map(label_idxs, sparse_matrix_file, lut_file, template_node_img, out_file_base = None, apply_inv_affine = False):
+def matrix2voxel_map(label_idxs, sparse_matrix_file, lut_file, template_node_img, out_file_base = None, apply_inv_affine = False,
+                     SPARSE = False):
     """
     Create visitation map or maps for single or multiple seed labels from template_node_img
     :param label_idxs:          label or labels (from template_node_img / lut) to visualise connectivity for, output will be in separate files
     :param sparse_matrix_file:  the matrix that we are to pull the data from
     :param lut_file:            look up table of indices and voxel locations (only currently used to confirm that sparse matrix is the correct size, not checking location at the moment)
     :param template_node_img:   the full image that was used to create the matrix that the label is being extracted from
+                                (or a SparseVolume/saved SparseVolume (.npz) of it)
     :param out_file:            output full filename, leave blank for auto-generated filename in same location as template_node_img
+    :param SPARSE:              write the maps as SparseVolumes (.npz, see sparse_volume.py) rather than .nii.gz
     :return:
     """
     import nibabel as nb
     from scipy import io, sparse
     import numpy as np
     from pandas import read_csv
+    import sparse_volume as spv
 
     if out_file_base is None:
         out_file_base = template_node_img.split(".")[0] + "_cnctm_label_"
 
-    img = nb.load(template_node_img)
-    aff = img.affine
-    header = img.header
-
-    d_orig = img.get_data()
+    if spv.is_sparse(template_node_img): #only the labelled voxels are mapped
+        node_vol = spv.load_sparse(template_node_img)
+        aff = node_vol.affine
+        header = None
+        d_orig = node_vol.values
+    else:
+        node_vol = None
+        img = nb.load(template_node_img)
+        aff = img.affine
+        header = img.header
+        d_orig = img.get_data()
 
     lut_file = read_csv(lut_file, sep=" ", header = 0).values
 
@@ -892,7 +960,10 @@ def matrix2voxel_map(label_idxs, sparse_matrix_file, lut_file, template_node_img
     for label_idx in label_idxs:
         print("  label index: {}".format(label_idx))
         d = np.copy(d_orig)
-        out_file = out_file_base + str(label_idx) + "_map.nii.gz"
+        if SPARSE:
+            out_file = out_file_base + str(label_idx) + "_map" + spv.SPARSE_EXT
+        else:
+            out_file = out_file_base + str(label_idx) + "_map.nii.gz"
         res = np.zeros(mat.shape[0])
 
         # order the vector so that it follows the ordering of the lut (0..n)
@@ -902,15 +973,24 @@ def matrix2voxel_map(label_idxs, sparse_matrix_file, lut_file, template_node_img
         if not (lut_file.shape[0] == len(res)):
             print("Shit, something went wrong! Your lut and matrix don't seem to match")
 
-        palette= np.unique(d)  # INCLUDES 0
+        palette= np.unique(d)  # INCLUDES 0 (unless the template is sparse)
         key = np.zeros(palette.shape)
-        key[1:] = res #leave the 0 for the first index, i.e., background
+        key[palette != 0] = res #leave the 0 for the first index, i.e., background
         index = np.digitize(d.ravel(), palette, right=True)
         d = key[index].reshape(d.shape)
 
-        img_out = nb.Nifti1Image(d,aff,header = header)
-        img_out.set_data_dtype('float32')
-        nb.save(img_out,out_file)
+        if node_vol is not None:
+            d = spv.SparseVolume(node_vol.indices, d.astype(np.float32), node_vol.shape, aff)
+        elif SPARSE:
+            d = spv.SparseVolume.from_dense(d.astype(np.float32), aff)
+        if SPARSE:
+            d.save(out_file)
+        else:
+            if node_vol is not None:
+                d = d.to_dense()
+            img_out = nb.Nifti1Image(d,aff,header = header)
+            img_out.set_data_dtype('float32')
+            nb.save(img_out,out_file)
         out_files.append(out_file)
         print("  {}\n".format(out_file))
     return out_files
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Memory used by label volumes in the old (int64/uint64/float64) and compact (utils.get_label_dtype) representations
+Uses a synthetic atlas of the size of a 0.5mm MNI volume by default and reports peak allocations (tracemalloc) for
+    - casting an atlas to integer labels (extract_stats_from_masked_image)
+    - building the cube label volume (get_cubed_array_labels_3d, used by the connectome node tools)
+    - labelling every voxel of a binary mask (mask2labels)
+
+    python bench_label_dtype.py --shape 362 434 362 --n_labels 400
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+
+import numpy as np
+import nibabel as nb
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TractREC'))
+import utils
+
+
+def peak_mb(fun, *args, **kwargs):
+    tracemalloc.start()
+    res = fun(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return res, peak / 1024.0 ** 2
+
+
+def cubed_labels_float64(shape, cube_subset_dim):
+    # what get_cubed_array_labels_3d used to do: a float64 supercube of the largest dimension, cropped and cast to uint64
+    max_dim = np.max(shape)
+    num_cubes_per_dim = np.ceil(max_dim / cube_subset_dim).astype(int)
+    d = np.zeros((max_dim, max_dim, max_dim))
+    span = np.ceil(max_dim / num_cubes_per_dim).astype(int)
+    cube_idx = 0
+    for ix in np.arange(0, num_cubes_per_dim):
+        for iy in np.arange(0, num_cubes_per_dim):
+            for iz in np.arange(0, num_cubes_per_dim):
+                cube_idx += 1
+                d[ix * span:(ix + 1) * span, iy * span:(iy + 1) * span, iz * span:(iz + 1) * span] = cube_idx
+    return (d[0:shape[0], 0:shape[1], 0:shape[2]]).astype(np.uint64)
+
+
+def report(name, old, new):
+    print("{0:<28} old: {1:8.1f}MB   compact: {2:8.1f}MB   ({3:.1f}x less)".format(name, old, new, old / new))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--shape', type=int, nargs=3, default=[362, 434, 362])
+    parser.add_argument('--n_labels', type=int, default=400)
+    parser.add_argument('--cube_dim', type=int, default=10)
+    parser.add_argument('--mask_vox', type=int, default=200000, help='number of voxels in the binary mask')
+    args = parser.parse_args()
+    shape = tuple(args.shape)
+    rng = np.random.RandomState(0)
+    print("Volume: {0} ({1:.1f}M voxels)".format(shape, np.prod(shape) / 1e6))
+
+    # atlas stored as float32 (as many label files are), slabs of labels along z
+    atlas = (np.arange(shape[2]) * args.n_labels // shape[2] + 1).astype(np.float32)[None, None, :] * \
+        np.ones(shape, dtype=np.float32)
+    old, old_mb = peak_mb(lambda d: d.astype(int), atlas)
+    new, new_mb = peak_mb(utils.cast_labels, atlas)
+    assert np.array_equal(old, new)
+    report("atlas labels ({0})".format(new.dtype), old_mb, new_mb)
+    del atlas, old, new
+
+    old, old_mb = peak_mb(cubed_labels_float64, shape, args.cube_dim)
+    new, new_mb = peak_mb(utils.get_cubed_array_labels_3d, shape, args.cube_dim)
+    assert np.array_equal(old, new)
+    report("cube labels ({0})".format(new.dtype), old_mb, new_mb)
+    del old, new
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        mask = np.zeros(shape, dtype=np.uint8)
+        mask.flat[rng.choice(mask.size, args.mask_vox, replace=False)] = 1
+        mask_fname = os.path.join(tmp_dir, 'mask.nii.gz')
+        nb.Nifti1Image(mask, np.eye(4)).to_filename(mask_fname)
+        out_fname, _ = utils.mask2labels(mask_fname)
+        out_img = nb.load(out_fname)
+        new_mb = np.prod(shape) * out_img.get_data_dtype().itemsize / 1024.0 ** 2
+        report("mask2labels ({0})".format(out_img.get_data_dtype()), np.prod(shape) * 8 / 1024.0 ** 2, new_mb)
+        print("mask2labels file size: {0:.1f}MB".format(os.path.getsize(out_fname) / 1024.0 ** 2))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
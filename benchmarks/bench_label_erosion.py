@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Time the per-label erosion of extract_stats_from_masked_image (erode_labels, each label eroded within its bounding
+box) against the previous loop (a full-volume erosion and several full-volume comparisons per label) on a synthetic
+atlas of small labels in a large volume (e.g., cerebellar lobules at 0.7mm), and check that both give the same labels
+
+    python bench_label_erosion.py --shape 260 311 260 --n_labels 30 --erode_vox 1 --n_jobs 1
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TractREC'))
+import TractREC as tr
+
+
+def full_volume_loop(mask, mask_ids, erode_vox):
+    # what the erosion loop of extract_stats_from_masked_image used to do
+    single_mask = np.zeros_like(mask)
+    for mask_id in mask_ids:
+        single_mask[mask == mask_id] = 1
+        temp_mask = np.copy(single_mask)
+        single_mask = tr.erode_mask(single_mask, erode_vox)
+        temp_mask[np.logical_and(mask == mask_id, single_mask == 0)] = 0
+        if np.sum(temp_mask) > 0:
+            mask[np.logical_and(mask == mask_id, single_mask == 0)] = 0
+        single_mask = single_mask * 0
+    return mask
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--shape', type=int, nargs=3, default=[260, 311, 260])
+    parser.add_argument('--n_labels', type=int, default=30)
+    parser.add_argument('--erode_vox', type=int, default=1)
+    parser.add_argument('--n_jobs', type=int, default=1, help='labels eroded at the same time (threads)')
+    args = parser.parse_args()
+    shape = tuple(args.shape)
+    rng = np.random.RandomState(0)
+
+    # blocky labels filling a box of ~1/4 of each dimension at the back of the volume (cerebellum-like)
+    box = [dim // 4 for dim in shape]
+    coarse = rng.randint(1, args.n_labels + 1, size=[int(np.ceil(dim / 6.0)) for dim in box])
+    region = np.kron(coarse, np.ones((6, 6, 6), dtype=np.uint8))[:box[0], :box[1], :box[2]]
+    atlas = np.zeros(shape, dtype=np.uint8)
+    start = [dim // 2 - b // 2 for dim, b in zip(shape, box)]
+    start[1] = shape[1] // 8
+    atlas[start[0]:start[0] + box[0], start[1]:start[1] + box[1], start[2]:start[2] + box[2]] = region
+    mask_ids = np.unique(atlas)[1:]
+    print("Volume: {0}, {1} labels, {2} labelled voxels".format(shape, len(mask_ids), np.count_nonzero(atlas)))
+
+    ref = atlas.copy()
+    t = time.time()
+    full_volume_loop(ref, mask_ids, args.erode_vox)
+    t_old = time.time() - t
+
+    new = atlas.copy()
+    t = time.time()
+    tr.erode_labels(new, mask_ids, args.erode_vox, n_jobs=args.n_jobs)
+    t_new = time.time() - t
+
+    print("full-volume loop: {0:6.2f}s".format(t_old))
+    print("bounding boxes:   {0:6.2f}s  {1:.1f}x".format(t_new, t_old / t_new))
+    print("same labels: {0}".format(np.array_equal(ref, new)))
+
+
+if __name__ == '__main__':
+    main()
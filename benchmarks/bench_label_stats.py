@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Time extract_stats_from_masked_image on a synthetic atlas with many labels, against the previous per-label loop
+(one full-volume masked array and np.where per label), and check that both give the same results
+
+    python bench_label_stats.py --shape 182 218 182 --n_labels 150
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+import numpy as np
+import nibabel as nb
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TractREC'))
+import TractREC as tr
+
+
+def per_label_loop(d, mask, mask_ids, nonzero_stats=True, min_val=None, max_val=None):
+    # what the label loop of extract_stats_from_masked_image used to do (vox_vol=1)
+    out = []
+    mask = mask.copy()
+    for mask_id in mask_ids:
+        dx = np.ma.masked_array(d, np.ma.make_mask(np.logical_not(mask == mask_id))).compressed()
+        if nonzero_stats:
+            dx = dx[dx > 0]
+            mask[d == 0] = 0
+        if max_val is not None:
+            dx[dx > max_val] = max_val
+        if min_val is not None:
+            dx[dx < min_val] = min_val
+        if len(dx) == 0:
+            dx = np.array([0])
+        np.column_stack(np.where(mask == mask_id))
+        out.append([np.mean(dx, dtype=np.float64), np.median(dx), np.std(dx, dtype=np.float64), np.min(dx),
+                    np.max(dx), np.sum(dx, dtype=np.float64)])
+    return np.array(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--shape', type=int, nargs=3, default=[182, 218, 182])
+    parser.add_argument('--n_labels', type=int, default=150)
+    args = parser.parse_args()
+    shape = tuple(args.shape)
+    rng = np.random.RandomState(0)
+
+    # blocky atlas: random labels on a coarse grid, upsampled, with background around the edges
+    coarse = rng.randint(1, args.n_labels + 1, size=[int(np.ceil(dim / 8.0)) for dim in shape])
+    atlas = np.kron(coarse, np.ones((8, 8, 8), dtype=coarse.dtype))[:shape[0], :shape[1], :shape[2]]
+    atlas[:10] = 0
+    metric = rng.rand(*shape).astype(np.float32)
+    metric[rng.rand(*shape) < 0.2] = 0
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        metric_fname = os.path.join(tmp_dir, 'metric.nii')
+        atlas_fname = os.path.join(tmp_dir, 'atlas.nii')
+        nb.Nifti1Image(metric, np.eye(4)).to_filename(metric_fname)
+        nb.Nifti1Image(atlas.astype(np.int16), np.eye(4)).to_filename(atlas_fname)
+        print("Volume: {0}, {1} labels".format(shape, len(np.unique(atlas)) - 1))
+
+        start = time.time()
+        res = tr.extract_stats_from_masked_image(metric_fname, atlas_fname, min_val=0, max_val=0.9)
+        t_new = time.time() - start
+
+        start = time.time()
+        ref = per_label_loop(metric, atlas, res.label_val, min_val=0, max_val=0.9)
+        t_old = time.time() - start
+
+        new = np.column_stack([res.mean, res.median, res.std, res.minn, res.maxx, res.sum])
+        print("per-label loop: {0:6.2f}s  (label loop only)".format(t_old))
+        print("grouped:        {0:6.2f}s  (including loading)  {1:.1f}x".format(t_new, t_old / t_new))
+        print("same results: {0}".format(np.allclose(ref, new, rtol=1e-12)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Compare nibabel's single threaded .nii.gz read/write against imgLoad/niiSave with nthreads
+Writes a synthetic float32 volume (~1GB by default), checks that the parallel output is identical and readable by
+gzip/nibabel, and prints wall times
+
+    python bench_parallel_gzip.py --size_mb 1024 --nthreads 8 --compresslevel 1
+"""
+
+import os
+import sys
+import time
+import gzip
+import shutil
+import tempfile
+import argparse
+
+import numpy as np
+import nibabel as nb
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TractREC'))
+import TractREC as tr
+
+
+def make_volume(size_mb):
+    # smooth-ish data with some zeros, so it compresses like a real metric map rather than noise
+    nz = max(1, int(size_mb * 1024 ** 2 / (4 * 256 * 256)))
+    x = np.linspace(0, 4 * np.pi, 256, dtype=np.float32)
+    d = np.empty((256, 256, nz), dtype=np.float32)
+    for z in range(nz):
+        d[:, :, z] = np.sin(x)[:, None] * np.cos(x + z / 10.0)[None, :]
+    d[d < 0] = 0
+    return d
+
+
+def timed(fun, *args, **kwargs):
+    start = time.time()
+    res = fun(*args, **kwargs)
+    return res, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size_mb', type=int, default=1024)
+    parser.add_argument('--nthreads', type=int, default=None, help='default: all cpus')
+    parser.add_argument('--compresslevel', type=int, default=1)
+    parser.add_argument('--out_dir', default=None, help='default: a temporary directory (removed afterwards)')
+    args = parser.parse_args()
+
+    out_dir = args.out_dir or tempfile.mkdtemp()
+    d = make_volume(args.size_mb)
+    aff = np.eye(4)
+    print("Volume: {0} {1:.0f}MB".format(d.shape, d.nbytes / 1024.0 ** 2))
+    try:
+        ref_fname = os.path.join(out_dir, 'ref.nii.gz')
+        par_fname = os.path.join(out_dir, 'par.nii.gz')
+        img = nb.Nifti1Image(d, aff)
+        img.header['cal_min'] = d.min()  # same header as niiSave writes, so the files should decompress identically
+        img.header['cal_max'] = d.max()
+        _, t_nib_w = timed(img.to_filename, ref_fname)
+        _, t_par_w = timed(tr.niiSave, par_fname, d, aff, nthreads=args.nthreads, compresslevel=args.compresslevel)
+        ref, t_nib_r = timed(lambda f: np.asanyarray(nb.load(f).dataobj), ref_fname)
+        par, t_par_r = timed(tr.imgLoad, par_fname, nthreads=args.nthreads)
+        par = par[0]
+
+        print("write  nibabel: {0:6.2f}s  niiSave(nthreads): {1:6.2f}s  ({2:.2f}x)".format(t_nib_w, t_par_w,
+                                                                                         t_nib_w / t_par_w))
+        print("read   nibabel: {0:6.2f}s  imgLoad(nthreads): {1:6.2f}s  ({2:.2f}x)".format(t_nib_r, t_par_r,
+                                                                                         t_nib_r / t_par_r))
+        print("size   nibabel: {0:.0f}MB  parallel: {1:.0f}MB".format(os.path.getsize(ref_fname) / 1024.0 ** 2,
+                                                                   os.path.getsize(par_fname) / 1024.0 ** 2))
+
+        # the parallel file must be plain gzip to everybody else, and the parallel reader must read plain gzip
+        with gzip.open(par_fname, 'rb') as f_par, gzip.open(ref_fname, 'rb') as f_ref:
+            gz_ok = f_par.read() == f_ref.read()
+        print("identical data: {0}  gzip-compatible: {1}  nibabel reads parallel file: {2}  "
+              "imgLoad(nthreads) reads nibabel file: {3}".format(
+                np.array_equal(ref, par), gz_ok,
+                np.array_equal(np.asanyarray(nb.load(par_fname).dataobj), d),
+                np.array_equal(tr.imgLoad(ref_fname, nthreads=args.nthreads)[0], d)))
+    finally:
+        if args.out_dir is None:
+            shutil.rmtree(out_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of extract_stats_from_masked_image and extract_quantitative_metric on synthetic phantoms
+
+Writes a phantom cohort to a temporary directory for every resolution and label count of the sweep (an ellipsoidal
+brain in a 180x216x180mm field of view, parcellated into n_labels Voronoi labels shared by all subjects, one metric
+and one threshold map per subject, and the labels on a grid of twice the voxel size for the resampling option), then
+runs every combination of subject count and option in its own process:
+    - none:     plain extraction
+    - erode:    erode_vox=1
+    - thresh:   thresh_mask_files with thresh_val=0.5, thresh_type='lower'
+    - resample: labels on the coarser grid, resampled to the grid of the metric
+and reports the time of one subject (and per label), subjects per second over the cohort, and the peak RSS of the
+process (and of its workers when n_jobs > 1, sampled from /proc on Linux)
+
+Results are saved as json (with the git commit and library versions) so that runs can be compared between commits
+
+    python bench_phantom_suite.py --res 2 1 0.5 --n_labels 10 100 1000 --n_subjects 1 4 --out before.json
+    python bench_phantom_suite.py --quick --out after.json --compare before.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+import threading
+
+import numpy as np
+import nibabel as nb
+
+TRACTREC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TractREC')
+FOV = np.array([180., 216., 180.])  # mm
+OPTIONS = ['none', 'erode', 'thresh', 'resample']
+
+
+def get_affine(res):
+    affine = np.diag([res, res, res, 1.])
+    affine[:3, 3] = -FOV / 2 + res / 2.
+    return affine
+
+
+def make_labels(res, n_labels, rng):
+    """
+    Voronoi parcellation of an ellipsoid (computed on a 2mm grid, then mapped to res), 0 outside of it
+    """
+    from scipy.spatial import cKDTree
+    coarse_shape = (FOV / 2.).astype(int)
+    axes = [(np.arange(dim) + 0.5) * 2. - fov / 2 for dim, fov in zip(coarse_shape, FOV)]
+    seeds = rng.uniform(-0.4, 0.4, size=(n_labels * 4, 3)) * FOV
+    seeds = seeds[np.sum((seeds / (0.45 * FOV)) ** 2, axis=1) < 1][:n_labels]
+    grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+    coarse = (cKDTree(seeds).query(grid)[1] + 1).astype(np.int16).reshape(coarse_shape)
+
+    shape = np.round(FOV / res).astype(int)
+    index = [np.minimum(((np.arange(dim) + 0.5) * res // 2.).astype(int), coarse_dim - 1)
+             for dim, coarse_dim in zip(shape, coarse_shape)]
+    labels = coarse[np.ix_(*index)]
+    coords = [(np.arange(dim) + 0.5) * res - fov / 2 for dim, fov in zip(shape, FOV)]
+    brain = ((coords[0][:, None, None] / (0.45 * FOV[0])) ** 2 + (coords[1][None, :, None] / (0.45 * FOV[1])) ** 2 +
+             (coords[2][None, None, :] / (0.45 * FOV[2])) ** 2) < 1
+    labels[~brain] = 0
+    return labels
+
+
+def make_phantoms(out_dir, res, n_labels, n_subjects, options, ext='.nii', seed=0):
+    """
+    Write the phantom files of one resolution and label count, returns a dictionary of file lists
+    """
+    rng = np.random.RandomState(seed)
+    affine = get_affine(res)
+    labels = make_labels(res, n_labels, rng)
+    files = {'labels': os.path.join(out_dir, 'labels' + ext), 'metric': [], 'thresh': [],
+             'n_vox': int(labels.size), 'n_labels': int(len(np.unique(labels)) - 1), 'shape': list(labels.shape)}
+    nb.Nifti1Image(labels, affine).to_filename(files['labels'])
+    if 'resample' in options:
+        files['coarse_labels'] = os.path.join(out_dir, 'labels_coarse' + ext)
+        nb.Nifti1Image(labels[::2, ::2, ::2], get_affine(2 * res)).to_filename(files['coarse_labels'])
+
+    label_mean = rng.uniform(0.2, 0.8, size=n_labels + 1).astype(np.float32)
+    label_mean[0] = 0
+    x = np.arange(labels.shape[0]) * res
+    for subject in range(n_subjects):
+        metric = label_mean[labels] + rng.standard_normal(labels.shape).astype(np.float32) * 0.05
+        metric[labels == 0] = 0
+        np.clip(metric, 0, 1, out=metric)
+        files['metric'].append(os.path.join(out_dir, 'sub{0:03d}_metric{1}'.format(subject, ext)))
+        nb.Nifti1Image(metric, affine).to_filename(files['metric'][-1])
+        del metric
+        if 'thresh' in options:  # smooth "probability" map, about half of the brain above 0.5
+            thresh = (0.5 + 0.5 * np.sin(x / 10. + subject))[:, None, None] * np.ones(labels.shape, dtype=np.float32)
+            files['thresh'].append(os.path.join(out_dir, 'sub{0:03d}_thresh{1}'.format(subject, ext)))
+            nb.Nifti1Image(thresh.astype(np.float32), affine).to_filename(files['thresh'][-1])
+            del thresh
+    return files
+
+
+class RSSSampler(object):
+    """
+    Peak RSS of this process and all of its descendants (e.g., joblib workers), sampled from /proc (Linux only)
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    @staticmethod
+    def get_tree_rss():
+        children = {}
+        for pid in os.listdir('/proc'):
+            if pid.isdigit():
+                try:
+                    with open('/proc/{0}/stat'.format(pid)) as f:
+                        ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                    children.setdefault(ppid, []).append(int(pid))
+                except (IOError, OSError, IndexError, ValueError):
+                    continue
+        rss = 0
+        todo = [os.getpid()]
+        while len(todo) > 0:
+            pid = todo.pop()
+            todo.extend(children.get(pid, []))
+            try:
+                with open('/proc/{0}/statm'.format(pid)) as f:
+                    rss += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            except (IOError, OSError):
+                continue
+        return rss
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.get_tree_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if os.path.isdir('/proc'):
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+def get_peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024.0 ** 2 if sys.platform == 'darwin' else peak / 1024.0  # bytes on macOS, KB on Linux
+
+
+def run_config(config):
+    """
+    Run one configuration (in a process of its own, so that its peak RSS is its own), returns a dictionary of results
+    """
+    sys.path.append(TRACTREC_DIR)
+    import TractREC as tr
+    if config['cache_mb'] > 0:
+        tr.set_img_cache_size(config['cache_mb'] * 1024 ** 2)
+        tr.set_resample_cache_size(config['cache_mb'] * 1024 ** 2)
+    base_rss = get_peak_rss_mb()
+    n_subjects = config['n_subjects']
+    files = config['files']
+    label_file = files['coarse_labels'] if config['option'] == 'resample' else files['labels']
+    kwargs = {}
+    if config['option'] == 'erode':
+        kwargs['erode_vox'] = 1
+    elif config['option'] == 'thresh':
+        kwargs.update(thresh_val=0.5, thresh_type='lower')
+
+    single = []
+    for repeat in range(config['repeats'] + 1):  # the first run is a warm-up (imports, page cache)
+        start = time.time()
+        res = tr.extract_stats_from_masked_image(files['metric'][0], label_file, max_val=1, thresh_mask_fname=(
+            files['thresh'][0] if config['option'] == 'thresh' else None), **kwargs)
+        single.append(time.time() - start)
+    single = single[1:]
+    n_labels = len(res.label_val)
+
+    IDs = ['sub{0:03d}'.format(subject) for subject in range(n_subjects)]
+    cohort = []
+    with RSSSampler() as sampler:
+        for repeat in range(config['repeats']):
+            start = time.time()
+            df = tr.extract_quantitative_metric(files['metric'][:n_subjects], [label_file] * n_subjects, IDs=IDs,
+                                                metric='all', max_val=1, ALL_FILES_ORDERED=True,
+                                                n_jobs=config['n_jobs'], thresh_mask_files=(
+                                                    files['thresh'][:n_subjects] if config['option'] == 'thresh'
+                                                    else None), **kwargs)
+            cohort.append(time.time() - start)
+    n_failed = int(df['error'].notnull().sum()) if 'error' in df.columns else 0
+    return {'t_subject_s': min(single), 'per_label_ms': 1000. * min(single) / max(n_labels, 1),
+            'vox_per_s': files['n_vox'] / min(single), 't_cohort_s': min(cohort),
+            'subjects_per_s': n_subjects / min(cohort), 'n_labels_found': n_labels, 'n_failed': n_failed,
+            'base_rss_mb': base_rss, 'peak_rss_mb': get_peak_rss_mb(),
+            'peak_tree_rss_mb': sampler.peak / 1024.0 ** 2 if sampler.peak > 0 else None}
+
+
+def get_meta(args):
+    import scipy
+    meta = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpu_count': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+            'numpy': np.__version__, 'nibabel': nb.__version__, 'scipy': scipy.__version__, 'args': vars(args)}
+    try:
+        import nilearn
+        meta['nilearn'] = nilearn.__version__
+    except ImportError:
+        meta['nilearn'] = None
+    try:
+        repo = os.path.dirname(TRACTREC_DIR)
+        meta['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo).decode().strip()
+        meta['dirty'] = len(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                                    cwd=repo).strip()) > 0
+    except (OSError, subprocess.CalledProcessError):
+        meta['commit'] = None
+    return meta
+
+
+def get_key(result):
+    return (result['res'], result['n_labels'], result['n_subjects'], result['option'], result['n_jobs'])
+
+
+def compare(results, old_fname):
+    """
+    Print the ratios of subjects per second, per-label cost, and peak RSS against an earlier run
+    """
+    with open(old_fname) as f:
+        old = json.load(f)
+    old_results = dict([(get_key(result), result) for result in old['results'] if 'error' not in result])
+    print("\nCompared to {0} (commit {1}), new / old: subj/s above 1 and ms/label below 1 are faster".format(
+        old_fname, old['meta'].get('commit')))
+    print("{0:>5} {1:>6} {2:>4} {3:>9} {4:>10} {5:>10} {6:>10}".format(
+        'res', 'labels', 'subj', 'option', 'subj/s', 'ms/label', 'peak RSS'))
+    for result in results:
+        prev = old_results.get(get_key(result))
+        if prev is None or 'error' in result:
+            continue
+        print("{0:>5} {1:>6} {2:>4} {3:>9} {4:>9.2f}x {5:>9.2f}x {6:>9.2f}x".format(
+            result['res'], result['n_labels'], result['n_subjects'], result['option'],
+            result['subjects_per_s'] / prev['subjects_per_s'], result['per_label_ms'] / prev['per_label_ms'],
+            result['peak_rss_mb'] / prev['peak_rss_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--res', type=float, nargs='+', default=[2., 1., 0.5], help='voxel sizes (mm)')
+    parser.add_argument('--n_labels', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--n_subjects', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--options', nargs='+', default=OPTIONS, choices=OPTIONS)
+    parser.add_argument('--n_jobs', type=int, default=1, help='n_jobs of extract_quantitative_metric')
+    parser.add_argument('--repeats', type=int, default=1, help='best of this many runs')
+    parser.add_argument('--cache_mb', type=int, default=0, help='image and resampling cache budgets (MB)')
+    parser.add_argument('--gz', action='store_true', help='write the phantoms as .nii.gz rather than .nii')
+    parser.add_argument('--quick', action='store_true', help='small sweep: 2 and 1mm, 10 and 100 labels, 2 subjects')
+    parser.add_argument('--out', default=None, help='json file of results (default: bench_phantom_<commit>.json)')
+    parser.add_argument('--compare', default=None, help='json file of an earlier run to compare with')
+    parser.add_argument('--run_config', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_config is not None:  # one configuration, in its own process
+        print(json.dumps(run_config(json.loads(args.run_config))))
+        return
+    if args.quick:
+        args.res, args.n_labels, args.n_subjects = [2., 1.], [10, 100], [2]
+
+    meta = get_meta(args)
+    out_fname = args.out or 'bench_phantom_{0}.json'.format((meta['commit'] or 'nogit')[:7])
+    results = []
+    print("{0:>5} {1:>15} {2:>6} {3:>4} {4:>9} {5:>9} {6:>9} {7:>9} {8:>9}".format(
+        'res', 'shape', 'labels', 'subj', 'option', 's/subj', 'ms/label', 'subj/s', 'peak MB'))
+    for res in args.res:
+        for n_labels in args.n_labels:
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                files = make_phantoms(tmp_dir, res, n_labels, max(args.n_subjects), args.options,
+                                      ext='.nii.gz' if args.gz else '.nii')
+                for n_subjects in args.n_subjects:
+                    for option in args.options:
+                        config = {'res': res, 'n_labels': n_labels, 'n_subjects': n_subjects, 'option': option,
+                                  'n_jobs': args.n_jobs, 'repeats': args.repeats, 'cache_mb': args.cache_mb}
+                        result = dict(config, shape=files['shape'], n_vox=files['n_vox'])
+                        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run_config',
+                                                 json.dumps(dict(config, files=files))],
+                                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                        out, err = proc.communicate()
+                        lines = out.decode().strip().splitlines()
+                        try:
+                            result.update(json.loads(lines[-1]))
+                        except (IndexError, ValueError):
+                            result['error'] = err.decode().strip().splitlines()[-1:] or ['no output']
+                            print("{0:>5} {1:>15} {2:>6} {3:>4} {4:>9}  failed: {5}".format(
+                                res, 'x'.join(map(str, files['shape'])), n_labels, n_subjects, option,
+                                result['error'][0]))
+                            results.append(result)
+                            continue
+                        results.append(result)
+                        print("{0:>5} {1:>15} {2:>6} {3:>4} {4:>9} {5:>9.3f} {6:>9.3f} {7:>9.2f} {8:>9.0f}".format(
+                            res, 'x'.join(map(str, files['shape'])), n_labels, n_subjects, option,
+                            result['t_subject_s'], result['per_label_ms'], result['subjects_per_s'],
+                            result['peak_tree_rss_mb'] if args.n_jobs != 1 and result['peak_tree_rss_mb']
+                            else result['peak_rss_mb']))
+            finally:
+                shutil.rmtree(tmp_dir)
+
+    with open(out_fname, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    print("Results saved to {0}".format(out_fname))
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Peak memory and time of extract_stats_from_masked_image in memory vs. BY_SLAB on a large synthetic atlas and metric,
+and how far the slab-wise results are from the in-memory ones (exact median, and the one-pass sketch median)
+
+    python bench_slab_stats.py --shape 300 360 300 --n_labels 200 --slab_size 16
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+
+import numpy as np
+import nibabel as nb
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TractREC'))
+import TractREC as tr
+
+
+def run(metric_fname, atlas_fname, **kwargs):
+    tracemalloc.start()
+    start = time.time()
+    res = tr.extract_stats_from_masked_image(metric_fname, atlas_fname, min_val=0, max_val=0.9, **kwargs)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return res, peak / 1024.0 ** 2, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--shape', type=int, nargs=3, default=[300, 360, 300])
+    parser.add_argument('--n_labels', type=int, default=200)
+    parser.add_argument('--slab_size', type=int, default=16)
+    args = parser.parse_args()
+    shape = tuple(args.shape)
+    rng = np.random.RandomState(0)
+
+    coarse = rng.randint(1, args.n_labels + 1, size=[int(np.ceil(dim / 12.0)) for dim in shape])
+    atlas = np.kron(coarse, np.ones((12, 12, 12), dtype=np.int16))[:shape[0], :shape[1], :shape[2]]
+    atlas[:10] = 0
+    metric = rng.rand(*shape).astype(np.float32)
+    metric[rng.rand(*shape) < 0.2] = 0
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        metric_fname = os.path.join(tmp_dir, 'metric.nii.gz')
+        atlas_fname = os.path.join(tmp_dir, 'atlas.nii.gz')
+        nb.Nifti1Image(metric, np.eye(4)).to_filename(metric_fname)
+        nb.Nifti1Image(atlas.astype(np.int16), np.eye(4)).to_filename(atlas_fname)
+        del metric, atlas
+        print("Volume: {0}, {1} labels, slabs of {2} slices".format(shape, args.n_labels, args.slab_size))
+
+        ref, peak, elapsed = run(metric_fname, atlas_fname)
+        print("{0:<16} peak: {1:8.1f}MB  time: {2:6.2f}s".format('in memory', peak, elapsed))
+        for median in ['exact', 'sketch']:
+            res, peak, elapsed = run(metric_fname, atlas_fname, BY_SLAB=True, slab_size=args.slab_size, median=median)
+            same = all([np.allclose(getattr(ref, key), getattr(res, key), rtol=1e-9)
+                        for key in ['volume', 'mean', 'std', 'minn', 'maxx', 'sum']])
+            median_err = np.max(np.abs(res.median - ref.median) / np.abs(ref.median))
+            print("{0:<16} peak: {1:8.1f}MB  time: {2:6.2f}s  same stats: {3}  max median rel. error: {4:.2e}".format(
+                'slab ' + median, peak, elapsed, same, median_err))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Peak memory and time of tract_seg3 on dense tract density images vs. the same images as SparseVolumes
+Writes n_tracts synthetic tract maps (each nonzero in a random tube of ~density of the volume), runs both versions,
+checks that the outputs are identical, and prints peak allocations (tracemalloc) and wall times
+
+    python bench_sparse_seg.py --n_tracts 50 --shape 145 174 145 --density 0.03
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+
+import numpy as np
+import nibabel as nb
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TractREC'))
+import TractREC as tr
+import sparse_volume as spv
+
+
+def make_tract(shape, density, rng):
+    # a blurry line between two random points, with streamline-count-like values
+    n_vox = int(density * np.prod(shape))
+    start = rng.rand(3) * shape
+    stop = rng.rand(3) * shape
+    t = rng.rand(n_vox, 1)
+    pts = start + t * (stop - start) + rng.randn(n_vox, 3) * 3
+    pts = np.clip(np.round(pts).astype(int), 0, np.array(shape) - 1)
+    d = np.zeros(shape, dtype=np.float32)
+    np.add.at(d, tuple(pts.T), 1)
+    return d
+
+
+def run(files, out_basename, **kwargs):
+    tracemalloc.start()
+    start = time.time()
+    tr.tract_seg3(files, out_basename, CLOBBER=True, **kwargs)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024.0 ** 2, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n_tracts', type=int, default=50)
+    parser.add_argument('--shape', type=int, nargs=3, default=[145, 174, 145])
+    parser.add_argument('--density', type=float, default=0.03, help='fraction of voxels in each tract')
+    args = parser.parse_args()
+    shape = tuple(args.shape)
+    rng = np.random.RandomState(0)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        files = []
+        sparse_files = []
+        for idx in range(args.n_tracts):
+            d = make_tract(shape, args.density, rng)
+            fname = os.path.join(tmp_dir, 'tract_{0:03d}.nii.gz'.format(idx))
+            nb.Nifti1Image(d, np.eye(4)).to_filename(fname)
+            files.append(fname)
+            sparse_files.append(spv.SparseVolume.from_dense(d).save(fname.replace('.nii.gz', spv.SPARSE_EXT)))
+        nnz = sum([spv.load_sparse(fname).nnz for fname in sparse_files])
+        print("{0} tracts of shape {1}, {2:.1f}% of voxels nonzero on average".format(
+            args.n_tracts, shape, 100.0 * nnz / args.n_tracts / np.prod(shape)))
+
+        results = {}
+        for name, ins, kwargs in [('dense', files, {}), ('dense BY_SLICE', files, {'BY_SLICE': True}),
+                                  ('sparse (.npz)', sparse_files, {})]:
+            out_basename = os.path.join(tmp_dir, name.split(' ')[0] + ('_slice' if kwargs else ''))
+            results[name] = run(ins, out_basename, **kwargs) + (out_basename,)
+
+        print("")
+        ref = results['dense'][2]
+        for name, (peak, elapsed, out_basename) in sorted(results.items()):
+            same = all([np.array_equal(nb.load(ref + '_seg_' + out + '.nii.gz').get_fdata(),
+                                       nb.load(out_basename + '_seg_' + out + '.nii.gz').get_fdata())
+                        for out in ['idx', 'tot', 'prt', 'pct']])
+            print("{0:<16} peak: {1:8.1f}MB  time: {2:6.2f}s  identical: {3}".format(name, peak, elapsed, same))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
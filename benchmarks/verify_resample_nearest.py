@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Check that resample_nearest gives exactly the voxels of nilearn's resample_img(interpolation='nearest',
+force_resample=True) on random grids (integer up/downsampling, translations, aligned corners and centres, partial
+overlaps, 4D, nan/inf, rotations), that resample_to_grid persists nearest resamplings to its disk cache and reads them
+back, and time both on a full-size label image
+
+    python verify_resample_nearest.py --n_cases 500
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import warnings
+
+import numpy as np
+import nibabel as nb
+from nilearn.image import resample_img
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TractREC'))
+import TractREC as tr
+
+
+def nilearn_nearest(img, target_affine, target_shape):
+    try:
+        return np.asarray(resample_img(img, target_affine, target_shape, interpolation='nearest',
+                                       force_resample=True).get_data())
+    except Exception as e:
+        return type(e)
+
+
+def fast_nearest(img, target_affine, target_shape):
+    try:
+        return tr.resample_nearest(img, target_affine, target_shape)
+    except Exception as e:
+        return type(e)
+
+
+def check_disk_cache(rng):
+    """
+    resample_to_grid saves nearest resamplings (by indexing, and rotations that go to resample_img) to the disk cache,
+    and a second call reads them back without resampling
+    """
+    tmp_dir = tempfile.mkdtemp()
+    resample_nearest = tr.resample_nearest
+    try:
+        fname = os.path.join(tmp_dir, 'labels.nii')
+        nb.Nifti1Image(rng.randint(0, 20, size=(20, 24, 20)).astype(np.int16), np.eye(4)).to_filename(fname)
+        rot = np.eye(4)
+        rot[:2, :2] = [[np.cos(0.3), -np.sin(0.3)], [np.sin(0.3), np.cos(0.3)]]
+        grids = [(np.diag([2., 2., 2., 1.]), (10, 12, 10)), (rot, (20, 24, 20))]
+        tr.set_resample_cache_size(0, cache_dir=os.path.join(tmp_dir, 'cache'))
+        first = [np.array(tr.resample_to_grid(fname, affine, shape)) for affine, shape in grids]
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        n_saved = len([name for name in (os.listdir(cache_dir) if os.path.isdir(cache_dir) else [])
+                       if name.endswith('.npy')])
+
+        def fail(*args, **kwargs):
+            raise AssertionError("resampled again instead of reading the disk cache")
+        tr.resample_nearest = fail
+        second = [tr.resample_to_grid(fname, affine, shape) for affine, shape in grids]
+        return n_saved == len(grids) and all([np.array_equal(a, b) for a, b in zip(first, second)])
+    except AssertionError:
+        return False
+    finally:
+        tr.resample_nearest = resample_nearest
+        tr.RESAMPLE_CACHE_DIR = None
+        shutil.rmtree(tmp_dir)
+
+
+def random_case(rng):
+    """
+    Random source image and target grid, mostly related by integer scaling and/or translation
+    """
+    shape = tuple(rng.randint(2, 14, size=3))
+    vox = rng.choice([0.5, 1., 1.5, 2., 3.], size=3)
+    source_affine = np.diag(np.append(vox, 1.))
+    source_affine[:3, 3] = rng.uniform(-20, 20, size=3)
+    kind = rng.choice(['down', 'up', 'shift', 'fraction', 'rotation'])
+    if kind == 'down':
+        factor = rng.randint(1, 5, size=3)
+    elif kind == 'up':
+        factor = 1. / rng.randint(1, 5, size=3)
+    elif kind == 'fraction':
+        factor = rng.uniform(0.3, 3., size=3)
+    else:
+        factor = np.ones(3)
+    target_affine = np.diag(np.append(vox * factor, 1.))
+    corner = rng.choice(['centre', 'corner', 'random'])
+    if corner == 'centre':  # voxel centres aligned
+        offset = np.zeros(3)
+    elif corner == 'corner':  # voxel corners aligned (nearest is a tie for even factors)
+        offset = (vox * factor - vox) / 2.
+    else:
+        offset = rng.uniform(-3, 3, size=3) * vox
+    if kind == 'shift':
+        offset = rng.randint(-4, 5, size=3) * vox
+    target_affine[:3, 3] = source_affine[:3, 3] + offset
+    if kind == 'rotation':
+        theta = rng.uniform(0, np.pi)
+        rot = np.eye(4)
+        rot[:2, :2] = [[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]]
+        target_affine = np.dot(rot, target_affine)
+    target_shape = tuple(np.maximum(1, (np.array(shape) * vox / (vox * factor)).astype(int) + rng.randint(-2, 3, 3)))
+
+    dtype = rng.choice(['int16', 'float32', 'float64', 'uint8'])
+    data = rng.randint(0, 50, size=shape + ((rng.randint(2, 4),) if rng.rand() < 0.2 else ()))
+    data = data.astype(dtype)
+    if dtype.startswith('float') and rng.rand() < 0.3:
+        data[rng.rand(*data.shape) < 0.1] = np.nan
+        data[rng.rand(*data.shape) < 0.05] = np.inf
+    return nb.Nifti1Image(data, source_affine), target_affine, target_shape
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n_cases', type=int, default=500)
+    parser.add_argument('--shape', type=int, nargs=3, default=[182, 218, 182])
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+    rng = np.random.RandomState(0)
+
+    n_fast = 0
+    failures = []
+    for case in range(args.n_cases):
+        img, target_affine, target_shape = random_case(rng)
+        ref = nilearn_nearest(img, target_affine, target_shape)
+        res = fast_nearest(img, target_affine, target_shape)
+        if tr.get_nearest_grid_index(img.affine, img.shape, target_affine, target_shape) is not None:
+            n_fast += 1
+        if isinstance(ref, type) or isinstance(res, type):
+            same = ref is res
+        else:
+            same = ref.dtype == res.dtype and np.array_equal(ref, res, equal_nan=True)
+        if not same:
+            failures.append(case)
+    print("{0} cases, {1} by indexing, {2} different from resample_img {3}".format(
+        args.n_cases, n_fast, len(failures), failures[:20]))
+    CACHED = check_disk_cache(rng)
+    print("disk cache written and read back: {0}".format(CACHED))
+
+    shape = tuple(args.shape)
+    atlas = rng.randint(0, 200, size=shape).astype(np.int16)
+    img = nb.Nifti1Image(atlas, np.diag([1., 1., 1., 1.]))
+    for name, target_affine, target_shape in [
+            ('2mm (down x2)', np.diag([2., 2., 2., 1.]), tuple([dim // 2 for dim in shape])),
+            ('0.5mm (up x2)', np.diag([.5, .5, .5, 1.]), tuple([dim * 2 for dim in shape])),
+            ('shift 3 vox', np.array([[1., 0, 0, 3], [0, 1, 0, -3], [0, 0, 1, 2], [0, 0, 0, 1]]), shape)]:
+        start = time.time()
+        ref = nilearn_nearest(img, target_affine, target_shape)
+        t_ref = time.time() - start
+        start = time.time()
+        res = fast_nearest(img, target_affine, target_shape)
+        t_res = time.time() - start
+        print("{0:<16} resample_img: {1:6.2f}s  resample_nearest: {2:6.2f}s  same: {3}".format(
+            name, t_ref, t_res, np.array_equal(ref, res)))
+    return len(failures) == 0 and CACHED
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)